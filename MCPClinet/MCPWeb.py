@@ -3,17 +3,32 @@ import json
 import os
 import traceback
 import re
+import time
 from typing import Dict, List, Any, Optional
 from contextlib import AsyncExitStack
 # import requests # 不再使用 requests
 import httpx # <--- 引入 httpx
 from dotenv import load_dotenv
-from mcp import ClientSession, StdioServerParameters
+from mcp import ClientSession, StdioServerParameters, types
 from mcp.client.stdio import stdio_client
 from mcp.client.sse import sse_client
 from utils.TokenAndConversation import TokenCounter, ConversationManager
-from utils.handleLog import log_tool_info_websocket, outputTokenInfo 
+from utils.handleLog import log_tool_info_websocket, outputTokenInfo, log_prompt_cache_usage, log_startup_resources, tool_log_sink
 from utils.handleStream import parse_stream_response_websocket, get_stream_chunks
+from utils.wsCoalescer import WebSocketCoalescer
+from utils.sseDecoder import SSEDecoder
+from utils.toolCatalog import ToolCatalog
+from utils.sessionRegistry import SessionRegistry, ConversationSession
+from utils.conversationStore import ConversationStore
+from utils.toolResultCache import ToolResultCache
+from utils.singleFlight import ToolSingleFlight
+from utils.serverBulkhead import ServerBulkhead, BulkheadRejected
+from utils.toolSchemaCache import ToolSchemaCache, server_fingerprint
+from utils.toolRouter import ToolRouter
+from utils.toolOutputStore import ToolOutputStore, READ_TOOL_OUTPUT_TOOL
+from utils.llmProviders import LLMProvider, ProviderPool, load_providers, is_retryable_status, is_content_event
+from utils.metrics import (registry as metrics_registry, LLM_CONNECT_SECONDS, LLM_TTFT_SECONDS, LLM_STREAM_SECONDS,
+                           TOOL_CALL_SECONDS, OPTIMIZE_HISTORY_SECONDS, WS_SEND_SECONDS)
 from quart import Quart, websocket, current_app
 import traceback
 
@@ -21,12 +36,73 @@ import traceback
 load_dotenv('../Aliyunmodel.env')
 isStream = True # 是否启用流式输出
 MAX_TOOL_ITERATIONS = 5 # 最大工具调用迭代次数
+COMPLETION_RESERVE_TOKENS = 4096 # 为模型回答预留的 token 数；历史的 token 预算 = 模型上下文窗口 - 工具定义 - 该值
+MIN_HISTORY_TOKEN_BUDGET = 2048 # 历史 token 预算的下限 (工具定义过多时避免预算为负而清空整个历史)
 LLM_TIMEOUT = 180 # LLM 调用超时 (秒)
-TOOL_TIMEOUT = 120 # 工具调用超时 (秒)
+LLM_PROVIDER_ENVS = ["../Aliyunmodel.env", "../SFmodel.env", "../model.env"] # 备用 LLM 接口 (OpenAI 兼容)，主接口为上面加载的环境变量
+LLM_HEDGE_TTFT = 8 # 首 token 超过该时间 (秒) 时向下一个接口发送对冲请求，None 表示不对冲
+TOOL_TIMEOUT = 120 # 工具调用超时 (秒)，包括排队时间；可在服务器配置的 "bulkhead" 字段中按服务器覆盖以下参数
+TOOL_MAX_CONCURRENCY = 4 # 每个服务器同时执行的工具调用上限
+TOOL_MAX_QUEUE = 32 # 每个服务器排队等待的工具调用上限，超过后立即返回 "服务器繁忙"
+BREAKER_FAILURE_THRESHOLD = 3 # 连续超时或出错该次数后熔断
+BREAKER_COOLDOWN = 30 # 熔断持续时间 (秒)，期间调用直接失败
+TOOL_CACHE_MAX_BYTES = 32 * 1024 * 1024 # 工具结果缓存的字节预算，缓存规则见 MCP 配置中的 "cache" 字段
+TOOL_OUTPUT_PREVIEW_THRESHOLD = 4000 # 超过该字符数的工具输出只在对话中保留预览，完整内容存档供按引用读取
+TOOL_OUTPUT_STORE_MAX_BYTES = 64 * 1024 * 1024 # 工具输出存档在内存中的字节预算
+TOOL_OUTPUT_STORE_DIR = "./cache/tool_outputs" # 工具输出存档目录 (按内容寻址)，重启后历史中的引用仍可读取，与会话存储按同一保留时间清理；None 表示只保存在内存中
+BUILTIN_SERVER = "client" # 客户端内置工具的服务器名前缀
+EAGER_TOOL_DISPATCH = True # 流式输出时，工具调用参数生成完毕即提前派发，与后续生成重叠
+# 只有只读工具会被提前派发 (轮次中断时取消不会留下副作用)：配置了缓存 TTL 的工具，以及服务器配置 "eager_dispatch" 中列出的工具
+STABLE_PROMPT_PREFIX = True # 固定系统提示 + 工具定义 + 只追加的历史，临时引导放在末尾，提高服务端前缀缓存命中率
+TOOL_ROUTER_ENABLED = True # 按用户问题检索相关工具，每次调用 LLM 只发送 top-k 个工具定义 (同一轮内不变)
+TOOL_ROUTER_TOP_K = 12 # 每轮按相关度选出的工具数 (另加客户端内置工具和最近用过的工具)
+TOOL_ROUTER_MIN_TOOLS = 24 # 工具总数不超过该值时不路由，直接发送全部工具
+TOOL_ROUTER_MIN_SCORE = 1.0 # 最相关工具的 BM25 分数低于该值时 (问题与工具描述几乎没有共同的词) 不路由，发送全部工具
+MAX_SESSIONS = 200 # 最多保留的会话数
+SESSION_MEMORY_BUDGET = 256 * 1024 * 1024 # 所有会话历史的内存预算 (字节)
+SESSION_IDLE_TTL = 3600 # 空闲会话保留时间 (秒)
+CONVERSATION_STORE_FILE = "./cache/conversations.db" # 会话历史的持久化存储 (SQLite WAL)，重启后会话重连时按 session_id 恢复；None 表示不持久化
+CONVERSATION_RETENTION = 7 * 24 * 3600 # 会话超过该时间 (秒) 没有新事件时从持久化存储中删除；None 表示永久保留
+WS_FLUSH_INTERVAL = 0.04 # 流式输出合并窗口 (秒)，窗口内的增量合并为一帧发送
+WS_FLUSH_BYTES = 4096 # 缓冲超过该字节数时立即发送
+WS_MAX_PENDING_BYTES = 256 * 1024 # 客户端跟不上时最多缓冲的字节数，超过后暂停读取 LLM 流 (背压)
+SERVER_HANDSHAKE_TIMEOUT = 60 # 单个 MCP 服务器握手超时 (秒)，可在服务器配置中用 handshake_timeout 覆盖
+SERVER_PING_INTERVAL = 15 # 对已连接服务器做健康检查 (ping) 的间隔 (秒)
+SERVER_PING_TIMEOUT = 10 # ping 超时 (秒)，超时视为服务器不健康并重启
+SERVER_RESTART_BACKOFF = 1 # 重启退避的初始等待 (秒)，连续失败时按指数增长
+SERVER_RESTART_BACKOFF_MAX = 300 # 重启退避的最大等待 (秒)
+SERVER_RESTART_MAX_ATTEMPTS = 8 # 连续失败该次数后不再重启
+SERVER_STABLE_SECONDS = 60 # 连接保持超过该时间后重置连续失败计数
+SERVER_LIFECYCLE = "resident" # 默认生命周期: resident 启动时连接并常驻；on_demand 首次调用其工具时才启动，空闲后关闭 (服务器配置中用 lifecycle 覆盖)
+SERVER_IDLE_TIMEOUT = 600 # on_demand 服务器空闲该时间 (秒) 后关闭进程，可在服务器配置中用 idle_timeout 覆盖
+TOOL_SCHEMA_CACHE_FILE = "./cache/tool_schemas.json" # 各服务器工具定义的持久化缓存，on_demand 服务器未运行时使用
 
 STDIO_MCP_CONFIG = "../MCPConfig/stdio_mcp_config.json"
 SSE_MCP_CONFIG = "../MCPConfig/sse_mcp_config.json"
 
+# 每次用户请求使用的系统提示
+MEMORY_SYSTEM_PROMPT = "请从记忆(当前使用memory服务器的知识图谱保存记忆)中读取记忆"
+
+QUERY_SYSTEM_PROMPT = """
+                关于用户请求的系统提示：
+                请先全面分析用户需求，确定本轮需要调用的所有工具和参数。
+                尽可能在同一轮内并发调用所有互不依赖的工具操作，提升性能；如有工具之间的先后依赖，请遵循正确顺序调用。
+                在每轮调用前后，都要思考：本轮是否已获取足够信息？工具信息是否返回了错误信息？是否有可并行调用的工具？依赖关系是否已正确处理？
+
+                <你的设定>
+         
+                </你的设定>
+
+            """
+
+TURN_INTERRUPTED_NOTE = "（本轮回答已被用户中断）" # 轮次被中断后写入历史的助手消息
+
+# 工具结果返回后引导 LLM 决策的临时系统消息
+TOOL_RESULT_GUIDANCE = """
+                 请分析最近的用户请求以及所有已调用的工具结果，判断是否已有足够信息完成用户需求。
+                 【指引】1. 若足够，请总结生成答复；2. 若不足，请生成下一步工具调用指令；3. 注意错误处理和避免重复调用。
+             """
+
 # --- 全局 App 和 MCP 客户端 ---
 app = Quart(__name__)
 mcp_client: Optional['MCPClient'] = None # 全局客户端实例
@@ -35,7 +111,8 @@ mcp_client: Optional['MCPClient'] = None # 全局客户端实例
 async def safe_send_json(ws, data: Dict[str, Any]):
     """安全地发送 JSON 格式的消息到 WebSocket"""
     try:
-        await ws.send(json.dumps(data))
+        with WS_SEND_SECONDS.time():
+            await ws.send(json.dumps(data))
     except Exception as e:
         print(f"发送 WebSocket 消息失败: {str(e)}")
         traceback.print_exc()
@@ -79,6 +156,10 @@ class MCPClientConfig:
         else:
             print("————————————————————————————当前使用硅基流动API——————————————————————————")
 
+        primary = LLMProvider("primary", self.model, self.model_base_url, self.model_api_key, self.model_contextWindow)
+        self.providers = load_providers(LLM_PROVIDER_ENVS, primary=primary)
+        print("可用 LLM 接口:", ", ".join(f"{p.name}({p.model})" for p in self.providers))
+
         self.stdio_server_config = self._load_server_config(STDIO_MCP_CONFIG)
         self.sse_server_config = self._load_server_config(SSE_MCP_CONFIG)
 
@@ -191,24 +272,41 @@ class ToolAdapter:
         return tool_calls_list
 
 
+class LLMRequestError(Exception):
+    """单个 LLM 接口请求失败"""
+    def __init__(self, provider: LLMProvider, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.provider = provider
+        self.status_code = status_code
+
+    @property
+    def retryable(self) -> bool:
+        """网络错误、408/429 和 5xx 可换接口重试；其余 4xx (请求格式、上下文超长等) 直接失败"""
+        return self.status_code is None or is_retryable_status(self.status_code)
+
+
 class LLMClient:
-    """处理与LLM API的通信 (使用 httpx)"""
+    """处理与LLM API的通信 (使用 httpx)，在多个接口间按健康度路由，并对慢请求发送对冲请求"""
     def __init__(self, config: MCPClientConfig):
         self.config = config
         # 创建可复用的 httpx 客户端
         self.http_client = httpx.AsyncClient(timeout=LLM_TIMEOUT) # 设置超时
+        self.provider_pool = ProviderPool(config.providers)
 
-    async def call_llm(self, websocket, messages: List[Dict], tools: List = None) -> Dict:
-        """调用LLM API获取响应 (使用 httpx)"""
+    def _build_request(self, provider: LLMProvider, messages: List[Dict], tools: List = None,
+                       tools_json: Optional[str] = None) -> httpx.Request:
+        """为指定接口构造请求"""
         data = {
-            "model": self.config.model,
+            "model": provider.model,
             "messages": messages,
             "stream": isStream
         }
+        if isStream:
+            data["stream_options"] = {"include_usage": True} # 流式响应的最后一个数据块返回 usage (含 cached_tokens)
         if tools:
             data["tools"] = tools
             # 根据需要添加特定模型的参数
-            if self.config.is_aliyun:
+            if provider.is_aliyun:
                 data["parallel_tool_calls"] = True # 阿里云特定参数
                 data["result_format"] = "message" # 阿里云推荐使用 message 格式
             else:
@@ -216,64 +314,184 @@ class LLMClient:
                 data["tool_choice"] = "auto"
 
         headers = {
-            "Authorization": f"Bearer {self.config.model_api_key}",
+            "Authorization": f"Bearer {provider.api_key}",
             "Content-Type": "application/json",
             "Accept": "text/event-stream" if isStream else "application/json" # 明确 Accept 类型
         }
 
-        # print(f"--- LLM Request Data ---")
-        # print(json.dumps(data, indent=2, ensure_ascii=False))
-        # print(f"--- Headers ---")
-        # print(headers)
-        # print(f"--- URL ---")
-        # print(self.config.model_base_url)
-        # print(f"------------------------")
+        if tools and tools_json:
+            del data["tools"]
+            # 请求体以 '}' 结尾，将缓存的工具 JSON 直接拼接到末尾
+            body = json.dumps(data, ensure_ascii=False)[:-1] + ', "tools": ' + tools_json + '}'
+            return self.http_client.build_request("POST", provider.base_url, headers=headers, content=body.encode('utf-8'))
+        return self.http_client.build_request("POST", provider.base_url, headers=headers, json=data)
 
+    async def _open_stream(self, provider: LLMProvider, request: httpx.Request):
+        """发送流式请求并等待第一个内容 token，返回 (响应, 字节迭代器, 已读取的数据块, TTFT)
 
+        TTFT 以第一个包含正文、推理内容或工具调用的事件为准，只有角色信息或注释行的数据块不算。
+        """
+        start = time.monotonic()
+        response = await self.http_client.send(request, stream=True)
+        LLM_CONNECT_SECONDS.observe(time.monotonic() - start, provider=provider.name)
         try:
-            async with self.http_client.stream("POST", self.config.model_base_url, json=data, headers=headers) if isStream \
-                 else self.http_client.post(self.config.model_base_url, json=data, headers=headers) as response:
-
-                # print(f"LLM Response Status Code: {response.status_code}") # Debugging
-
-                if response.status_code != 200:
-                    error_content = await response.aread() # 读取错误响应体
-                    print(f"LLM 请求失败，状态码: {response.status_code}, 响应: {error_content.decode()}")
-                    await send_error_to_websocket(websocket, f"LLM 请求失败", f"状态码: {response.status_code}, 响应: {error_content.decode()}")
-                    return {"error": f"LLM 请求失败，状态码: {response.status_code}"}
-                print("response",response)
-                if isStream:
-                    # 处理流式响应 
+            if response.status_code != 200:
+                error_content = await response.aread() # 读取错误响应体
+                raise LLMRequestError(provider, f"状态码: {response.status_code}, 响应: {error_content.decode()}",
+                                      status_code=response.status_code)
+            chunks = response.aiter_bytes()
+            decoder = SSEDecoder()
+            head_chunks: List[bytes] = []
+            while not decoder.done:
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                head_chunks.append(chunk)
+                if any(is_content_event(event) for event in decoder.feed(chunk)):
+                    break
+            if not head_chunks:
+                raise LLMRequestError(provider, "响应流为空")
+            ttft = time.monotonic() - start
+            LLM_TTFT_SECONDS.observe(ttft, provider=provider.name)
+            return response, chunks, head_chunks, ttft
+        except BaseException:
+            await response.aclose()
+            raise
+
+    async def _open_hedged_stream(self, messages: List[Dict], tools: List = None, tools_json: Optional[str] = None):
+        """按健康度依次尝试接口；首 token 超过对冲阈值时向下一个接口发送对冲请求，先返回首个数据块者胜出，另一个被取消
+
+        返回 (接口, 响应, 字节迭代器, 已读取的数据块)，所有接口都失败时抛出最后一个错误；
+        请求本身被拒绝 (408/429 以外的 4xx) 时直接抛出，不换接口重试，也不计入接口的错误率
+        """
+        candidates = self.provider_pool.ranked()
+        attempts: Dict[asyncio.Task, LLMProvider] = {}
+        last_error: Optional[BaseException] = None
+
+        def start_next() -> bool:
+            if not candidates:
+                return False
+            provider = candidates.pop(0)
+            request = self._build_request(provider, messages, tools, tools_json)
+            attempts[asyncio.create_task(self._open_stream(provider, request))] = provider
+            return True
+
+        start_next()
+        hedged = False
+        try:
+            while attempts:
+                can_hedge = LLM_HEDGE_TTFT is not None and not hedged and candidates
+                done, _ = await asyncio.wait(attempts.keys(), timeout=LLM_HEDGE_TTFT if can_hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    print(f"LLM 首 token 超过 {LLM_HEDGE_TTFT}s，向 {candidates[0].name} 发送对冲请求")
+                    start_next()
+                    continue
+                for task in done:
+                    provider = attempts.pop(task)
+                    try:
+                        response, chunks, head_chunks, ttft = task.result()
+                    except Exception as e:
+                        print(f"LLM 接口 {provider.name} 请求失败: {e}")
+                        if isinstance(e, LLMRequestError) and not e.retryable:
+                            raise
+                        provider.record_failure()
+                        last_error = e
+                        continue
+                    provider.record_success(ttft)
+                    if hedged:
+                        provider.hedge_wins += 1
+                    print(f"LLM 接口 {provider.name} 首 token 耗时 {ttft:.2f}s")
+                    return provider, response, chunks, head_chunks
+                if not attempts:
+                    start_next() # 全部失败则回退到下一个接口
+        finally:
+            # 取消落败或未完成的请求 (已完成的请求需要关闭响应)
+            for task in attempts:
+                task.cancel()
+            for result in await asyncio.gather(*attempts, return_exceptions=True):
+                if isinstance(result, tuple):
+                    await result[0].aclose()
+        raise last_error or LLMRequestError(None, "没有可用的 LLM 接口")
+
+    async def call_llm(self, websocket, messages: List[Dict], tools: List = None, tools_json: Optional[str] = None,
+                       on_tool_call_ready=None, can_dispatch_early=None) -> Dict:
+        """调用LLM API获取响应 (使用 httpx)
+
+        tools_json 为工具目录缓存的序列化结果，提供时直接拼接进请求体，避免每轮重复序列化工具定义
+        on_tool_call_ready 为流式解析时的工具调用提前派发回调，can_dispatch_early 判断某个工具是否允许提前派发
+        """
+        try:
+            if isStream:
+                provider, response, chunks, head_chunks = await self._open_hedged_stream(messages, tools, tools_json)
+                stream_start = time.monotonic()
+                try:
+                    # 处理流式响应 (先交出等待首 token 时已读取的数据块)
                     async def stream_iterator():
-                        async for chunk in response.aiter_bytes():
+                        for chunk in head_chunks:
+                            yield chunk
+                        async for chunk in chunks:
                             yield chunk
 
-                    response_text, tool_calls_info, origin_tools = await parse_stream_response_websocket(websocket, stream_iterator())
-                    # 流式响应解析后，需要组装成与非流式兼容的格式
-                    response_data = {
-                        "choices": [{
-                             "message": {
-                                 "role": "assistant",
-                                 "content": response_text if not tool_calls_info else None, # 如果有工具调用，内容通常为 None
-                                 "tool_calls": origin_tools if tool_calls_info else None
-                             },
-                             "finish_reason": "tool_calls" if tool_calls_info else "stop" # 模拟 finish_reason
-                        }]
-                        # 可能还需要 usage 信息，但流式通常不直接提供最终 token 数
-                    }
-                    # print(f"DEBUG: Assembled Stream Response Data: {response_data}") # Debugging
-                    return response_data
-                else:
-                    # 处理非流式响应
-                    response_data = await response.json()
-                    # print(f"DEBUG: Non-Stream Response Data: {response_data}") # Debugging
-                    # outputTokenInfo(response_data) # 非流式可以获取 token 信息
-                    if not response_data:
-                        print("API响应内容为空")
-                        await send_error_to_websocket(websocket, "API 响应为空")
-                        return {"error": "API响应内容为空"}
-                    return response_data
+                    usage = {}
+                    coalescer = WebSocketCoalescer(websocket, flush_interval=WS_FLUSH_INTERVAL, flush_bytes=WS_FLUSH_BYTES,
+                                                   max_pending_bytes=WS_MAX_PENDING_BYTES)
+                    response_text, tool_calls_info, origin_tools = await parse_stream_response_websocket(
+                        websocket, stream_iterator(), on_tool_call_ready=on_tool_call_ready, usage=usage, coalescer=coalescer,
+                        can_dispatch_early=can_dispatch_early)
+                finally:
+                    await response.aclose()
+                    LLM_STREAM_SECONDS.observe(time.monotonic() - stream_start, provider=provider.name)
+                # 流式响应解析后，需要组装成与非流式兼容的格式
+                response_data = {
+                    "choices": [{
+                         "message": {
+                             "role": "assistant",
+                             "content": response_text if not tool_calls_info else None, # 如果有工具调用，内容通常为 None
+                             "tool_calls": origin_tools if tool_calls_info else None
+                         },
+                         "finish_reason": "tool_calls" if tool_calls_info else "stop" # 模拟 finish_reason
+                    }],
+                    "usage": usage # 接口支持 stream_options.include_usage 时才有内容
+                }
+                # print(f"DEBUG: Assembled Stream Response Data: {response_data}") # Debugging
+                return response_data
 
+            # 处理非流式响应：按健康度依次尝试，失败则回退到下一个接口
+            last_error = None
+            for provider in self.provider_pool.ranked():
+                start = time.monotonic()
+                try:
+                    response = await self.http_client.send(self._build_request(provider, messages, tools, tools_json))
+                    LLM_CONNECT_SECONDS.observe(time.monotonic() - start, provider=provider.name)
+                except httpx.RequestError as e:
+                    provider.record_failure()
+                    last_error = LLMRequestError(provider, str(e))
+                    continue
+                if response.status_code != 200:
+                    last_error = LLMRequestError(provider, f"状态码: {response.status_code}, 响应: {response.text}",
+                                                 status_code=response.status_code)
+                    if not last_error.retryable:
+                        raise last_error # 请求本身被拒绝，换接口也会失败
+                    provider.record_failure()
+                    continue
+                provider.record_success(time.monotonic() - start)
+                response_data = response.json()
+                # print(f"DEBUG: Non-Stream Response Data: {response_data}") # Debugging
+                # outputTokenInfo(response_data) # 非流式可以获取 token 信息
+                if not response_data:
+                    print("API响应内容为空")
+                    await send_error_to_websocket(websocket, "API 响应为空")
+                    return {"error": "API响应内容为空"}
+                return response_data
+            raise last_error or LLMRequestError(None, "没有可用的 LLM 接口")
+
+        except LLMRequestError as e:
+            print(f"LLM 请求失败: {e}")
+            await send_error_to_websocket(websocket, f"LLM 请求失败", str(e))
+            return {"error": f"LLM 请求失败: {e}"}
         except httpx.RequestError as e:
             print(f"LLM 请求网络错误: {e}")
             traceback.print_exc()
@@ -300,80 +518,349 @@ class MCPClient:
     def __init__(self) -> None:
         self.config = MCPClientConfig()
         self.llm_client = LLMClient(self.config)
-        self.exit_stack = AsyncExitStack()
         self.sessions: Dict[str, ClientSession] = {} # 添加类型提示
         self.connected_servers: set[str] = set() # 添加类型提示
-
-        # ConversationManager 需要根据会话 ID 管理，这里暂时还是全局
-        # **警告: 这是单用户模式，多用户需要改造**
+        self.server_status: Dict[str, str] = {} # 每个服务器的就绪状态: connecting/ready/restarting/idle/timeout/failed/gave_up/stopped
+        self.server_tasks: Dict[str, asyncio.Task] = {} # 每个服务器的连接任务 (持有其传输层上下文)
+        self.server_stop_events: Dict[str, asyncio.Event] = {}
+        self.server_wake_events: Dict[str, asyncio.Event] = {} # 唤醒健康检查 (停止或调用出现传输层错误时)
+        self.server_restarts: Dict[str, int] = {} # 每个服务器的重启次数
+        self.server_ready_events: Dict[str, asyncio.Event] = {} # 服务器当前有可用会话时置位
+        self.server_ready_futures: Dict[str, asyncio.Future] = {} # 每次启动监督任务时首次连接的结果
+        self.server_last_used: Dict[str, float] = {} # 每个服务器最近一次工具调用的时间，用于空闲回收
+        self.server_configs: Dict[str, tuple] = {name: (transport, config) for name, transport, config in self._iter_server_configs()}
+        self.tool_schema_cache = ToolSchemaCache(TOOL_SCHEMA_CACHE_FILE)
+        self.tool_catalog = ToolCatalog() # 已转换工具列表的缓存
+        self.tool_result_cache = ToolResultCache(max_bytes=TOOL_CACHE_MAX_BYTES) # 幂等工具调用的结果缓存
+        self.tool_single_flight = ToolSingleFlight(
+            is_idempotent=lambda server_name, tool_name: self.tool_result_cache.get_ttl(server_name, tool_name) > 0
+        ) # 合并进行中的相同幂等工具调用 (可缓存的工具及配置中 "single_flight" 列出的工具)
+        self.tool_bulkheads: Dict[str, ServerBulkhead] = {} # 每个服务器的并发上限、等待队列和熔断器
+        self.tool_output_store = ToolOutputStore(max_bytes=TOOL_OUTPUT_STORE_MAX_BYTES,
+                                                 preview_threshold=TOOL_OUTPUT_PREVIEW_THRESHOLD,
+                                                 directory=TOOL_OUTPUT_STORE_DIR,
+                                                 retention=CONVERSATION_RETENTION) # 长工具输出存档
+        self.tool_catalog.update(BUILTIN_SERVER, [READ_TOOL_OUTPUT_TOOL]) # 注册客户端内置工具
+        for server_name, _, server_config in self._iter_server_configs():
+            self.tool_result_cache.configure_server(server_name, server_config.get("cache"))
+            self.tool_single_flight.configure_server(server_name, server_config)
+            self.tool_bulkheads[server_name] = ServerBulkhead.from_config(
+                server_name, server_config.get("bulkhead"),
+                max_concurrency=TOOL_MAX_CONCURRENCY, max_queue=TOOL_MAX_QUEUE, timeout=TOOL_TIMEOUT,
+                failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN)
+
+        # 每个会话拥有独立的 ConversationManager，MCP 会话在所有会话间共享
         self.token_counter = TokenCounter()
-        self.conversation_manager = ConversationManager(
+        self.conversation_store = ConversationStore(CONVERSATION_STORE_FILE, retention=CONVERSATION_RETENTION) \
+            if CONVERSATION_STORE_FILE else None
+        self.conversation_sessions = SessionRegistry(
+            self._new_conversation_manager,
+            max_sessions=MAX_SESSIONS,
+            max_total_bytes=SESSION_MEMORY_BUDGET,
+            idle_ttl=SESSION_IDLE_TTL,
+        )
+        self.tool_router = ToolRouter(top_k=TOOL_ROUTER_TOP_K, min_tools=TOOL_ROUTER_MIN_TOOLS, min_score=TOOL_ROUTER_MIN_SCORE,
+                                      count_tokens=lambda text: self.token_counter.count_message_tokens(
+                                          {"role": "system", "content": text})) # 按问题选出相关工具
+        self._tools_token_cache: Dict[tuple, int] = {} # (分词器版本, 工具定义 JSON) -> token 数
+        self.max_tool_iterations = MAX_TOOL_ITERATIONS
+
+    def _new_conversation_manager(self, session_id: Optional[str] = None) -> ConversationManager:
+        """为新会话创建对话管理器"""
+        conversation = ConversationManager(
+            session_id=session_id,
             model_api_url=self.config.model_base_url,
             model_name=self.config.model,
             token_counter=self.token_counter,
-        
-        )
-        self.conversation_manager.add_message(
-            {
-                "role":"system",
-                "content":"请从记忆(当前使用memory服务器的知识图谱保存记忆)中读取记忆"
-                
-            }
+            http_client=self.llm_client.http_client, # 摘要复用共享的 httpx 客户端
+            model_api_key=self.config.model_api_key,
+            store=self.conversation_store,
         )
-        self.max_tool_iterations = MAX_TOOL_ITERATIONS
-
-    async def connect_to_servers(self) -> None:
-        """连接到所有配置的MCP服务器（支持幂等）"""
-        # --- 连接 STDIO 服务器 ---
+        if STABLE_PROMPT_PREFIX:
+            # 固定的系统提示放在不可变前缀中，后续只追加历史
+            conversation.add_system_prompt({"role": "system", "content": MEMORY_SYSTEM_PROMPT})
+            conversation.add_system_prompt({"role": "system", "content": QUERY_SYSTEM_PROMPT})
+        return conversation
+
+    async def restore_session(self, session: ConversationSession) -> None:
+        """新创建的会话从持久化存储恢复历史；持有轮次锁，恢复完成前同一会话的轮次不会开始"""
+        async with session.turn_lock:
+            if session.restored:
+                return
+            session.restored = True
+            conversation = session.conversation_manager
+            if await conversation.rehydrate():
+                print(f"从持久化存储恢复会话 {session.session_id} ({len(conversation.messages)} 条消息)")
+            elif not STABLE_PROMPT_PREFIX:
+                conversation.add_message({"role": "system", "content": MEMORY_SYSTEM_PROMPT})
+
+    def _iter_server_configs(self):
+        """遍历所有配置的服务器，返回 (服务器名, 传输类型, 配置)"""
         for server_name, server_config in self.config.stdio_server_config.get("servers", {}).items():
-            if server_name in self.connected_servers: continue
-            try:
-                server_params = StdioServerParameters(**server_config)
-                stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
-                stdio, write = stdio_transport
-                session = await self.exit_stack.enter_async_context(ClientSession(stdio, write))
-                await session.initialize()
-                self.sessions[server_name] = session
-                self.connected_servers.add(server_name)
-                print(f"✅ 成功连接到 STDIO 服务器 `{server_name}`")
-            except Exception as e:
-                print(f"❌ 连接到 STDIO 服务器 {server_name} 失败: {e}")
-                traceback.print_exc() # 打印详细错误
-
-        # --- 连接 SSE 服务器 ---
+            yield server_name, "stdio", server_config
         for server_name, server_config in self.config.sse_server_config.get("servers", {}).items():
-            if server_name in self.connected_servers: continue
-            try:
-                server_url = server_config.get("url")
-                if not server_url:
-                    print(f"❌ SSE 服务器 {server_name} 配置缺少 'url'")
+            yield server_name, "sse", server_config
+
+    async def connect_to_servers(self, wait_for_all: bool = True) -> None:
+        """并发连接所有配置的MCP服务器（支持幂等）
+
+        每个服务器在独立任务中完成握手并持有自己的传输层上下文，握手超时互不影响。
+        wait_for_all 为 False 时，只要有一个服务器就绪（或全部结束）即返回，其余服务器在后台继续连接。
+        """
+        ready_futures = []
+        for server_name, transport, server_config in self._iter_server_configs():
+            task = self.server_tasks.get(server_name)
+            if task and not task.done(): continue
+            if self._is_on_demand(server_name):
+                cached_tools = self.tool_schema_cache.get(server_name, server_fingerprint(server_config))
+                if cached_tools is not None:
+                    # 按需启动且有缓存的工具定义：先不启动进程，首次调用时再启动
+                    self.tool_catalog.update(server_name, cached_tools)
+                    self.server_status[server_name] = "idle"
                     continue
-                sse_transport = await self.exit_stack.enter_async_context(sse_client(url=server_url))
-                read, write = sse_transport
-                session = await self.exit_stack.enter_async_context(ClientSession(read, write))
-                await session.initialize()
-                self.sessions[server_name] = session
+                # 没有缓存时启动一次以获取工具定义，空闲后自动关闭
+            ready_futures.append(self._start_server(server_name))
+
+        if not ready_futures:
+            return
+        if wait_for_all:
+            await asyncio.wait(ready_futures)
+            return
+        pending = set(ready_futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if any(f.result() for f in done):
+                break
+
+    def _start_server(self, server_name: str) -> asyncio.Future:
+        """启动服务器的监督任务，返回首次连接结果的 future"""
+        transport, server_config = self.server_configs[server_name]
+        ready = asyncio.get_running_loop().create_future()
+        self.server_ready_futures[server_name] = ready
+        self.server_status[server_name] = "connecting"
+        self.server_tasks[server_name] = asyncio.create_task(
+            self._run_server(server_name, transport, server_config, ready))
+        return ready
+
+    def _is_on_demand(self, server_name: str) -> bool:
+        _, server_config = self.server_configs.get(server_name, (None, {}))
+        return server_config.get("lifecycle", SERVER_LIFECYCLE) == "on_demand"
+
+    def _is_server_available(self, server_name: str) -> bool:
+        """服务器已连接，或是可以按需启动的服务器 (已停止或多次重启失败后放弃的服务器除外)"""
+        return server_name in self.sessions or (self._is_on_demand(server_name) and
+                                                self.server_status.get(server_name) not in ("stopped", "gave_up"))
+
+    async def _ensure_server(self, server_name: str) -> bool:
+        """确保服务器有可用会话：on_demand 服务器未运行时启动它并等待握手完成
+
+        首次连接失败、监督任务退出或服务器正在退避等待重启时立即返回 False，不必等满握手超时
+        """
+        if server_name in self.sessions:
+            return True
+        if not self._is_server_available(server_name):
+            return False
+        task = self.server_tasks.get(server_name)
+        if task is not None and not task.done() and self.server_status.get(server_name) == "idle":
+            await asyncio.wait([task]) # 正在空闲回收，等待旧进程关闭后再重新启动
+        if task is None or task.done():
+            print(f"按需启动服务器 {server_name}")
+            self._start_server(server_name)
+        elif self.server_status.get(server_name) == "restarting":
+            return False # 连接失败后正在退避，本次调用直接返回错误
+        _, server_config = self.server_configs[server_name]
+        ready_event = self.server_ready_events.setdefault(server_name, asyncio.Event())
+        event_waiter = asyncio.ensure_future(ready_event.wait())
+        waiters = {event_waiter, self.server_tasks[server_name]} # 监督任务退出 (放弃重启) 时也立即返回
+        ready = self.server_ready_futures.get(server_name)
+        if ready is not None and not ready.done():
+            waiters.add(ready) # 首次连接失败时 ready 为 False，立即返回
+        try:
+            await asyncio.wait(waiters, timeout=server_config.get("handshake_timeout", SERVER_HANDSHAKE_TIMEOUT),
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            event_waiter.cancel()
+        return server_name in self.sessions
+
+    def _is_server_idle(self, server_name: str) -> bool:
+        """on_demand 服务器没有进行中或排队的调用，且最近一次调用已超过空闲时间"""
+        if not self._is_on_demand(server_name):
+            return False
+        bulkhead = self.tool_bulkheads.get(server_name)
+        if bulkhead is not None and (bulkhead.in_flight or bulkhead.waiting):
+            return False
+        _, server_config = self.server_configs[server_name]
+        idle_timeout = server_config.get("idle_timeout", SERVER_IDLE_TIMEOUT)
+        return time.monotonic() - self.server_last_used.get(server_name, 0) >= idle_timeout
+
+    async def _run_server(self, server_name: str, transport: str, server_config: Dict, ready: asyncio.Future) -> None:
+        """监督单个服务器：连接并保持连接，进程退出或健康检查失败后按指数退避重启，直到收到停止信号
+
+        每次 (重新) 连接都在本任务内创建新的传输层上下文和会话，就绪后替换 self.sessions 中的旧会话，
+        其它服务器和所有对话不受影响。
+        """
+        stop_event = asyncio.Event()
+        wake_event = asyncio.Event()
+        self.server_stop_events[server_name] = stop_event
+        self.server_wake_events[server_name] = wake_event
+        failures = 0
+        try:
+            while not stop_event.is_set():
+                uptime = await self._run_server_once(server_name, transport, server_config, ready, stop_event, wake_event)
+                if not ready.done():
+                    ready.set_result(False) # 首次连接失败不阻塞启动，之后在后台继续重试
+                if stop_event.is_set() or self.server_status.get(server_name) == "idle":
+                    break # 停止，或 on_demand 服务器空闲被回收 (下次调用时重新启动)
+                failures = 0 if uptime is not None and uptime >= SERVER_STABLE_SECONDS else failures + 1
+                if failures >= SERVER_RESTART_MAX_ATTEMPTS:
+                    self.server_status[server_name] = "gave_up" # 不再视为可用 (on_demand 服务器也不会按需启动)
+                    print(f"❌ 服务器 {server_name} 连续 {failures} 次连接失败，不再重启")
+                    break
+                delay = min(SERVER_RESTART_BACKOFF_MAX, SERVER_RESTART_BACKOFF * 2 ** max(0, failures - 1))
+                self.server_status[server_name] = "restarting"
+                self.server_restarts[server_name] = self.server_restarts.get(server_name, 0) + 1
+                print(f"🔄 {delay}s 后重启服务器 {server_name} (第 {self.server_restarts[server_name]} 次)")
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+            if stop_event.is_set():
+                self.server_status[server_name] = "stopped"
+        finally:
+            if not ready.done():
+                ready.set_result(False)
+
+    async def _run_server_once(self, server_name: str, transport: str, server_config: Dict, ready: asyncio.Future,
+                               stop_event: asyncio.Event, wake_event: asyncio.Event) -> Optional[float]:
+        """连接一次服务器并定期 ping，直到停止、传输层关闭或健康检查失败；返回连接保持的时间，未能连接时返回 None"""
+        label = "STDIO" if transport == "stdio" else "SSE"
+        timeout = server_config.get("handshake_timeout", SERVER_HANDSHAKE_TIMEOUT)
+        self.server_status[server_name] = "connecting"
+        session = None
+        connected_at = None
+        try:
+            async with AsyncExitStack() as stack:
+                if transport == "stdio":
+                    server_params = StdioServerParameters(**server_config)
+                    read, write = await stack.enter_async_context(stdio_client(server_params))
+                else:
+                    server_url = server_config.get("url")
+                    if not server_url:
+                        raise ValueError("配置缺少 'url'")
+                    read, write = await stack.enter_async_context(sse_client(url=server_url))
+                session = await stack.enter_async_context(ClientSession(read, write, message_handler=self._make_message_handler(server_name)))
+                await asyncio.wait_for(session.initialize(), timeout=timeout)
+                self.sessions[server_name] = session # 重启时替换旧会话
                 self.connected_servers.add(server_name)
-                print(f"✅ 成功连接到 SSE 服务器 `{server_name}`")
-            except Exception as e:
-                print(f"❌ 连接到 SSE 服务器 {server_name} 失败: {e}")
-                traceback.print_exc()
+                self.tool_catalog.invalidate(server_name) # 重连后需要重新获取工具列表
+                if self._is_on_demand(server_name):
+                    # 立即获取并缓存工具定义：若在收到查询前就被空闲回收，关闭后仍可使用缓存的定义
+                    await self._refresh_server_tools(server_name, session)
+                if server_name in self.tool_bulkheads:
+                    self.tool_bulkheads[server_name].record_success() # 新会话可用，关闭熔断
+                self.server_status[server_name] = "ready"
+                connected_at = time.monotonic()
+                self.server_last_used[server_name] = connected_at
+                self.server_ready_events.setdefault(server_name, asyncio.Event()).set()
+                print(f"✅ 成功连接到 {label} 服务器 `{server_name}`")
+                if not ready.done():
+                    ready.set_result(True)
+
+                # 健康检查：定期 ping，调用出现传输层错误时被提前唤醒
+                while not stop_event.is_set():
+                    try:
+                        await asyncio.wait_for(wake_event.wait(), timeout=SERVER_PING_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    wake_event.clear()
+                    if stop_event.is_set():
+                        break
+                    if self._is_server_idle(server_name):
+                        self.server_status[server_name] = "idle"
+                        print(f"💤 服务器 {server_name} 空闲，关闭进程 (下次调用时重新启动)")
+                        break
+                    try:
+                        await asyncio.wait_for(session.send_ping(), timeout=SERVER_PING_TIMEOUT)
+                    except Exception as e:
+                        self.server_status[server_name] = "unhealthy"
+                        print(f"❌ {label} 服务器 {server_name} 健康检查失败: {type(e).__name__} {e}")
+                        break
+        except asyncio.CancelledError:
+            self.server_status[server_name] = "stopped"
+            raise
+        except Exception as e:
+            if connected_at is not None:
+                self.server_status[server_name] = "unhealthy"
+                print(f"❌ {label} 服务器 {server_name} 连接中断: {e}")
+            elif isinstance(e, asyncio.TimeoutError):
+                self.server_status[server_name] = "timeout"
+                print(f"❌ 连接到 {label} 服务器 {server_name} 超时 (>{timeout}s)")
+            else:
+                self.server_status[server_name] = "failed"
+                print(f"❌ 连接到 {label} 服务器 {server_name} 失败: {e}")
+                traceback.print_exc() # 打印详细错误
+        finally:
+            if server_name in self.server_ready_events:
+                self.server_ready_events[server_name].clear()
+            if session is not None and self.sessions.get(server_name) is session:
+                del self.sessions[server_name]
+                self.connected_servers.discard(server_name)
+                if not (self._is_on_demand(server_name) and
+                        self.tool_schema_cache.get(server_name, server_fingerprint(server_config)) is not None):
+                    self.tool_catalog.remove_server(server_name) # on_demand 服务器保留缓存的工具定义
+        return time.monotonic() - connected_at if connected_at is not None else None
+
+    def _wake_supervisor(self, server_name: str) -> None:
+        """调用超时或出错时立即对该服务器做一次健康检查，不必等到下一个 ping 周期"""
+        wake_event = self.server_wake_events.get(server_name)
+        if wake_event is not None:
+            wake_event.set()
+
+    def format_server_status(self) -> str:
+        """生成各服务器就绪状态的文本"""
+        status_icons = {"ready": "✅", "connecting": "⏳", "restarting": "🔄", "idle": "💤"}
+        lines = []
+        for name, status in self.server_status.items():
+            line = f"{status_icons.get(status, '❌')} {name}: {status}"
+            if self.server_restarts.get(name):
+                line += f" (已重启 {self.server_restarts[name]} 次)"
+            bulkhead = self.tool_bulkheads.get(name)
+            if bulkhead is not None:
+                stats = bulkhead.stats()
+                line += f" (执行中 {stats['in_flight']}/{stats['max_concurrency']}，排队 {stats['waiting']}，熔断器 {stats['state']})"
+            lines.append(line)
+        return "\n".join(lines) if lines else "没有配置任何服务器。"
+
+    def _make_message_handler(self, server_name: str):
+        """为指定服务器创建消息处理器，收到 tools/list_changed 通知时使工具目录失效"""
+        async def handle_message(message) -> None:
+            if isinstance(message, types.ServerNotification) and isinstance(message.root, types.ToolListChangedNotification):
+                self.tool_catalog.invalidate(server_name)
+        return handle_message
+
+    async def _refresh_server_tools(self, server_name: str, session: ClientSession) -> None:
+        """重新获取单个服务器的工具列表并写入工具目录"""
+        try:
+            response = await session.list_tools()
+            converted = []
+            for tool in response.tools:
+                original_name = tool.name
+                # 修改工具对象本身的 name 属性
+                tool.name = f"{server_name}.{original_name}"
+                converted.append(ToolAdapter.convert_tool_format(tool))
+            self.tool_catalog.update(server_name, converted)
+            if server_name in self.server_configs:
+                await self.tool_schema_cache.put(server_name, server_fingerprint(self.server_configs[server_name][1]), converted)
+        except Exception as e:
+            print(f"获取服务器 {server_name} 的工具列表失败: {e}")
+            traceback.print_exc()
 
     async def get_available_tools(self) -> List:
-        """获取所有服务器上可用的工具，并转换为 LLM 格式"""
-        all_tools = []
-        for server_name, session in self.sessions.items():
-            try:
-                response = await session.list_tools()
-                for tool in response.tools:
-                    original_name = tool.name
-                    # 修改工具对象本身的 name 属性
-                    tool.name = f"{server_name}.{original_name}"
-                    all_tools.append(tool)
-            except Exception as e:
-                print(f"获取服务器 {server_name} 的工具列表失败: {e}")
-                traceback.print_exc()
-        return [ToolAdapter.convert_tool_format(tool) for tool in all_tools]
+        """获取所有服务器上可用的工具 (LLM 格式)，只重新拉取失效的服务器"""
+        stale = [(name, session) for name, session in self.sessions.items() if self.tool_catalog.needs_refresh(name)]
+        if stale:
+            await asyncio.gather(*(self._refresh_server_tools(name, session) for name, session in stale))
+        return self.tool_catalog.get_tools()
 
     async def list_resources(self, ws):
         """列出所有可用资源并发送到 WebSocket"""
@@ -415,7 +902,7 @@ class MCPClient:
                 prompt_list_str.append(msg)
         await send_system_message_to_websocket(ws, "可用提示列表:\n" + "\n".join(prompt_list_str))
 
-    async def handle_resource_command(self, args, ws):
+    async def handle_resource_command(self, args, ws, conversation: ConversationManager):
         """处理资源命令，并通过 WebSocket 发送结果或错误"""
         if not args or len(args) < 2 or args[0].lower() not in ['get', 'use']:
             await send_error_to_websocket(ws, "命令格式错误", "用法: /resource [get|use] <server_name>.<resource_name>")
@@ -430,7 +917,7 @@ class MCPClient:
 
         server_name, actual_resource_name = resource_full_name.split('.', 1)
 
-        if server_name not in self.sessions:
+        if not await self._ensure_server(server_name):
             await send_error_to_websocket(ws, f"未找到服务器: {server_name}")
             return
 
@@ -441,7 +928,7 @@ class MCPClient:
             if action == 'get':
                 await send_system_message_to_websocket(ws, f"资源 {resource_full_name} 内容:\n{resource_content}")
             elif action == 'use':
-                self.conversation_manager.add_message({
+                conversation.add_message({
                     "role": "system",
                     "content": f"以下是资源 {resource_full_name} 的内容:\n{resource_content}"
                 }, is_key_message=True)
@@ -453,7 +940,7 @@ class MCPClient:
             traceback.print_exc()
             await send_error_to_websocket(ws, f"处理资源 {resource_full_name} 失败", str(e))
 
-    async def handle_prompt_command(self, args, ws):
+    async def handle_prompt_command(self, args, ws, conversation: ConversationManager):
         """处理提示命令，并通过 WebSocket 发送结果或错误"""
         if not args or len(args) < 1:
              await send_error_to_websocket(ws, "命令格式错误", "用法: /prompt <server_name>.<prompt_name> [可选的JSON参数]")
@@ -466,7 +953,7 @@ class MCPClient:
 
         server_name, actual_prompt_name = prompt_full_name.split('.', 1)
 
-        if server_name not in self.sessions:
+        if not await self._ensure_server(server_name):
              await send_error_to_websocket(ws, f"未找到服务器: {server_name}")
              return
 
@@ -497,7 +984,7 @@ class MCPClient:
                  prompt_content_str = json.dumps(prompt_messages, ensure_ascii=False, indent=2)
 
 
-            self.conversation_manager.add_message({
+            conversation.add_message({
                 "role": "system",
                 "content": f"执行提示 {prompt_full_name} (参数: {json.dumps(params, ensure_ascii=False)}) 的结果已添加到对话历史。结果内容:\n{prompt_content_str}"
             }, is_key_message=True) # 标记为关键信息
@@ -514,49 +1001,108 @@ class MCPClient:
             await send_error_to_websocket(ws, f"执行提示 {prompt_full_name} 失败", str(e))
 
 
-    async def decide_next_action(self, websocket, query: str = None) -> Dict:
-        """决定下一步行动：调用 LLM 获取工具调用或最终响应"""
+    def _route_tools(self, conversation: ConversationManager, tools: List[Dict], tools_json: str,
+                     query: Optional[str] = None) -> tuple:
+        """按用户问题选出本轮发送给 LLM 的工具，返回 (工具列表, 序列化结果)
+
+        新问题时重新路由，同一轮的后续调用沿用相同的工具子集，保持请求前缀稳定
+        """
+        version = self.tool_catalog.version
+        if query:
+            builtin_tools = [tool["function"]["name"] for tool in self.tool_catalog.get_tools([BUILTIN_SERVER])]
+            conversation.routed_tools = self.tool_router.route(
+                query, tools, version, tools_json,
+                recent_tools=conversation.get_recent_tool_names(), always_include=builtin_tools)
+        if conversation.routed_tools is None:
+            return tools, tools_json
+
+        routed, routed_json, saved = self.tool_router.subset(conversation.routed_tools, tools, version, tools_json)
+        self.tool_router.record_saved(saved)
+        print(f"工具路由: 发送 {len(routed)}/{len(tools)} 个工具，节省约 {saved} 个 prompt token")
+        return routed, routed_json
+
+    def _history_token_budget(self, tools_json: str) -> int:
+        """消息可用的 token 预算: 上下文窗口 - 工具定义 - 为回答预留的 token (工具定义的 token 数按内容缓存)"""
+        key = (self.token_counter.generation, tools_json)
+        tool_tokens = self._tools_token_cache.get(key)
+        first_seen = tool_tokens is None
+        if first_seen:
+            if len(self._tools_token_cache) > 64:
+                self._tools_token_cache.clear()
+            tool_tokens = self._tools_token_cache[key] = self.token_counter.count_message_tokens(
+                {"role": "system", "content": tools_json})
+        context_window = self.llm_client.provider_pool.context_window
+        budget = context_window - tool_tokens - COMPLETION_RESERVE_TOKENS
+        if budget < MIN_HISTORY_TOKEN_BUDGET:
+            if first_seen:
+                print(f"警告: 工具定义 ({tool_tokens} tokens) 和预留回答几乎占满上下文窗口 ({context_window} tokens)，"
+                      f"历史预算按下限 {MIN_HISTORY_TOKEN_BUDGET} 计算，请减少启用的工具或调小 TOOL_ROUTER_TOP_K")
+            budget = MIN_HISTORY_TOKEN_BUDGET
+        return budget
+
+    def _widen_tool_route(self, conversation: ConversationManager, tool_name: str) -> None:
+        """模型请求了本轮未发送的工具时，后续调用改为发送全部工具"""
+        if conversation.routed_tools is not None and tool_name not in conversation.routed_tools:
+            print(f"模型请求了未发送的工具 {tool_name}，本轮后续调用发送全部工具")
+            conversation.routed_tools = None
+
+    async def decide_next_action(self, websocket, conversation: ConversationManager, query: str = None,
+                                 transient_messages: Optional[List[Dict]] = None) -> Dict:
+        """决定下一步行动：调用 LLM 获取工具调用或最终响应
+
+        transient_messages 为仅本次请求使用的引导消息，追加在消息末尾，保持前缀稳定以命中服务端前缀缓存
+        """
         if query:
             # 使用ConversationManager添加用户消息
-            self.conversation_manager.add_message({"role": "user", "content": query})
-
-            # 移除旧的系统提示，再添加新的 (如果需要动态更新的话)
-            self.conversation_manager.diminishByRoleAndKey("system", "关于用户请求的系统提示：") # 假设这个方法有效
-
-            # 添加系统提示 (可以考虑将其移到 ConversationManager 初始化时或作为固定前缀)
-            system_prompt = """
-                关于用户请求的系统提示：
-                请先全面分析用户需求，确定本轮需要调用的所有工具和参数。
-                尽可能在同一轮内并发调用所有互不依赖的工具操作，提升性能；如有工具之间的先后依赖，请遵循正确顺序调用。
-                在每轮调用前后，都要思考：本轮是否已获取足够信息？工具信息是否返回了错误信息？是否有可并行调用的工具？依赖关系是否已正确处理？
+            conversation.add_message({"role": "user", "content": query})
 
-                <你的设定>
-         
-                </你的设定>
+            if not STABLE_PROMPT_PREFIX:
+                # 移除旧的系统提示，再添加新的 (稳定前缀模式下该提示已固定在前缀中)
+                conversation.diminishByRoleAndKey("system", "关于用户请求的系统提示：") # 假设这个方法有效
+                conversation.add_message({"role": "system", "content": QUERY_SYSTEM_PROMPT})
 
-            """
-            self.conversation_manager.add_message({"role": "system", "content": system_prompt})
+        # 获取可用工具 (工具定义的序列化结果在目录版本不变时复用)
+        available_tools = await self.get_available_tools()
+        tools_json = self.tool_catalog.get_serialized()
+        if TOOL_ROUTER_ENABLED:
+            available_tools, tools_json = self._route_tools(conversation, available_tools, tools_json, query)
 
-            # 自动优化历史记录
-            await self.conversation_manager.optimize_history()
+        # 自动优化历史记录 (按模型上下文窗口扣除本次发送的工具定义和预留回答后的预算)
+        with OPTIMIZE_HISTORY_SECONDS.time():
+            await conversation.optimize_history(self._history_token_budget(tools_json))
 
-        # 获取可用工具
-        available_tools = await self.get_available_tools()
+        # 获取当前优化后的消息历史 (临时引导消息只追加在末尾，不写入历史)
+        current_messages = conversation.get_current_messages()
+        if transient_messages:
+            current_messages.extend(transient_messages)
 
-        # 获取当前优化后的消息历史
-        current_messages = self.conversation_manager.get_current_messages()
+        # 流式输出时，参数已生成完毕的工具调用会被提前派发
+        eager_tasks: Dict[str, Dict] = {}
+        on_tool_call_ready = self._make_eager_dispatcher(eager_tasks) if EAGER_TOOL_DISPATCH and isStream else None
 
         # 调用 LLM
-        response_data = await self.llm_client.call_llm(websocket, current_messages, available_tools)
+        try:
+            response_data = await self.llm_client.call_llm(websocket, current_messages, available_tools,
+                                                           tools_json=tools_json,
+                                                           on_tool_call_ready=on_tool_call_ready,
+                                                           can_dispatch_early=self._can_dispatch_early)
+        except asyncio.CancelledError:
+            self._cancel_eager_tasks(eager_tasks) # 轮次被中断，提前派发的工具调用一并取消
+            raise
 
         if "error" in response_data:
+            self._cancel_eager_tasks(eager_tasks)
             return response_data # 直接返回错误信息
 
+        if response_data.get("usage"):
+            log_prompt_cache_usage(response_data["usage"], conversation.record_prompt_usage(response_data["usage"]))
+
         # --- 解析 LLM 响应 ---
         try:
             # 非流式和流式现在都返回类似结构
             if not response_data or "choices" not in response_data or not response_data["choices"]:
                  print(f"LLM 响应格式错误或 choices 为空: {response_data}")
+                 self._cancel_eager_tasks(eager_tasks)
                  await send_error_to_websocket(websocket, "LLM 响应格式错误", f"响应: {response_data}")
                  return {"error": "LLM 响应格式错误"}
 
@@ -565,7 +1111,7 @@ class MCPClient:
 
             # 将助手消息（可能包含工具调用）添加到历史记录
             # 确保即使 content 为 None 也添加，因为可能有 tool_calls
-            self.conversation_manager.add_message({
+            conversation.add_message({
                 "role": "assistant",
                 "content": assistant_message.get("content"), # 可能为 None
                 "tool_calls": assistant_message.get("tool_calls") # 可能为 None
@@ -578,8 +1124,10 @@ class MCPClient:
             # print(f"DEBUG: Parsed tool calls from message: {parsed_tool_calls}") # Debugging
 
             if parsed_tool_calls and finish_reason == "tool_calls":
-                 return {"tool_calls": parsed_tool_calls}
-            elif assistant_message.get("content"):
+                 return {"tool_calls": parsed_tool_calls, "eager_tasks": eager_tasks}
+
+            self._cancel_eager_tasks(eager_tasks) # 最终没有工具调用，取消提前派发的任务
+            if assistant_message.get("content"):
                  # 如果没有工具调用，但有内容，则认为是最终响应
                  # 对于流式，内容在 parse_stream_response_websocket 中已发送，这里不再发送
                  # 对于非流式，内容需要在这里发送
@@ -597,33 +1145,134 @@ class MCPClient:
         except (KeyError, IndexError, TypeError) as e:
             error_msg = f"解析 LLM 响应时出错: {e}"
             print(error_msg)
+            self._cancel_eager_tasks(eager_tasks)
             print(f"原始响应数据: {response_data}")
             traceback.print_exc()
             await send_error_to_websocket(websocket, "解析 LLM 响应失败", error_msg)
             return {"error": "解析LLM响应失败"}
 
-    async def call_tool_with_timeout(self, session, tool_name, args, timeout=TOOL_TIMEOUT) -> Any:
-        """带超时的工具调用，返回 MCP 的原始 Result 对象或错误模拟对象"""
+    @staticmethod
+    def _error_result(text: str) -> types.CallToolResult:
+        """构造与 MCP 调用结果结构相同的错误结果，后续处理逻辑可以统一读取 .content[0].text"""
+        return types.CallToolResult(content=[types.TextContent(type="text", text=text)], isError=True)
+
+    async def call_tool_with_timeout(self, session, tool_name, args, timeout=TOOL_TIMEOUT,
+                                     bulkhead: Optional[ServerBulkhead] = None) -> Any:
+        """带超时的工具调用，返回 MCP 的原始 Result 对象或错误结果
+
+        提供 bulkhead 时先占用该服务器的并发名额 (排队时间计入超时)，熔断中、队列已满或排队超时时返回错误；
+        只有工具调用本身的超时和传输层错误计入熔断器的失败次数
+        """
+        if bulkhead is not None:
+            timeout = bulkhead.timeout
+        deadline = time.monotonic() + timeout
         try:
             # print(f"Calling tool: {tool_name} with args: {args}") # Debugging
-            return await asyncio.wait_for(
-                session.call_tool(tool_name, args),
-                timeout=timeout
-            )
+            if bulkhead is None:
+                return await asyncio.wait_for(session.call_tool(tool_name, args), timeout=timeout)
+            async with bulkhead.slot(timeout=timeout):
+                result = await asyncio.wait_for(session.call_tool(tool_name, args),
+                                                timeout=max(0, deadline - time.monotonic()))
+            bulkhead.record_success()
+            return result
+        except BulkheadRejected as e:
+            print(f"工具 {tool_name} 调用被拒绝: {e}")
+            return self._error_result(f"工具 {tool_name} 暂不可用: {e}")
         except asyncio.TimeoutError:
             print(f"工具 {tool_name} 调用超时 (>{timeout}s)")
-            # 返回一个模拟失败结果的对象，结构类似成功时的 Result
-            # 这使得后续处理逻辑可以统一检查 .content
-            return type('FakeTimeoutResult', (object,), {"content": [{"text": f"工具 {tool_name} 调用超时"}]})()
+            if bulkhead is not None:
+                bulkhead.record_failure()
+                self._wake_supervisor(bulkhead.server_name)
+            return self._error_result(f"工具 {tool_name} 调用超时")
         except Exception as e:
             print(f"工具 {tool_name} 调用出错: {str(e)}")
             traceback.print_exc()
-            # 返回模拟错误结果的对象
-            return type('FakeErrorResult', (object,), {"content": [{"text": f"工具 {tool_name} 调用出错: {str(e)}"}]})()
+            if bulkhead is not None:
+                bulkhead.record_failure()
+                self._wake_supervisor(bulkhead.server_name)
+            return self._error_result(f"工具 {tool_name} 调用出错: {str(e)}")
+
+    async def _call_builtin_tool(self, tool_name: str, args: Dict) -> Any:
+        """执行客户端内置工具，返回与 MCP 调用结果相同结构的对象"""
+        if tool_name == "read_tool_output":
+            text = await self.tool_output_store.read(args)
+        else:
+            text = f"错误: 未知的内置工具 {BUILTIN_SERVER}.{tool_name}"
+        return types.CallToolResult(content=[types.TextContent(type="text", text=text)])
+
+    async def call_tool(self, server_name: str, tool_name: str, args: Dict) -> Any:
+        """调用指定服务器上的工具，可缓存的幂等工具优先从结果缓存返回，相同的并发调用只执行一次"""
+        cached = self.tool_result_cache.get(server_name, tool_name, args)
+        if cached is not None:
+            print(f"工具结果缓存命中: {server_name}.{tool_name}")
+            return cached
+        return await self.tool_single_flight.call(server_name, tool_name, args,
+                                                  lambda: self._execute_tool(server_name, tool_name, args))
+
+    async def _execute_tool(self, server_name: str, tool_name: str, args: Dict) -> Any:
+        """实际执行工具调用并更新结果缓存 (on_demand 服务器未运行时先启动)"""
+        self.server_last_used[server_name] = time.monotonic()
+        if not await self._ensure_server(server_name):
+            return self._error_result(f"服务器 '{server_name}' 未能启动 (状态: {self.server_status.get(server_name, '未配置')})")
+        with TOOL_CALL_SECONDS.time(server=server_name, tool=tool_name):
+            result = await self.call_tool_with_timeout(self.sessions[server_name], tool_name, args,
+                                                       bulkhead=self.tool_bulkheads.get(server_name))
+        self.server_last_used[server_name] = time.monotonic()
+        self.tool_result_cache.on_tool_called(server_name, tool_name)
+        self.tool_result_cache.put(server_name, tool_name, args, result)
+        return result
+
+
+    def _make_eager_dispatcher(self, eager_tasks: Dict[str, Dict]):
+        """创建流式解析用的提前派发回调，派发的任务按 tool_call_id 记录到 eager_tasks"""
+        def dispatch(call: Dict) -> None:
+            tool_call_id = call["tool_call_id"]
+            tool_name = call["tool_name"]
+            if tool_call_id in eager_tasks or '.' not in tool_name:
+                return
+            server_name, actual_tool_name = tool_name.split('.', 1)
+            if not self._is_server_available(server_name):
+                return # 交给 process_tool_result 统一生成错误结果
+            print(f"提前派发工具调用: {tool_name} ({tool_call_id})")
+            task = asyncio.create_task(self.call_tool(
+                server_name,
+                actual_tool_name,
+                call["tool_args"]
+            ))
+            eager_tasks[tool_call_id] = {"name": tool_name, "args": call["tool_args"], "task": task, "start": time.monotonic()}
+        return dispatch
+
+    def _can_dispatch_early(self, qualified_name: str) -> bool:
+        """工具 ("服务器.工具") 是否可以提前派发: 只读 (可缓存) 或在服务器配置的 "eager_dispatch" 中列出
+
+        流式解析在拼接、解析参数之前先用它过滤，有副作用的工具等 LLM 输出结束、确认要执行后再调用
+        """
+        if '.' not in qualified_name:
+            return False
+        server_name, tool_name = qualified_name.split('.', 1)
+        if self.tool_result_cache.get_ttl(server_name, tool_name) > 0:
+            return True
+        for name, _, server_config in self._iter_server_configs():
+            if name == server_name:
+                return tool_name in server_config.get("eager_dispatch", [])
+        return False
+
+    @staticmethod
+    def _cancel_eager_tasks(eager_tasks: Optional[Dict[str, Dict]]) -> None:
+        """取消未被使用的提前派发任务"""
+        if not eager_tasks:
+            return
+        for detail in eager_tasks.values():
+            if not detail["task"].done():
+                detail["task"].cancel()
+        eager_tasks.clear()
 
+    async def process_tool_result(self, initial_tool_calls: List[Dict], websocket, conversation: ConversationManager,
+                                  eager_tasks: Optional[Dict[str, Dict]] = None) -> Optional[str]:
+        """处理工具调用（可能多轮），直到获得最终响应或达到迭代上限。返回最终响应字符串或 None (如果出错或无响应)。
 
-    async def process_tool_result(self, initial_tool_calls: List[Dict], websocket) -> Optional[str]:
-        """处理工具调用（可能多轮），直到获得最终响应或达到迭代上限。返回最终响应字符串或 None (如果出错或无响应)。"""
+        eager_tasks 为流式解析时已提前派发的工具调用 (tool_call_id -> 任务)，名称和参数一致时直接复用其结果。
+        """
         pending_calls = initial_tool_calls.copy()
         iteration = 0
 
@@ -641,15 +1290,16 @@ class MCPClient:
                      tool_name = call["tool_name"]
                      tool_args = call["tool_args"]
                      tool_call_id = call["tool_call_id"]
+                     self._widen_tool_route(conversation, tool_name)
                      server_name, actual_tool_name = tool_name.split('.', 1)
 
-                     if server_name not in self.sessions:
+                     if server_name != BUILTIN_SERVER and not self._is_server_available(server_name):
                          print(f"警告: 工具 {tool_name} 的服务器 {server_name} 未连接，跳过调用。")
                          # 模拟一个错误结果给 LLM
                          tool_results_for_llm.append({
                             "role": "tool",
                             "tool_call_id": tool_call_id,
-                            "content": f"错误: 服务器 '{server_name}' 未连接或不可用。"
+                            "content": f"错误: 服务器 '{server_name}' 未连接或不可用 (状态: {self.server_status.get(server_name, '未配置')})。"
                          })
                          continue
 
@@ -664,13 +1314,26 @@ class MCPClient:
                           else:
                               tool_args = {} # 其他类型直接置空
 
-                     task = asyncio.create_task(self.call_tool_with_timeout(
-                         self.sessions[server_name],
-                         actual_tool_name,
-                         tool_args
-                     ))
+                     eager = eager_tasks.pop(tool_call_id, None) if eager_tasks else None
+                     start = time.monotonic()
+                     if server_name == BUILTIN_SERVER:
+                         task = asyncio.create_task(self._call_builtin_tool(actual_tool_name, tool_args))
+                     elif eager and eager["name"] == tool_name and eager["args"] == tool_args:
+                         task = eager["task"] # 复用提前派发的调用
+                         start = eager["start"]
+                     else:
+                         if eager:
+                             eager["task"].cancel()
+                         task = asyncio.create_task(self.call_tool(
+                             server_name,
+                             actual_tool_name,
+                             tool_args
+                         ))
                      tasks.append(task)
-                     call_details[task] = {"id": tool_call_id, "name": tool_name, "args": tool_args}
+                     detail = {"id": tool_call_id, "name": tool_name, "args": tool_args, "start": start}
+                     call_details[task] = detail
+                     # 记录每个工具调用自身的完成时间，用于日志中的耗时
+                     task.add_done_callback(lambda _, d=detail: d.setdefault("end", time.monotonic()))
 
                  except Exception as e:
                      print(f"准备工具调用 {call.get('tool_name', '未知')} 时出错: {e}")
@@ -682,6 +1345,9 @@ class MCPClient:
                          "content": f"错误: 准备工具调用时失败 - {e}"
                      })
 
+            # 提前派发但未出现在最终工具调用中的任务不再需要
+            self._cancel_eager_tasks(eager_tasks)
+
             # 等待本轮所有工具调用完成
             completed_tasks = await asyncio.gather(*tasks, return_exceptions=True)
 
@@ -713,37 +1379,39 @@ class MCPClient:
                          # print(f"DEBUG: Tool {tool_name} returned unexpected structure: {type(result_or_exc)}, {result_or_exc}")
 
                  # 发送工具执行信息到 WebSocket
-                 await log_tool_info_websocket(tool_name, tool_args, tool_content, websocket) # 假设这个函数存在并发送 JSON
-
-                 # 准备发送给 LLM 的结果格式
+                 latency = detail.get("end", time.monotonic()) - detail["start"]
+                 await log_tool_info_websocket(tool_name, tool_args, tool_content, websocket,
+                                               session_id=conversation.session_id, latency=latency)
+
+                 # 准备发送给 LLM 的结果格式 (长输出存档，历史中只保留预览和引用)
+                 tool_content = str(tool_content) # 确保是字符串
+                 if not tool_name.startswith(f"{BUILTIN_SERVER}."):
+                     tool_content = await self.tool_output_store.to_context(tool_content)
                  tool_results_for_llm.append({
                      "role": "tool",
                      "tool_call_id": tool_call_id,
-                     "content": str(tool_content) # 确保是字符串
+                     "content": tool_content
                  })
 
             # 将本轮所有工具结果添加到历史记录
             for res_msg in tool_results_for_llm:
-                 self.conversation_manager.add_message(res_msg, is_key_message=True) # 工具结果通常是关键信息
+                 conversation.add_message(res_msg, is_key_message=True) # 工具结果通常是关键信息
 
             # 添加临时系统消息引导决策 (可选，但有助于复杂流程)
-            temp_system_msg_content = """
-                 请分析最近的用户请求以及所有已调用的工具结果，判断是否已有足够信息完成用户需求。
-                 【指引】1. 若足够，请总结生成答复；2. 若不足，请生成下一步工具调用指令；3. 注意错误处理和避免重复调用。
-             """
-            temp_system_msg = {"role": "system", "content": temp_system_msg_content}
-            self.conversation_manager.add_message(temp_system_msg)
-
-            # 优化历史记录
-            await self.conversation_manager.optimize_history()
+            temp_system_msg = {"role": "system", "content": TOOL_RESULT_GUIDANCE}
+            if not STABLE_PROMPT_PREFIX:
+                conversation.add_message(temp_system_msg)
 
-            # 调用 LLM 获取下一步决策
+            # 调用 LLM 获取下一步决策 (历史记录在 decide_next_action 中按预算优化)
             print("--- 请求 LLM 进行下一步决策 ---")
             # 注意：这里不再传递 query，因为用户原始 query 已在历史中
-            decision = await self.decide_next_action(websocket)
-
-            # 移除临时系统消息 (如果添加了)
-            self.conversation_manager.messages.remove(temp_system_msg)
+            if STABLE_PROMPT_PREFIX:
+                # 引导消息只追加在请求末尾，不改写历史
+                decision = await self.decide_next_action(websocket, conversation, transient_messages=[temp_system_msg])
+            else:
+                decision = await self.decide_next_action(websocket, conversation)
+                # 移除临时系统消息 (如果添加了)
+                conversation.remove_message(temp_system_msg)
 
             if "error" in decision:
                 await send_error_to_websocket(websocket, "处理工具结果时出错", decision['error'])
@@ -752,6 +1420,7 @@ class MCPClient:
             if "tool_calls" in decision:
                  print(f"--- LLM 请求调用新的工具 (迭代 {iteration+1}) ---")
                  pending_calls.extend(decision["tool_calls"])
+                 eager_tasks = decision.get("eager_tasks")
             elif "response" in decision:
                  print("--- LLM 决定生成最终响应 ---")
                  # 响应已在 decide_next_action 中通过 WebSocket 发送（如果是非流式）
@@ -767,6 +1436,7 @@ class MCPClient:
         # 达到最大迭代次数
         if iteration >= self.max_tool_iterations:
             print(f"警告: 工具调用达到最大迭代次数 ({self.max_tool_iterations})。")
+            self._cancel_eager_tasks(eager_tasks) # 剩余的工具调用不会执行
             last_tool_result = []
             for call in pending_calls:
                 last_tool_result.append({
@@ -775,10 +1445,10 @@ class MCPClient:
                      "content": 'error:工具调用次数达到上限，工具未执行，请不要再继续生成工具调用而是向用户确认当前状况' # 确保是字符串
                  })
             for res_msg in last_tool_result:
-                 self.conversation_manager.add_message(res_msg, is_key_message=True) # 工具结果通常是关键信息
+                 conversation.add_message(res_msg, is_key_message=True) # 工具结果通常是关键信息
             await send_system_message_to_websocket(websocket, f"工具调用达到最大次数 ({self.max_tool_iterations})，将尝试基于现有信息生成最终回复。")
             # 尝试让 LLM 基于现有信息做最后总结
-            final_attempt_decision = await self.decide_next_action(websocket) # 不再传入 query
+            final_attempt_decision = await self.decide_next_action(websocket, conversation) # 不再传入 query
             if "response" in final_attempt_decision:
                 return final_attempt_decision["response"]
             else:
@@ -790,11 +1460,11 @@ class MCPClient:
         return "发生未知错误，无法处理您的请求。"
 
 
-    async def process_query(self, query: str, websocket) -> Optional[str]:
+    async def process_query(self, query: str, websocket, conversation: ConversationManager) -> Optional[str]:
         """处理用户查询的主方法，返回最终响应字符串或 None"""
         # 第一步：调用 LLM 决定是直接回答还是调用工具
         print(f"--- 处理新查询: {query} ---")
-        decision = await self.decide_next_action(websocket, query)
+        decision = await self.decide_next_action(websocket, conversation, query)
 
         if "error" in decision:
             # 错误已通过 websocket 发送
@@ -806,27 +1476,29 @@ class MCPClient:
         elif "tool_calls" in decision:
              # LLM 要求调用工具
              print("--- 开始处理工具调用流程 ---")
-             final_response = await self.process_tool_result(decision["tool_calls"], websocket)
+             final_response = await self.process_tool_result(decision["tool_calls"], websocket, conversation,
+                                                              eager_tasks=decision.get("eager_tasks"))
              return final_response # 返回 process_tool_result 的结果 (可能是响应字符串或 None)
         else:
              print("警告: 初始决策既无响应也无工具调用。")
              await send_error_to_websocket(websocket, "无法理解您的请求或生成有效响应。")
              return None
 
-    async def reset_conversation(self):
-        """重置对话历史 (全局)"""
-        # **警告: 这是全局重置，多用户场景需要修改**
-        self.conversation_manager.messages = []
-        self.conversation_manager.key_messages = []
-        self.conversation_manager.system_summary = None
-        print("对话历史已重置 (全局)")
+    async def reset_conversation(self, conversation: ConversationManager):
+        """重置指定会话的对话历史"""
+        conversation.diminishMessages()
+        print("对话历史已重置")
 
     async def cleanup(self):
         """清理客户端资源"""
         print("正在清理 MCP 客户端资源...")
         try:
             await self.llm_client.close() # 关闭 httpx 客户端
-            await self.exit_stack.aclose()
+            for stop_event in self.server_stop_events.values():
+                stop_event.set()
+            for wake_event in self.server_wake_events.values():
+                wake_event.set()
+            await asyncio.gather(*self.server_tasks.values(), return_exceptions=True)
             self.sessions.clear()
             self.connected_servers.clear()
             print("MCP 客户端资源清理完成。")
@@ -843,21 +1515,20 @@ async def ws():
         await websocket.close(code=1011, reason="Server not initialized")
         return
 
-    # **多用户会话管理应该在这里开始**
-    # 例如: session_id = request.cookies.get('session_id') or generate_new_id()
-    # conversation_mgr = get_or_create_conversation_manager(session_id)
-    # 这里我们仍然使用全局的 conversation_manager
-
-    current_conversation = mcp_client.conversation_manager # **指向全局管理器**
+    # 按客户端提供的 session_id 获取会话 (同一 session_id 的多个连接共享历史)
+    session: ConversationSession = mcp_client.conversation_sessions.acquire(websocket.args.get("session_id"))
+    current_conversation = session.conversation_manager
 
     try:
-        # 1. 发送连接成功消息
+        # 1. 恢复持久化的会话历史 (仅新创建的会话)，然后发送会话 ID 和连接成功消息
+        await mcp_client.restore_session(session)
+        await safe_send_json(websocket._get_current_object(), {"type": "session", "session_id": session.session_id})
         await send_system_message_to_websocket(websocket._get_current_object(), "连接成功！MCP AI 助手已准备就绪。")
-        await send_system_message_to_websocket(websocket._get_current_object(), "输入查询内容, 或使用命令: /reset, /key, /resources, /resource, /prompts, /prompt, /view, /quit")
+        await send_system_message_to_websocket(websocket._get_current_object(), "输入查询内容, 或使用命令: /stop, /reset, /key, /resources, /resource, /prompts, /prompt, /servers, /providers, /cache, /view, /quit")
 
         """
         # 2. 发送当前历史记录给新连接的前端
-        history = current_conversation.get_current_messages() # 获取当前全局历史
+        history = current_conversation.get_current_messages() # 获取当前会话历史
         if history:
             await safe_send_json(websocket._get_current_object(), {"type": "history", "data": history})
             print(f"已发送 {len(history)} 条历史记录给新连接。")
@@ -865,6 +1536,40 @@ async def ws():
         """
 
         # 3. 进入消息处理循环
+        # 轮次在独立任务中执行，接收循环不被阻塞：/stop 或新的查询可以中断正在进行的轮次
+        ws_obj = websocket._get_current_object()
+        turn_task: Optional[asyncio.Task] = None
+
+        async def run_turn(query: str):
+            # 同一会话的轮次串行，不同会话并行；process_query 内部会处理 WebSocket 的响应发送
+            async with session.turn_lock:
+                session.touch()
+                checkpoint = current_conversation.checkpoint()
+                try:
+                    await mcp_client.process_query(query, ws_obj, current_conversation)
+                except asyncio.CancelledError:
+                    # 取消已传递到 LLM 流 (关闭 httpx 响应) 和工具调用的 gather，这里撤销本轮不完整的历史
+                    removed = current_conversation.rollback_turn(checkpoint, note=TURN_INTERRUPTED_NOTE)
+                    print(f"会话 {session.session_id} 的轮次已中断，撤销 {removed} 条消息")
+                    raise
+                except Exception as e:
+                    print(f"处理查询时发生错误: {e}")
+                    traceback.print_exc()
+                    await send_error_to_websocket(ws_obj, "处理您的请求时发生内部错误。", str(e))
+                    return
+                # 轮次结束、用户空闲时，若上下文超过软阈值则在后台提前生成摘要
+                current_conversation.maybe_schedule_summary()
+
+        async def cancel_turn() -> bool:
+            """取消正在进行的轮次并等待其清理完成，返回是否确实中断了轮次"""
+            nonlocal turn_task
+            task, turn_task = turn_task, None
+            if task is None or task.done():
+                return False
+            task.cancel()
+            await asyncio.wait([task])
+            return True
+
         while True:
             try:
                 raw_data = await websocket.receive()
@@ -887,11 +1592,13 @@ async def ws():
                     continue
 
                 print(f"收到处理请求: {query}") # 日志记录
+                turn_running = turn_task is not None and not turn_task.done()
 
                 # --- 处理内置命令 ---
                 if query.lower() == '/quit':
+                    await cancel_turn()
                     try:
-                        await send_system_message_to_websocket(websocket._get_current_object(), "您已断开连接。")
+                        await send_system_message_to_websocket(ws_obj, "您已断开连接。")
                         print("正在关闭WebSocket连接...")
                         await websocket.close(code=1000, reason="User requested disconnect")
                         print("WebSocket连接已关闭")
@@ -899,49 +1606,62 @@ async def ws():
                         print(f"关闭WebSocket连接时出错: {e}")
                         traceback.print_exc()
                     break
+                elif query.lower() == '/stop':
+                    if await cancel_turn():
+                        await send_system_message_to_websocket(ws_obj, "已停止当前回答。")
+                    else:
+                        await send_system_message_to_websocket(ws_obj, "当前没有正在进行的回答。")
+                    continue
                 elif query.lower() == '/reset':
-                    await mcp_client.reset_conversation() # 重置全局历史
-                    await send_system_message_to_websocket(websocket._get_current_object(), "对话已重置。")
+                    await cancel_turn()
+                    async with session.turn_lock:
+                        await mcp_client.reset_conversation(current_conversation) # 重置当前会话历史
+                    await send_system_message_to_websocket(ws_obj, "对话已重置。")
                     # 清空前端显示（通过发送空历史或特定命令）
-                    await safe_send_json(websocket._get_current_object(), {"type": "history", "data": []})
+                    await safe_send_json(ws_obj, {"type": "history", "data": []})
                     continue
                 elif query.lower() == '/key':
                     current_conversation.mark_current_exchange_as_key()
-                    await send_system_message_to_websocket(websocket._get_current_object(), "已标记当前交互为关键信息。")
+                    await send_system_message_to_websocket(ws_obj, "已标记当前交互为关键信息。")
                     continue
                 elif query.lower() == '/view':
                     msgs = current_conversation.get_current_messages()
                     history_content = json.dumps(msgs, indent=2, ensure_ascii=False) if msgs else "当前没有对话记录。"
                     # 将历史记录作为系统消息发送，避免前端误认为是 AI 回答
-                    await send_system_message_to_websocket(websocket._get_current_object(), f"当前对话上下文:\n```json\n{history_content}\n```")
+                    await send_system_message_to_websocket(ws_obj, f"当前对话上下文:\n```json\n{history_content}\n```")
                     continue
                 elif query.startswith('/'):
                      cmd_parts = query[1:].split()
                      cmd = cmd_parts[0].lower()
                      args = cmd_parts[1:]
-                     if cmd == 'resources':
-                         await mcp_client.list_resources(websocket._get_current_object())
+                     if cmd in ('resource', 'prompt') and turn_running:
+                         # 这两个命令会写入对话历史，不与正在进行的轮次交错
+                         await send_system_message_to_websocket(ws_obj, "请等待当前回答完成，或先使用 /stop 停止。")
+                     elif cmd == 'resources':
+                         await mcp_client.list_resources(ws_obj)
                      elif cmd == 'resource':
-                         await mcp_client.handle_resource_command(args, websocket._get_current_object())
+                         await mcp_client.handle_resource_command(args, ws_obj, current_conversation)
                      elif cmd == 'prompts':
-                         await mcp_client.list_prompts(websocket._get_current_object())
+                         await mcp_client.list_prompts(ws_obj)
                      elif cmd == 'prompt':
-                         await mcp_client.handle_prompt_command(args, websocket._get_current_object())
+                         await mcp_client.handle_prompt_command(args, ws_obj, current_conversation)
+                     elif cmd == 'providers':
+                         stats = mcp_client.llm_client.provider_pool.stats()
+                         await send_system_message_to_websocket(ws_obj, "LLM 接口状态:\n" + json.dumps(stats, ensure_ascii=False, indent=2))
+                     elif cmd == 'cache':
+                         stats = {**mcp_client.tool_result_cache.stats(), "single_flight": mcp_client.tool_single_flight.stats()}
+                         await send_system_message_to_websocket(ws_obj, "工具结果缓存:\n" + json.dumps(stats, ensure_ascii=False, indent=2))
+                     elif cmd == 'servers':
+                         await send_system_message_to_websocket(ws_obj, "服务器状态:\n" + mcp_client.format_server_status())
                      else:
-                         await send_error_to_websocket(websocket._get_current_object(), f"未知命令: {cmd}")
+                         await send_error_to_websocket(ws_obj, f"未知命令: {cmd}")
                      continue
 
                 # --- 正常处理用户查询 ---
-                # 发送一个 "正在处理" 的消息 (可选)
-                # await send_system_message_to_websocket(websocket._get_current_object(), "🤔 正在思考中...")
-
-                # 调用核心处理逻辑
-                # 注意：process_query 内部会处理 WebSocket 的响应发送
-                await mcp_client.process_query(query, websocket._get_current_object())
-
-                # 可选：在 process_query 返回后发送一个完成标记
-                # await send_system_message_to_websocket(websocket._get_current_object(), "✅ 处理完成")
-
+                # 新的查询会中断尚未完成的上一轮
+                if await cancel_turn():
+                    await send_system_message_to_websocket(ws_obj, "已中断上一轮回答，开始处理新的问题。")
+                turn_task = asyncio.create_task(run_turn(query))
 
             except asyncio.CancelledError:
                  print("WebSocket 连接被取消。")
@@ -951,31 +1671,83 @@ async def ws():
                  print(f"WebSocket 循环中发生错误: {e}")
                  traceback.print_exc()
                  # 尝试通知客户端错误
-                 await send_error_to_websocket(websocket._get_current_object(), "处理您的请求时发生内部错误。", str(e))
+                 await send_error_to_websocket(ws_obj, "处理您的请求时发生内部错误。", str(e))
                  # 可以选择 break 终止连接，或者 continue 尝试处理下一条消息
 
     finally:
-        # 连接关闭时的清理
-        print("WebSocket 连接已关闭。")
-        # 如果需要，可以在这里进行特定于此连接的清理
-        # 例如: remove_conversation_manager(session_id)
-
+        # 连接关闭时的清理：连接已断开，正在进行的轮次不再有接收方，直接取消
+        if turn_task is not None and not turn_task.done():
+            turn_task.cancel()
+            await asyncio.wait([turn_task])
+        print(f"WebSocket 连接已关闭 (会话 {session.session_id})。")
+        mcp_client.conversation_sessions.release(session)
+
+
+# --- Prometheus 指标 ---
+@app.route('/metrics')
+async def metrics():
+    """以 Prometheus 文本格式导出各环节耗时直方图和运行状态"""
+    return metrics_registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def register_runtime_gauges(client: 'MCPClient') -> None:
+    """注册在采集时读取的运行状态指标"""
+    metrics_registry.gauge("mcp_sessions", "当前保留的会话数", lambda: len(client.conversation_sessions))
+    metrics_registry.gauge("mcp_connected_servers", "已连接的 MCP 服务器数", lambda: len(client.sessions))
+    metrics_registry.gauge("mcp_tool_catalog_version", "工具目录版本", lambda: client.tool_catalog.version)
+    metrics_registry.gauge("mcp_tool_cache_hits_total", "工具结果缓存命中次数", lambda: client.tool_result_cache.hits, "counter")
+    metrics_registry.gauge("mcp_tool_cache_misses_total", "工具结果缓存未命中次数", lambda: client.tool_result_cache.misses, "counter")
+    metrics_registry.gauge("mcp_tool_router_tokens_saved_total", "工具路由节省的 prompt token 数 (估算)",
+                           lambda: client.tool_router.tokens_saved_total, "counter")
+    metrics_registry.gauge("mcp_tool_single_flight_shared_total", "与进行中的相同调用合并的工具调用次数",
+                           lambda: client.tool_single_flight.shared, "counter")
+    metrics_registry.gauge("mcp_server_restarts_total", "MCP 服务器被监督重启的次数",
+                           lambda: dict(client.server_restarts), "counter", ("server",))
+    metrics_registry.gauge("mcp_tool_queue_depth", "排队等待的工具调用数",
+                           lambda: {name: b.waiting for name, b in client.tool_bulkheads.items()}, labelnames=("server",))
+    metrics_registry.gauge("mcp_tool_in_flight", "正在执行的工具调用数",
+                           lambda: {name: b.in_flight for name, b in client.tool_bulkheads.items()}, labelnames=("server",))
+    metrics_registry.gauge("mcp_tool_breaker_open", "熔断器状态 (0 关闭，0.5 半开，1 熔断)",
+                           lambda: {name: {"closed": 0, "half_open": 0.5, "open": 1}[b.state]
+                                    for name, b in client.tool_bulkheads.items()}, labelnames=("server",))
+    metrics_registry.gauge("mcp_tool_rejected_total", "被舱壁拒绝的工具调用数",
+                           lambda: {name: b.rejected for name, b in client.tool_bulkheads.items()}, "counter", ("server",))
+    metrics_registry.gauge("mcp_tool_log_dropped_total", "因队列已满被丢弃的工具日志数", lambda: tool_log_sink.dropped, "counter")
+    if client.conversation_store:
+        metrics_registry.gauge("mcp_conversation_events_written_total", "写入持久化存储的会话事件数",
+                               lambda: client.conversation_store.written, "counter")
 
 # --- App Lifecycle ---
 @app.before_serving
 async def startup():
     global mcp_client
     print("服务启动中...")
+    startup_start = time.perf_counter()
     mcp_client = MCPClient() # 创建实例
-    await mcp_client.connect_to_servers() # 连接 MCP 服务器
-    print("MCP 服务器连接完成。服务准备就绪。")
+    mcp_client.token_counter.warm_up_in_background() # 分词器在后台加载，不阻塞启动
+    tool_log_sink.start() # 启动后台工具日志写入
+    if mcp_client.conversation_store:
+        mcp_client.conversation_store.start() # 启动会话事件的后台写盘
+    mcp_client.conversation_sessions.start() # 定期淘汰空闲会话
+    register_runtime_gauges(mcp_client)
+    log_startup_resources("MCPClient 初始化", startup_start)
+    # 并发连接 MCP 服务器，首个服务器就绪后即开始服务，其余在后台继续连接
+    await mcp_client.connect_to_servers(wait_for_all=False)
+    print("MCP 服务器已部分就绪，服务开始接受连接。")
+    print(mcp_client.format_server_status())
+    log_startup_resources("服务就绪", startup_start)
 
 @app.after_serving
 async def shutdown():
     global mcp_client
     print("服务关闭，开始清理资源...")
     if mcp_client:
+        await mcp_client.conversation_sessions.close() # 停止会话淘汰任务
         await mcp_client.cleanup() # 清理 MCP 客户端资源
+        if mcp_client.conversation_store:
+            await mcp_client.conversation_store.close() # 写完剩余的会话事件
+            print(f"会话存储统计: {mcp_client.conversation_store.stats()}")
+    await tool_log_sink.close() # 写完剩余的工具日志
+    print(f"工具日志统计: {tool_log_sink.stats()}")
     print("所有资源清理完成。")
 
 # --- Main Execution ---
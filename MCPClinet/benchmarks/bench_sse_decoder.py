@@ -0,0 +1,157 @@
+"""SSE 解码器微基准：正确性 (任意分块) 与吞吐量
+
+用法 (在 MCPClinet 目录下运行):
+    python benchmarks/bench_sse_decoder.py                 # 使用内置的模拟流
+    python benchmarks/bench_sse_decoder.py a.sse b.sse     # 使用录制的原始流
+
+录制原始流可直接保存接口的响应体，例如:
+    curl -N $MODEL_BASE_URL -H "Authorization: Bearer $MODEL_API_KEY" -H "Content-Type: application/json" \\
+         -d '{"model": "...", "stream": true, "messages": [...]}' > stream.sse
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.sseDecoder import SSEDecoder, JSON_BACKEND  # noqa: E402
+
+
+def _event(delta, usage=None) -> bytes:
+    chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "model": "bench",
+             "choices": [{"index": 0, "delta": delta, "finish_reason": None}] if delta is not None else []}
+    if usage:
+        chunk["usage"] = usage
+    return b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+def build_sample_stream(tokens: int = 2000) -> bytes:
+    """模拟一次带思考过程、正文 (中英混合) 和工具调用的流式响应"""
+    rng = random.Random(0)
+    words = ["天气", "北京", "温度", "the", "weather", "is", "晴朗", "，", "。", "MCP", "工具", "调用", "结果", "\n"]
+    parts = [b": keep-alive\n\n"]
+    for _ in range(tokens // 4):
+        parts.append(_event({"reasoning_content": rng.choice(words)}))
+    for _ in range(tokens):
+        parts.append(_event({"content": rng.choice(words)}))
+    arguments = json.dumps({"city": "北京", "days": 3, "detail": "温度、湿度与风力" * 8}, ensure_ascii=False)
+    parts.append(_event({"tool_calls": [{"index": 0, "id": "call_0", "type": "function",
+                                         "function": {"name": "weather.get_weather_tool", "arguments": ""}}]}))
+    for i in range(0, len(arguments), 3):
+        parts.append(_event({"tool_calls": [{"index": 0, "function": {"arguments": arguments[i:i + 3]}}]}))
+    parts.append(_event(None, usage={"prompt_tokens": 1200, "completion_tokens": tokens, "total_tokens": tokens + 1200}))
+    parts.append(b"data: [DONE]\n\n")
+    return b"".join(parts)
+
+
+def reference_events(stream: bytes):
+    """参考结果：整段解码后按行解析"""
+    events = []
+    for line in stream.decode("utf-8").split("\n"):
+        if line.startswith("data:"):
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            events.append(json.loads(data))
+    return events
+
+
+def split_chunks(stream: bytes, mode: str, rng: random.Random):
+    if mode == "whole":
+        return [stream]
+    if mode == "1-byte":
+        return [stream[i:i + 1] for i in range(len(stream))]
+    chunks, pos = [], 0
+    while pos < len(stream):  # 随机大小，模拟 TCP 分段 (会截断行和多字节字符)
+        size = rng.randint(1, 512)
+        chunks.append(stream[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def legacy_decode(chunks):
+    """改造前的做法：每个数据块单独 decode 后按 \\n 切分"""
+    events, dropped = [], 0
+    for chunk in chunks:
+        try:
+            text = chunk.decode("utf-8")
+        except UnicodeDecodeError:
+            dropped += 1
+            continue
+        for line in text.split("\n"):
+            if line.startswith("data: ") and not line.startswith("data: [DONE]"):
+                try:
+                    events.append(json.loads(line[6:]))
+                except json.JSONDecodeError:
+                    dropped += 1
+    return events, dropped
+
+
+def decode(chunks, json_loads=None):
+    decoder = SSEDecoder(json_loads=json_loads)
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    events.extend(decoder.flush())
+    return events
+
+
+def bench(fn, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def accumulate_arguments(fragments, use_list: bool) -> str:
+    if use_list:
+        parts = []
+        for fragment in fragments:
+            parts.append(fragment)
+        return "".join(parts)
+    arguments = ""
+    for fragment in fragments:
+        arguments += fragment
+    return arguments
+
+
+def main():
+    paths = sys.argv[1:]
+    streams = [(os.path.basename(p), open(p, "rb").read()) for p in paths] or [("sample", build_sample_stream())]
+    rng = random.Random(42)
+    print(f"JSON 后端: {JSON_BACKEND}")
+
+    ok = True
+    for name, stream in streams:
+        expected = reference_events(stream)
+        print(f"\n== {name}: {len(stream) / 1024:.1f} KiB, {len(expected)} 个事件")
+        for mode in ("whole", "random", "1-byte"):
+            chunks = split_chunks(stream, mode, rng)
+            events = decode(chunks)
+            legacy_events, legacy_dropped = legacy_decode(chunks)
+            correct = events == expected
+            ok = ok and correct
+            print(f"  [{mode:>6}] {len(chunks):>7} 块  新解码器: {'正确' if correct else '错误'}"
+                  f"  旧做法: 丢失 {len(expected) - len(legacy_events)} 个事件 ({legacy_dropped} 处解析失败)")
+
+        chunks = split_chunks(stream, "random", rng)
+        repeat = 20
+        mib = len(stream) / (1024 * 1024)
+        for label, fn in (("新解码器 (" + JSON_BACKEND + ")", lambda: decode(chunks)),
+                          ("新解码器 (json)", lambda: decode(chunks, json.loads)),
+                          ("旧做法 (json)", lambda: legacy_decode(chunks))):
+            seconds = bench(fn, repeat)
+            print(f"  {label:<20} {seconds * 1000:8.2f} ms/次  {mib / seconds:8.1f} MiB/s  {len(expected) / seconds:10.0f} 事件/s")
+
+    fragments = ["{\"k\": \"" + "值" * 2 + "\"}, "] * 20000
+    for use_list in (False, True):
+        seconds = bench(lambda: accumulate_arguments(fragments, use_list), 20)
+        print(f"\n工具参数拼接 ({'列表 + join' if use_list else '字符串 +='}): {seconds * 1000:.2f} ms / {len(fragments)} 个片段", end="")
+    print()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 测试按 MCPWeb.py 的方式导入 utils.* (在 MCPClinet 目录下运行)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
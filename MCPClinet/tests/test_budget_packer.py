@@ -0,0 +1,49 @@
+from utils.budgetPacker import group_tool_exchanges, pack_to_budget
+
+
+def _messages():
+    return [
+        {"role": "user", "content": "u0", "tokens": 10, "value": 1},
+        {"role": "assistant", "content": None, "tool_calls": [{"id": "a"}, {"id": "b"}], "tokens": 10, "value": 5},
+        {"role": "tool", "tool_call_id": "a", "content": "ra", "tokens": 10, "value": 5},
+        {"role": "tool", "tool_call_id": "b", "content": "rb", "tokens": 10, "value": 5},
+        {"role": "assistant", "content": "answer", "tokens": 10, "value": 3},
+        {"role": "user", "content": "u1", "tokens": 10, "value": 1},
+    ]
+
+
+def _pack(messages, budget, pinned=()):
+    return pack_to_budget(messages, budget, lambda msg: msg["tokens"], lambda msg, i: msg["value"], set(pinned))
+
+
+def test_group_tool_exchanges():
+    assert group_tool_exchanges(_messages()) == [[0], [1, 2, 3], [4], [5]]
+
+
+def test_orphan_tool_result_is_its_own_unit():
+    messages = [{"role": "tool", "tool_call_id": "x", "content": "r"}, {"role": "user", "content": "u"}]
+    assert group_tool_exchanges(messages) == [[0], [1]]
+
+
+def test_pinned_units_are_always_kept():
+    kept = _pack(_messages(), budget=0, pinned=[5, 2])
+    assert kept == {1, 2, 3, 5}
+
+
+def test_tool_exchanges_are_kept_or_dropped_whole():
+    for budget in range(0, 70, 5):
+        kept = _pack(_messages(), budget, pinned=[5])
+        assert {1, 2, 3} <= kept or not kept & {1, 2, 3}
+
+
+def test_greedy_prefers_value_density_within_budget():
+    kept = _pack(_messages(), budget=30, pinned=[5])
+    assert kept == {4, 5, 0}  # 剩余 20: 回答 (3/10) 和用户问题 (1/10) 装得下，工具单元 (15/30) 装不下
+
+
+def test_best_single_unit_beats_low_value_greedy():
+    messages = [
+        {"role": "user", "content": "small", "tokens": 1, "value": 1},
+        {"role": "assistant", "content": "big", "tokens": 10, "value": 8},
+    ]
+    assert _pack(messages, budget=10) == {1}
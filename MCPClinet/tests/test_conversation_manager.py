@@ -0,0 +1,148 @@
+import asyncio
+import json
+import threading
+
+from utils.TokenAndConversation import ConversationManager, TokenCounter
+
+
+def _counter():
+    counter = TokenCounter(backend="estimate")
+    counter._encode = len  # 按字符计数，便于断言
+    counter._loaded = True
+    return counter
+
+
+def _manager():
+    return ConversationManager("http://localhost", "test-model", _counter())
+
+
+def _tool_call(call_id, name="filesystem.read_file"):
+    return {"id": call_id, "type": "function", "function": {"name": name, "arguments": json.dumps({"path": "a.txt"})}}
+
+
+def _assert_exchanges_complete(messages):
+    called = {call["id"] for msg in messages for call in msg.get("tool_calls") or []}
+    answered = {msg["tool_call_id"] for msg in messages if msg.get("role") == "tool"}
+    assert called == answered
+
+
+def test_count_message_tokens_includes_tool_calls():
+    counter = _counter()
+    plain = {"role": "assistant", "content": None}
+    with_calls = {"role": "assistant", "content": None, "tool_calls": [_tool_call("call_1")]}
+    assert counter.count_message_tokens(with_calls) > counter.count_message_tokens(plain) + 20
+
+
+def test_first_count_loads_tokenizer_in_background():
+    counter = TokenCounter(backend="estimate")
+    release = threading.Event()
+    loaded = TokenCounter._load
+
+    def slow_load():
+        release.wait(5)
+        loaded(counter)
+
+    counter._load = slow_load
+    threads = []
+    warm_up = counter.warm_up_in_background
+    counter.warm_up_in_background = lambda: threads.append(warm_up()) or threads[-1]
+    message = {"role": "user", "content": "问题"}
+    estimate = counter.count_message_tokens(message)  # 不等待分词器加载
+    assert counter._warming and not counter._loaded
+    assert counter.count_message_tokens(message) == estimate
+    release.set()
+    assert len(threads) == 1  # 预热只启动一次
+    threads[0].join(5)
+    assert counter._loaded and counter.generation == 1
+
+
+def test_cached_count_changes_with_tool_calls():
+    counter = _counter()
+    message = {"role": "assistant", "content": None}
+    before = counter.count_message_tokens_cached(message)
+    message["tool_calls"] = [_tool_call("call_1")]
+    assert counter.count_message_tokens_cached(message) > before
+
+
+def test_preserve_critical_context_keeps_whole_tool_exchanges():
+    manager = _manager()
+    for turn in range(3):
+        manager.add_message({"role": "user", "content": f"问题 {turn}"}, is_key_message=True)
+        manager.add_message({"role": "assistant", "content": None,
+                             "tool_calls": [_tool_call(f"call_{turn}_a"), _tool_call(f"call_{turn}_b")]},
+                            is_key_message=True)
+        manager.add_message({"role": "tool", "tool_call_id": f"call_{turn}_a", "content": "结果 A"})
+        manager.add_message({"role": "tool", "tool_call_id": f"call_{turn}_b", "content": "结果 B"})
+    manager.add_message({"role": "assistant", "content": None, "tool_calls": [_tool_call("call_last")]})
+    manager.add_message({"role": "tool", "tool_call_id": "call_last", "content": "最新结果"})
+
+    manager._preserve_critical_context()
+
+    messages = manager.messages
+    _assert_exchanges_complete(messages)
+    assert messages[-1]["content"] == "最新结果"
+    assert any(msg.get("content") == "问题 2" for msg in messages)
+
+
+def test_summary_segment_does_not_split_tool_exchanges():
+    manager = _manager()
+    manager.add_message({"role": "user", "content": "问题"})
+    manager.add_message({"role": "assistant", "content": "回答"})
+    manager.add_message({"role": "user", "content": "读取文件"})
+    manager.add_message({"role": "assistant", "content": None,
+                         "tool_calls": [_tool_call(f"call_{i}") for i in range(5)]})
+    for i in range(5):
+        manager.add_message({"role": "tool", "tool_call_id": f"call_{i}", "content": f"结果 {i}"})
+    manager.add_message({"role": "assistant", "content": "文件内容"})
+    manager.add_message({"role": "user", "content": "下一个问题"})
+
+    segment = manager._select_summary_segment()
+    rest = manager.messages[len(segment):]
+    _assert_exchanges_complete(segment)
+    _assert_exchanges_complete(rest)
+    assert [msg["content"] for msg in segment] == ["问题", "回答", "读取文件"]
+
+
+def test_failed_summary_keeps_history_and_previous_summary():
+    manager = _manager()
+    for i in range(8):
+        manager.add_message({"role": "user" if i % 2 == 0 else "assistant", "content": f"消息 {i}"})
+    previous = {"role": "system", "content": "之前的摘要"}
+    manager.system_summary = previous
+
+    async def failed_summary(messages, last_question=None):
+        return None
+
+    manager._generate_focused_summary = failed_summary
+    asyncio.run(manager._summarize_segment(manager._select_summary_segment()))
+    assert len(manager.messages) == 8
+    assert manager.system_summary is previous
+
+
+def test_summary_segment_excludes_current_turn():
+    manager = _manager()
+    for i in range(2):
+        manager.add_message({"role": "user", "content": f"问题 {i}"})
+        manager.add_message({"role": "assistant", "content": f"回答 {i}"})
+    manager.add_message({"role": "user", "content": "当前问题"})
+    for i in range(3):
+        manager.add_message({"role": "assistant", "content": None, "tool_calls": [_tool_call(f"call_{i}")]})
+        manager.add_message({"role": "tool", "tool_call_id": f"call_{i}", "content": f"结果 {i}"})
+
+    segment = manager._select_summary_segment()
+    assert [msg["content"] for msg in segment] == ["问题 0", "回答 0", "问题 1", "回答 1"]
+
+
+def test_rollback_cancels_background_summary():
+    manager = _manager()
+
+    async def run():
+        checkpoint = manager.checkpoint()
+        manager.add_message({"role": "user", "content": "问题"})
+        manager._summary_task = asyncio.create_task(asyncio.sleep(10))
+        task = manager._summary_task
+        manager.rollback_turn(checkpoint)
+        await asyncio.sleep(0)
+        return task
+
+    assert asyncio.run(run()).cancelled()
@@ -0,0 +1,88 @@
+import asyncio
+import sqlite3
+import time
+
+from utils.conversationStore import ConversationStore, replay_events
+from utils.TokenAndConversation import ConversationManager, TokenCounter
+
+
+def _message(msg_id, content, role="user"):
+    return {"msg_id": msg_id, "role": role, "content": content, "token_count": 3}
+
+
+def _event_count(path, session_id):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM events WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+
+def test_replay_events_applies_changes_in_order():
+    state = replay_events([
+        ("append", {"message": _message(0, "a")}),
+        ("append", {"message": _message(1, "b")}),
+        ("replace", {"msg_id": 0, "content": "a2"}),
+        ("remove", {"msg_ids": [1]}),
+        ("summary", {"summary": {"role": "system", "content": "摘要"}}),
+    ])
+    assert [msg["content"] for msg in state["messages"]] == ["a2"]
+    assert state["system_summary"]["content"] == "摘要"
+
+
+def test_load_flushes_pending_events_and_drops_transient_fields(tmp_path):
+    store = ConversationStore(str(tmp_path / "c.db"))
+    store.append("s1", "append", {"message": _message(0, "你好")})
+    state = store.load("s1")
+    assert state["messages"] == [{"msg_id": 0, "role": "user", "content": "你好"}]
+    assert store.load("missing") is None
+
+
+def test_clear_deletes_earlier_events(tmp_path):
+    path = str(tmp_path / "c.db")
+    store = ConversationStore(path)
+    store.append("s1", "append", {"message": _message(0, "a")})
+    store._flush()
+    store.append("s1", "append", {"message": _message(1, "b")})
+    store.append("s1", "clear", {})
+    store.append("s1", "append", {"message": _message(2, "c")})
+    store.append("s2", "append", {"message": _message(0, "other")})
+    store._flush()
+    assert _event_count(path, "s1") == 1
+    assert [msg["content"] for msg in store.load("s1")["messages"]] == ["c"]
+    assert _event_count(path, "s2") == 1
+
+
+def test_purge_expired_removes_abandoned_sessions(tmp_path):
+    path = str(tmp_path / "c.db")
+    store = ConversationStore(path, retention=60)
+    store.append("old", "append", {"message": _message(0, "a")})
+    store.append("new", "append", {"message": _message(0, "b")})
+    store._flush()
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE events SET created_at = ? WHERE session_id = 'old'", (time.time() - 3600,))
+    assert store.purge_expired() == 1
+    assert store.load("old") is None
+    assert store.load("new") is not None
+
+
+def test_snapshot_compacts_long_logs(tmp_path):
+    path = str(tmp_path / "c.db")
+    store = ConversationStore(path, snapshot_min_events=10)
+    for i in range(20):
+        store.append("s1", "append", {"message": _message(i, str(i))})
+        store.append("s1", "remove", {"msg_ids": [i]})
+    store.append("s1", "append", {"message": _message(99, "last")})
+    assert [msg["content"] for msg in store.load("s1")["messages"]] == ["last"]
+    assert _event_count(path, "s1") == 1
+    assert [msg["content"] for msg in store.load("s1")["messages"]] == ["last"]
+
+
+def test_rehydrate_restores_history(tmp_path):
+    store = ConversationStore(str(tmp_path / "c.db"))
+    counter = TokenCounter(backend="estimate")
+    first = ConversationManager("http://localhost", "m", counter, session_id="s1", store=store)
+    first.add_message({"role": "user", "content": "你好"})
+    first.add_message({"role": "assistant", "content": "你好，有什么可以帮你？"})
+
+    restored = ConversationManager("http://localhost", "m", counter, session_id="s1", store=store)
+    assert asyncio.run(restored.rehydrate())
+    assert [msg["content"] for msg in restored.messages] == ["你好", "你好，有什么可以帮你？"]
+    assert restored.checkpoint() == first.checkpoint()
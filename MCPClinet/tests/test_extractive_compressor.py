@@ -0,0 +1,62 @@
+import json
+from collections import Counter
+
+from utils.extractiveCompressor import (compress_content, extract_key_sentences, find_redundant, split_sentences,
+                                        trim_json)
+from utils.textUtils import tokenize
+
+
+def _terms(*texts):
+    return Counter(term for text in texts for term in tokenize(text))
+
+
+def test_split_sentences_keeps_decimals_and_urls():
+    sentences = split_sentences("版本 3.12 已发布。详见 https://example.com/a.b 页面！Next step. Done")
+    assert sentences == ["版本 3.12 已发布。", "详见 https://example.com/a.b 页面！", "Next step. ", "Done"]
+
+
+def test_find_redundant_system_prompts_and_tool_results():
+    long_result = "x" * 300
+    messages = [
+        {"role": "system", "content": "固定提示"},
+        {"role": "system", "content": "推荐的工作流程"},
+        {"role": "tool", "tool_call_id": "a", "content": long_result},
+        {"role": "system", "content": "推荐的工作流程"},
+        {"role": "tool", "tool_call_id": "b", "content": long_result},
+    ]
+    removable, replacements = find_redundant(messages, pinned=set(), prefix_contents=["固定提示"])
+    assert removable == [0, 1]
+    assert list(replacements) == [2]
+    assert "tool_call_id=b" in replacements[2]
+
+
+def test_find_redundant_skips_pinned_messages():
+    messages = [{"role": "system", "content": "提示"}, {"role": "system", "content": "提示"}]
+    assert find_redundant(messages, pinned={0}, prefix_contents=[]) == ([], {})
+
+
+def test_trim_json_keeps_referenced_fields():
+    data = {"city": "北京", "forecast": {"temp": 25, "humidity": 40}, "raw": "y" * 200}
+    trimmed = trim_json(data, _terms("北京的 temp 是多少"))
+    assert trimmed == {"city": "北京", "forecast": {"temp": 25}}
+
+
+def test_extract_key_sentences_keeps_markers_and_order():
+    text = "".join(f"第{i}句讲的是天气预报和气温变化。" for i in range(10)) + "完整内容见 ref=abc123。"
+    extracted = extract_key_sentences(text, ratio=0.3)
+    assert "ref=abc123" in extracted
+    assert len(extracted) < len(text)
+    positions = [text.index(sentence) for sentence in split_sentences(extracted)]
+    assert positions == sorted(positions)
+
+
+def test_compress_content_json_tool_result():
+    data = {"items": [{"name": f"item{i}", "detail": "d" * 100} for i in range(30)], "total": 30}
+    message = {"role": "tool", "content": json.dumps(data)}
+    compressed = compress_content(message, _terms("total 是多少"), min_chars=100)
+    assert compressed.startswith('{"total": 30}')
+
+
+def test_compress_content_skips_short_and_system_messages():
+    assert compress_content({"role": "user", "content": "短消息"}, Counter(), min_chars=100) is None
+    assert compress_content({"role": "system", "content": "长" * 2000}, Counter(), min_chars=100) is None
@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+from utils.handleStream import JsonObjectTracker, parse_stream_response_websocket
+
+
+class _WebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(json.loads(data))
+
+
+def _tool_delta(index, arguments, call_id=None, name=None):
+    call = {"index": index, "function": {"arguments": arguments}}
+    if call_id:
+        call["id"] = call_id
+        call["function"]["name"] = name
+    return {"choices": [{"delta": {"tool_calls": [call]}}]}
+
+
+def _stream(events):
+    async def iterate():
+        for event in events:
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+    return iterate()
+
+
+def _parse(events, can_dispatch_early=None):
+    dispatched = []
+
+    async def run():
+        result = await parse_stream_response_websocket(_WebSocket(), _stream(events), on_tool_call_ready=dispatched.append,
+                                                       can_dispatch_early=can_dispatch_early)
+        return result, list(dispatched)
+
+    return asyncio.run(run())
+
+
+def test_tracker_ignores_braces_inside_strings():
+    tracker = JsonObjectTracker()
+    assert not tracker.feed('{"pattern": "a}b{", ')
+    assert not tracker.feed('"quote": "\\"}"')
+    assert tracker.feed("}")
+
+
+def test_tracker_closes_only_at_top_level():
+    tracker = JsonObjectTracker()
+    assert not tracker.feed('{"items": [1, {"a": 2}]')
+    assert tracker.feed(", \"b\": 3}")
+
+
+def test_dispatches_once_when_arguments_close():
+    events = [
+        _tool_delta(0, '{"path": ', "call_1", "file-system.read_file"),
+        _tool_delta(0, '"a}.txt"'),
+        _tool_delta(0, "}"),
+        {"choices": [{"delta": {"content": "读取中"}}]},
+    ]
+    (_, tool_calls, _), dispatched = _parse(events)
+    assert dispatched == [{"tool_call_id": "call_1", "tool_name": "file-system.read_file", "tool_args": {"path": "a}.txt"}}]
+    assert tool_calls[0]["tool_args"] == {"path": "a}.txt"}
+
+
+def test_next_index_dispatches_previous_call():
+    events = [
+        _tool_delta(0, "", "call_1", "weather.get_weather"),
+        _tool_delta(1, '{"city": "北京"', "call_2", "weather.get_weather"),
+    ]
+    (_, tool_calls, _), dispatched = _parse(events)
+    assert [call["tool_call_id"] for call in dispatched] == ["call_1"]
+    assert dispatched[0]["tool_args"] == {}
+    assert len(tool_calls) == 2
+
+
+def test_tools_that_cannot_dispatch_early_are_skipped():
+    events = [
+        _tool_delta(0, '{"command": "ls"}', "call_1", "execute-command.execute_command_tool"),
+        _tool_delta(1, '{"path": "a.txt"}', "call_2", "file-system.read_file"),
+    ]
+    checked = []
+
+    def can_dispatch_early(name):
+        checked.append(name)
+        return name == "file-system.read_file"
+
+    (_, tool_calls, _), dispatched = _parse(events, can_dispatch_early)
+    assert [call["tool_call_id"] for call in dispatched] == ["call_2"]
+    assert checked == ["execute-command.execute_command_tool", "file-system.read_file"]
+    assert tool_calls[0]["tool_args"] == {"command": "ls"}
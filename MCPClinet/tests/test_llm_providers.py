@@ -0,0 +1,39 @@
+from utils.llmProviders import LLMProvider, ProviderPool, is_content_event, is_retryable_status
+
+
+def _provider(name, context_window=16000):
+    return LLMProvider(name, "model", f"https://{name}.example/v1/chat/completions", "key", context_window)
+
+
+def test_retryable_status_codes():
+    assert is_retryable_status(429)
+    assert is_retryable_status(408)
+    assert is_retryable_status(503)
+    assert not is_retryable_status(400)
+    assert not is_retryable_status(401)
+    assert not is_retryable_status(413)
+
+
+def test_content_event_ignores_role_only_deltas():
+    assert not is_content_event({"choices": [{"delta": {"role": "assistant", "content": ""}}]})
+    assert not is_content_event({"choices": [], "usage": {"prompt_tokens": 3}})
+    assert is_content_event({"choices": [{"delta": {"content": "你"}}]})
+    assert is_content_event({"choices": [{"delta": {"reasoning_content": "思考"}}]})
+    assert is_content_event({"choices": [{"delta": {"tool_calls": [{"index": 0, "id": "call_1"}]}}]})
+
+
+def test_pool_ranks_by_ttft_and_errors():
+    fast, slow = _provider("fast"), _provider("slow")
+    fast.record_success(0.5)
+    slow.record_success(2.0)
+    pool = ProviderPool([slow, fast])
+    assert [p.name for p in pool.ranked()] == ["fast", "slow"]
+    for _ in range(3):
+        fast.record_failure()
+    assert fast.in_cooldown
+    assert [p.name for p in pool.ranked()] == ["slow", "fast"]
+
+
+
+def test_pool_context_window_is_smallest():
+    assert ProviderPool([_provider("a", 32000), _provider("b", 16000)]).context_window == 16000
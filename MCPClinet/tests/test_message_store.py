@@ -0,0 +1,53 @@
+from utils.messageStore import MessageStore
+
+
+def _store():
+    store = MessageStore()
+    for role, content in [("system", "提示"), ("user", "问题"), ("assistant", "回答"), ("user", " 问题 ")]:
+        store.append({"role": role, "content": content})
+    return store
+
+
+def test_append_assigns_stable_ids():
+    store = _store()
+    assert [msg["msg_id"] for msg in store] == [0, 1, 2, 3]
+    store.remove(1)
+    store.append({"role": "user", "content": "新问题"})
+    assert [msg["msg_id"] for msg in store] == [0, 2, 3, 4]
+
+
+def test_role_and_content_indexes_follow_removals():
+    store = _store()
+    assert sorted(store.find_by_content("问题")) == [1, 3]
+    assert store.last("user")["msg_id"] == 3
+    store.remove(3)
+    assert store.last("user")["msg_id"] == 1
+    assert store.find_by_content("问题") == [1]
+    assert [msg["msg_id"] for msg in store.reversed_by_role("user")] == [1]
+
+
+def test_update_content_tracks_size_and_index():
+    store = _store()
+    before = store.content_bytes
+    store.update_content(2, "更长的回答内容")
+    assert store.content_bytes == before + len("更长的回答内容".encode("utf-8")) - len("回答".encode("utf-8"))
+    assert store.find_by_content("更长的回答内容") == [2]
+    assert store.find_by_content("回答") == []
+
+
+def test_key_ids_and_ids_since():
+    store = _store()
+    assert store.mark_key(1)
+    assert not store.mark_key(1)
+    assert store.key_ids == {1}
+    assert store.ids_since(2) == [2, 3]
+    store.remove(1)
+    assert store.key_ids == set()
+
+
+def test_as_list_cache_is_invalidated():
+    store = _store()
+    first = store.as_list()
+    assert store.as_list() is first
+    store.append({"role": "user", "content": "x"})
+    assert len(store.as_list()) == 5
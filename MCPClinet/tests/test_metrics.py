@@ -0,0 +1,49 @@
+from utils.metrics import Gauge, Histogram, MetricsRegistry
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency_seconds", "耗时", ("provider",), buckets=(0.1, 1, 5))
+    for value in (0.05, 0.5, 0.5, 3, 10):
+        histogram.observe(value, provider="a")
+    lines = histogram.render()
+    assert lines[:2] == ["# HELP latency_seconds 耗时", "# TYPE latency_seconds histogram"]
+    assert lines[2:] == [
+        'latency_seconds_bucket{provider="a",le="0.1"} 1',
+        'latency_seconds_bucket{provider="a",le="1"} 3',
+        'latency_seconds_bucket{provider="a",le="5"} 4',
+        'latency_seconds_bucket{provider="a",le="+Inf"} 5',
+        'latency_seconds_sum{provider="a"} 14.05',
+        'latency_seconds_count{provider="a"} 5',
+    ]
+
+
+def test_histogram_time_records_on_exception():
+    histogram = Histogram("op_seconds", "耗时")
+    try:
+        with histogram.time():
+            raise ValueError()
+    except ValueError:
+        pass
+    assert histogram.render()[-1] == "op_seconds_count 1"
+
+
+def test_label_values_are_escaped():
+    histogram = Histogram("calls_seconds", "耗时", ("tool",), buckets=(1,))
+    histogram.observe(0.5, tool='a\\b"c\nd')
+    assert 'calls_seconds_count{tool="a\\\\b\\"c\\nd"} 1' in histogram.render()
+
+
+def test_registry_renders_gauges():
+    registry = MetricsRegistry()
+    registry.gauge("queue_size", "队列长度", lambda: 3)
+    registry.gauge("server_up", "服务器状态", lambda: {"srv": 1, ("other",): 0}, labelnames=("server",))
+    registry.gauge("broken", "回调出错", lambda: 1 / 0)
+    assert registry.render() == (
+        "# HELP queue_size 队列长度\n# TYPE queue_size gauge\nqueue_size 3.0\n"
+        "# HELP server_up 服务器状态\n# TYPE server_up gauge\n"
+        'server_up{server="srv"} 1.0\nserver_up{server="other"} 0.0\n'
+    )
+
+
+def test_gauge_metric_type():
+    assert Gauge("total", "总数", lambda: 1, metric_type="counter").render()[1] == "# TYPE total counter"
@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+
+from utils.serverBulkhead import BulkheadRejected, ServerBulkhead
+
+
+def test_from_config_overrides_defaults():
+    bulkhead = ServerBulkhead.from_config("fetch", {"max_concurrency": 2}, max_concurrency=4, max_queue=8, timeout=10)
+    assert (bulkhead.max_concurrency, bulkhead.max_queue, bulkhead.timeout) == (2, 8, 10)
+
+
+def test_concurrency_limit_and_queue_rejection():
+    bulkhead = ServerBulkhead("s", max_concurrency=1, max_queue=1)
+
+    async def run():
+        release = asyncio.Event()
+        peak = 0
+
+        async def call():
+            nonlocal peak
+            async with bulkhead.slot():
+                peak = max(peak, bulkhead.in_flight)
+                await release.wait()
+
+        first = asyncio.create_task(call())
+        second = asyncio.create_task(call())
+        await asyncio.sleep(0)
+        assert (bulkhead.in_flight, bulkhead.waiting) == (1, 1)
+        with pytest.raises(BulkheadRejected):
+            async with bulkhead.slot():
+                pass
+        release.set()
+        await asyncio.gather(first, second)
+        return peak
+
+    assert asyncio.run(run()) == 1
+    assert bulkhead.rejected == 1
+    assert (bulkhead.in_flight, bulkhead.waiting) == (0, 0)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    bulkhead = ServerBulkhead("s", failure_threshold=2, cooldown=60)
+    bulkhead.record_failure()
+    bulkhead.record_success()
+    bulkhead.record_failure()
+    assert bulkhead.state == "closed"
+    bulkhead.record_failure()
+    assert bulkhead.state == "open"
+
+    async def call():
+        async with bulkhead.slot():
+            pass
+
+    with pytest.raises(BulkheadRejected):
+        asyncio.run(call())
+
+
+def test_half_open_allows_a_single_probe():
+    bulkhead = ServerBulkhead("s", failure_threshold=1, cooldown=0)
+    bulkhead.record_failure()
+
+    async def run():
+        probe_started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def probe():
+            async with bulkhead.slot():
+                probe_started.set()
+                await release.wait()
+            bulkhead.record_success()
+
+        task = asyncio.create_task(probe())
+        await probe_started.wait()
+        assert bulkhead.state == "half_open"
+        with pytest.raises(BulkheadRejected):
+            async with bulkhead.slot():
+                pass
+        release.set()
+        await task
+
+    asyncio.run(run())
+    assert bulkhead.state == "closed"
+
+
+def test_failed_probe_reopens_breaker():
+    bulkhead = ServerBulkhead("s", failure_threshold=3, cooldown=0)
+    for _ in range(3):
+        bulkhead.record_failure()
+
+    async def probe():
+        async with bulkhead.slot():
+            pass
+        bulkhead.record_failure()
+
+    asyncio.run(probe())
+    assert bulkhead.state == "open"
+
+
+def test_queue_timeout_is_rejected_without_failure():
+    bulkhead = ServerBulkhead("s", max_concurrency=1, failure_threshold=1)
+
+    async def run():
+        release = asyncio.Event()
+
+        async def hold():
+            async with bulkhead.slot():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(BulkheadRejected):
+            async with bulkhead.slot(timeout=0.01):
+                pass
+        release.set()
+        await holder
+
+    asyncio.run(run())
+    assert bulkhead.rejected == 1
+    assert bulkhead.state == "closed" and bulkhead.failures == 0
+    assert (bulkhead.in_flight, bulkhead.waiting) == (0, 0)
+
+
+def test_call_waiting_in_queue_does_not_count_as_server_failure():
+    from MCPWeb import MCPClient
+
+    client = MCPClient.__new__(MCPClient)
+    client.server_wake_events = {"s": asyncio.Event()}
+    bulkhead = ServerBulkhead("s", max_concurrency=1, timeout=0.05, failure_threshold=1)
+
+    class Session:
+        async def call_tool(self, tool_name, args):
+            return "ok"
+
+    async def run():
+        release = asyncio.Event()
+
+        async def hold():
+            async with bulkhead.slot():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        result = await client.call_tool_with_timeout(Session(), "read_file", {}, bulkhead=bulkhead)
+        release.set()
+        await holder
+        return result
+
+    result = asyncio.run(run())
+    assert "暂不可用" in result.content[0].text
+    assert bulkhead.state == "closed" and bulkhead.failures == 0
+    assert not client.server_wake_events["s"].is_set()
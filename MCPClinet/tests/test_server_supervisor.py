@@ -0,0 +1,251 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import MCPWeb
+from utils.serverBulkhead import ServerBulkhead
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(MCPWeb, "CONVERSATION_STORE_FILE", None)
+    monkeypatch.setattr(MCPWeb, "TOOL_SCHEMA_CACHE_FILE", str(tmp_path / "tool_schemas.json"))
+    monkeypatch.setattr(MCPWeb, "SERVER_RESTART_BACKOFF", 0)
+    monkeypatch.setattr(MCPWeb, "SERVER_RESTART_MAX_ATTEMPTS", 3)
+    client = MCPWeb.MCPClient()
+    client.server_configs = {"srv": ("stdio", {"command": "srv", "lifecycle": "on_demand", "handshake_timeout": 5})}
+    client.tool_bulkheads = {"srv": ServerBulkhead("srv")}
+    return client
+
+
+class _Session:
+    """只实现监督任务用到的方法的 MCP 会话，ping_delay 为 None 时 ping 正常返回"""
+    instances = []
+
+    def __init__(self, read, write, message_handler=None):
+        self.ping_delay = None
+        self.closed = False
+        _Session.instances.append(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+
+    async def initialize(self):
+        pass
+
+    async def send_ping(self):
+        if self.ping_delay is not None:
+            await asyncio.sleep(self.ping_delay)
+
+    async def list_tools(self):
+        return SimpleNamespace(tools=[])
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    @asynccontextmanager
+    async def stdio_client(server_params):
+        yield None, None
+
+    _Session.instances = []
+    monkeypatch.setattr(MCPWeb, "stdio_client", stdio_client)
+    monkeypatch.setattr(MCPWeb, "ClientSession", _Session)
+    monkeypatch.setattr(MCPWeb, "SERVER_PING_INTERVAL", 0.01)
+    monkeypatch.setattr(MCPWeb, "SERVER_PING_TIMEOUT", 0.05)
+    return _Session
+
+
+def _supervise(client, server_name="srv"):
+    """启动服务器的监督任务，返回首次连接结果的 future"""
+    return client._start_server(server_name)
+
+
+async def _stop(client, server_name="srv"):
+    client.server_stop_events[server_name].set()
+    client.server_wake_events[server_name].set()
+    await client.server_tasks[server_name]
+
+
+def _failing_connect(client, attempts):
+    async def run_server_once(server_name, transport, server_config, ready, stop_event, wake_event):
+        attempts.append(time.monotonic())
+        client.server_status[server_name] = "failed"
+        return None
+    return run_server_once
+
+
+def test_ensure_server_returns_as_soon_as_first_connect_fails(client):
+    attempts = []
+
+    async def run_server_once(server_name, transport, server_config, ready, stop_event, wake_event):
+        attempts.append(time.monotonic())
+        client.server_status[server_name] = "failed"
+        await asyncio.sleep(3600 if len(attempts) > 1 else 0) # 之后的重试一直挂起
+        return None
+
+    client._run_server_once = run_server_once
+
+    async def run():
+        start = time.monotonic()
+        available = await client._ensure_server("srv")
+        elapsed = time.monotonic() - start
+        client.server_tasks["srv"].cancel()
+        await asyncio.gather(client.server_tasks["srv"], return_exceptions=True)
+        return available, elapsed
+
+    available, elapsed = asyncio.run(run())
+    assert available is False
+    assert elapsed < 1
+
+
+def test_server_that_gave_up_is_no_longer_available(client):
+    attempts = []
+    client._run_server_once = _failing_connect(client, attempts)
+
+    async def run():
+        assert client._is_server_available("srv")
+        assert await client._ensure_server("srv") is False
+        await client.server_tasks["srv"]
+        return await client._ensure_server("srv")
+
+    assert asyncio.run(run()) is False
+    assert len(attempts) == MCPWeb.SERVER_RESTART_MAX_ATTEMPTS
+    assert client.server_status["srv"] == "gave_up"
+    assert not client._is_server_available("srv")
+
+
+def test_restart_backoff_grows_exponentially(client, monkeypatch):
+    monkeypatch.setattr(MCPWeb, "SERVER_RESTART_BACKOFF", 0.02)
+    monkeypatch.setattr(MCPWeb, "SERVER_RESTART_BACKOFF_MAX", 0.04)
+    monkeypatch.setattr(MCPWeb, "SERVER_RESTART_MAX_ATTEMPTS", 4)
+    attempts = []
+    client._run_server_once = _failing_connect(client, attempts)
+
+    async def run():
+        ready = _supervise(client)
+        assert await ready is False
+        await client.server_tasks["srv"]
+
+    asyncio.run(run())
+    gaps = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+    assert len(attempts) == 4 and client.server_restarts["srv"] == 3
+    for gap, expected in zip(gaps, [0.02, 0.04, 0.04]):
+        assert gap >= expected * 0.9
+
+
+def test_stable_connection_resets_failure_counter(client):
+    uptimes = [None, None, MCPWeb.SERVER_STABLE_SECONDS, None, None, None]
+    calls = []
+
+    async def run_server_once(server_name, transport, server_config, ready, stop_event, wake_event):
+        calls.append(server_name)
+        return uptimes[len(calls) - 1]
+
+    client._run_server_once = run_server_once
+
+    async def run():
+        _supervise(client)
+        await client.server_tasks["srv"]
+
+    asyncio.run(run())
+    assert len(calls) == 6 # 稳定运行一段时间后重新计数，之后再连续失败 3 次才放弃
+    assert client.server_status["srv"] == "gave_up"
+
+
+def test_ping_timeout_tears_down_the_session(client, transport):
+    client.server_configs["srv"] = ("stdio", {"command": "srv"})
+
+    async def run():
+        ready = asyncio.get_running_loop().create_future()
+        stop_event, wake_event = asyncio.Event(), asyncio.Event()
+
+        async def hang_pings():
+            while not ready.done():
+                await asyncio.sleep(0)
+            assert "srv" in client.sessions
+            transport.instances[0].ping_delay = 3600
+
+        hang = asyncio.create_task(hang_pings())
+        uptime = await client._run_server_once("srv", "stdio", {"command": "srv"}, ready, stop_event, wake_event)
+        await hang
+        return ready.result(), uptime
+
+    connected, uptime = asyncio.run(run())
+    assert connected is True and uptime is not None
+    assert client.server_status["srv"] == "unhealthy"
+    assert "srv" not in client.sessions and "srv" not in client.connected_servers
+    assert transport.instances[0].closed
+
+
+def test_restart_replaces_the_session(client, transport, monkeypatch):
+    client.server_configs["srv"] = ("stdio", {"command": "srv"})
+
+    async def run():
+        ready = _supervise(client)
+        assert await ready is True
+        first = client.sessions["srv"]
+        first.ping_delay = 3600 # ping 超时后重启
+        while len(transport.instances) < 2 or client.server_status.get("srv") != "ready":
+            await asyncio.sleep(0.01)
+        second = client.sessions["srv"]
+        await _stop(client)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first is not second and first.closed
+    assert client.server_restarts["srv"] == 1
+    assert client.server_status["srv"] == "stopped"
+    assert "srv" not in client.sessions
+
+
+def test_idle_on_demand_server_is_reaped_without_restart(client, transport):
+    client.server_configs["srv"] = ("stdio", {"command": "srv", "lifecycle": "on_demand", "idle_timeout": 0})
+
+    async def run():
+        assert await _supervise(client) is True
+        await client.server_tasks["srv"]
+
+    asyncio.run(run())
+    assert client.server_status["srv"] == "idle"
+    assert not client.server_restarts.get("srv")
+    assert "srv" not in client.sessions
+    assert client._is_server_available("srv")
+
+
+def test_is_server_idle(client):
+    client.server_configs["srv"] = ("stdio", {"command": "srv", "lifecycle": "on_demand", "idle_timeout": 60})
+    client.server_last_used["srv"] = time.monotonic() - 120
+    assert client._is_server_idle("srv")
+    client.tool_bulkheads["srv"].in_flight = 1 # 有进行中的调用时不回收
+    assert not client._is_server_idle("srv")
+    client.tool_bulkheads["srv"].in_flight = 0
+    client.server_last_used["srv"] = time.monotonic()
+    assert not client._is_server_idle("srv")
+    client.server_configs["srv"] = ("stdio", {"command": "srv", "idle_timeout": 0})
+    assert not client._is_server_idle("srv") # 常驻服务器从不回收
+
+
+def test_connect_to_servers_defers_on_demand_servers_with_cached_tools(client, transport, monkeypatch):
+    config = {"command": "srv", "lifecycle": "on_demand"}
+    client.server_configs = {"srv": ("stdio", config), "new": ("stdio", {"command": "new", "lifecycle": "on_demand"})}
+    monkeypatch.setattr(client, "_iter_server_configs",
+                        lambda: ((name, transport_type, cfg) for name, (transport_type, cfg) in client.server_configs.items()))
+    cached = [{"type": "function", "function": {"name": "srv.read", "description": "", "parameters": {}}}]
+
+    async def run():
+        await client.tool_schema_cache.put("srv", MCPWeb.server_fingerprint(config), cached)
+        await client.connect_to_servers()
+        started = set(client.server_tasks)
+        await _stop(client, "new")
+        return started
+
+    started = asyncio.run(run())
+    assert started == {"new"} # 没有缓存的服务器启动一次以获取工具定义
+    assert client.server_status["srv"] == "idle"
+    assert client.tool_catalog.get_tools(["srv"]) == cached
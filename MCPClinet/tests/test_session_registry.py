@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+from utils.messageStore import MessageStore
+from utils.sessionRegistry import SessionRegistry
+
+
+class _Conversation:
+    """只包含会话注册表用到的字段的对话管理器"""
+    def __init__(self, session_id=None):
+        self.session_id = session_id
+        self.history = MessageStore()
+        self.system_summary = None
+        self.tool_context = None
+
+    @property
+    def messages(self):
+        return self.history.as_list()
+
+    def add_message(self, message):
+        self.history.append(message)
+
+    def cancel_background_summary(self):
+        pass
+
+
+def test_acquire_reuses_session_by_id():
+    registry = SessionRegistry(_Conversation)
+    first = registry.acquire("s1")
+    second = registry.acquire("s1")
+    assert first is second
+    assert first.connections == 2
+    assert registry.acquire().session_id != "s1"
+    assert len(registry) == 2
+
+
+def test_sessions_have_independent_history():
+    registry = SessionRegistry(_Conversation)
+    a, b = registry.acquire("a"), registry.acquire("b")
+    a.conversation_manager.add_message({"role": "user", "content": "只属于 a"})
+    assert len(b.conversation_manager.messages) == 0
+
+
+def test_idle_sessions_expire_after_ttl():
+    registry = SessionRegistry(_Conversation, idle_ttl=60)
+    session = registry.acquire("s1")
+    registry.release(session)
+    assert registry.get("s1") is session
+    session.last_active = time.monotonic() - 120
+    registry.evict_idle()
+    assert registry.get("s1") is None
+
+
+def test_connected_sessions_are_never_evicted():
+    registry = SessionRegistry(_Conversation, max_sessions=1, idle_ttl=0)
+    registry.acquire("s1")
+    registry.acquire("s2")
+    assert registry.get("s1") is not None and registry.get("s2") is not None
+
+
+def test_lru_eviction_over_memory_budget():
+    registry = SessionRegistry(_Conversation, max_total_bytes=100)
+    old = registry.acquire("old")
+    old.conversation_manager.add_message({"role": "user", "content": "x" * 80})
+    registry.release(old)
+    new = registry.acquire("new")
+    new.conversation_manager.add_message({"role": "user", "content": "y" * 80})
+    registry.release(new)
+    assert registry.get("old") is None
+    assert registry.get("new") is new
+
+
+def test_session_with_running_turn_is_not_idle():
+    registry = SessionRegistry(_Conversation)
+    session = registry.acquire("s1")
+    registry.release(session)
+
+    async def run():
+        async with session.turn_lock:
+            return session.is_idle
+
+    assert asyncio.run(run()) is False
+    assert session.is_idle
+
+
+def test_size_counts_utf8_bytes_tool_calls_and_summary():
+    registry = SessionRegistry(_Conversation)
+    session = registry.acquire("s1")
+    conversation = session.conversation_manager
+    conversation.add_message({"role": "user", "content": "中文"})
+    assert session.estimate_size() == 6
+    conversation.add_message({"role": "assistant", "content": None,
+                              "tool_calls": [{"function": {"name": "srv.read", "arguments": "{}"}}]})
+    assert session.estimate_size() > 6 + len("srv.read")
+    before = session.estimate_size()
+    conversation.system_summary = {"role": "system", "content": "摘要"}
+    assert session.estimate_size() > before + 6
+
+
+def test_periodic_sweep_expires_idle_sessions():
+    registry = SessionRegistry(_Conversation, idle_ttl=60, sweep_interval=0.01)
+    session = registry.acquire("s1")
+    registry.release(session)
+    session.last_active = time.monotonic() - 120
+
+    async def run():
+        registry.start()
+        await asyncio.sleep(0.05)
+        await registry.close()
+
+    asyncio.run(run())
+    assert registry.get("s1") is None
@@ -0,0 +1,72 @@
+import asyncio
+
+from utils.singleFlight import ToolSingleFlight
+
+
+def _single_flight():
+    single_flight = ToolSingleFlight(is_idempotent=lambda server_name, tool_name: tool_name == "read_file")
+    single_flight.configure_server("fs", {"single_flight": ["stat"], "single_flight_exclude": ["read_file_live"]})
+    single_flight.configure_server("shell", {})
+    return single_flight
+
+
+async def _call_twice(single_flight, server_name, tool_name, args=None):
+    executions = []
+
+    async def execute():
+        executions.append(tool_name)
+        await asyncio.sleep(0.01)
+        return len(executions)
+
+    results = await asyncio.gather(*(single_flight.call(server_name, tool_name, args or {}, execute) for _ in range(2)))
+    return results, executions
+
+
+def test_idempotent_calls_are_merged():
+    single_flight = _single_flight()
+    results, executions = asyncio.run(_call_twice(single_flight, "fs", "read_file", {"path": "a"}))
+    assert results == [1, 1]
+    assert len(executions) == 1
+    assert single_flight.shared == 1
+
+
+def test_opt_in_tools_are_merged():
+    _, executions = asyncio.run(_call_twice(_single_flight(), "fs", "stat"))
+    assert len(executions) == 1
+
+
+def test_non_idempotent_calls_run_separately():
+    single_flight = _single_flight()
+    _, executions = asyncio.run(_call_twice(single_flight, "shell", "execute_command_tool", {"command": "date"}))
+    assert len(executions) == 2
+    assert not single_flight.should_merge("fs", "read_file_live")
+
+
+def test_different_args_are_not_merged():
+    single_flight = _single_flight()
+
+    async def run():
+        async def execute():
+            await asyncio.sleep(0.01)
+            return "ok"
+        await asyncio.gather(single_flight.call("fs", "read_file", {"path": "a"}, execute),
+                             single_flight.call("fs", "read_file", {"path": "b"}, execute))
+
+    asyncio.run(run())
+    assert single_flight.executions == 2
+
+
+def test_cancelling_one_waiter_keeps_the_shared_call():
+    single_flight = _single_flight()
+
+    async def run():
+        async def execute():
+            await asyncio.sleep(0.05)
+            return "done"
+        first = asyncio.create_task(single_flight.call("fs", "read_file", {}, execute))
+        second = asyncio.create_task(single_flight.call("fs", "read_file", {}, execute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == "done"
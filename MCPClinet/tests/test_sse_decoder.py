@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+from utils.sseDecoder import SSEDecoder, decode_sse_bytes
+
+EVENTS = [
+    {"choices": [{"delta": {"role": "assistant", "content": ""}}]},
+    {"choices": [{"delta": {"content": "北京明天晴，"}}]},
+    {"choices": [{"delta": {"content": "最高气温 25℃。"}}]},
+]
+
+
+def _stream(events=EVENTS, separator=b"\n\n"):
+    body = b"".join(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + separator for event in events)
+    return b": keep-alive\n\n" + body + b"data: [DONE]\n\n"
+
+
+def _feed_in_chunks(data, size):
+    decoder = SSEDecoder()
+    events = []
+    for i in range(0, len(data), size):
+        events.extend(decoder.feed(data[i:i + size]))
+    return events + decoder.flush()
+
+
+def test_decode_whole_stream():
+    assert decode_sse_bytes(_stream()) == EVENTS
+
+
+def test_arbitrary_chunk_boundaries_including_multibyte_characters():
+    data = _stream()
+    for size in (1, 2, 3, 7, 64):
+        assert _feed_in_chunks(data, size) == EVENTS
+
+
+def test_crlf_line_endings():
+    assert decode_sse_bytes(_stream().replace(b"\n", b"\r\n")) == EVENTS
+
+
+def test_events_without_blank_line_separator():
+    assert decode_sse_bytes(_stream(separator=b"\n")) == EVENTS
+
+
+def test_multiline_data_is_joined():
+    data = b'data: {"a":\ndata: 1}\n\n'
+    assert decode_sse_bytes(data) == [{"a": 1}]
+
+
+def test_stops_after_done_and_skips_invalid_json():
+    decoder = SSEDecoder()
+    events = decoder.feed(b"data: not-json\n\ndata: {\"a\": 1}\n\ndata: [DONE]\n\ndata: {\"b\": 2}\n\n")
+    assert events == [{"a": 1}]
+    assert decoder.done
+    assert decoder.invalid == 1
+
+
+def test_unterminated_last_event_is_flushed():
+    decoder = SSEDecoder()
+    assert decoder.feed(b'data: {"a": 1}') == []
+    assert decoder.flush() == [{"a": 1}]
+
+
+def test_aiter_events():
+    async def chunks():
+        data = _stream()
+        for i in range(0, len(data), 5):
+            yield data[i:i + 5]
+
+    async def collect():
+        return [event async for event in SSEDecoder().aiter_events(chunks())]
+
+    assert asyncio.run(collect()) == EVENTS
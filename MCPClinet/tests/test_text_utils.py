@@ -0,0 +1,19 @@
+from utils.textUtils import estimate_tokens, tokenize
+
+
+def test_tokenize_splits_camel_case_and_tool_names():
+    assert tokenize("filesystem.readFile") == ["filesystem", "read", "file"]
+
+
+def test_tokenize_mixed_text():
+    assert tokenize("readFile 北京") == ["read", "file", "北", "京", "北京"]
+
+
+def test_tokenize_chinese_unigrams_and_bigrams():
+    assert tokenize("天气") == ["天", "气", "天气"]
+
+
+def test_estimate_tokens_counts_each_cjk_character():
+    assert estimate_tokens("北京明天的天气怎么样") == 10
+    assert estimate_tokens("hello world!") == 3
+    assert estimate_tokens("查询 weather") == 2 + 2
@@ -0,0 +1,69 @@
+import asyncio
+import json
+import os
+import time
+
+from utils.handleLog import ToolLogSink
+
+
+def _read_records(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_records_are_written_in_batches(tmp_path):
+    path = str(tmp_path / "log" / "tool_output.jsonl")
+    sink = ToolLogSink(path=path, batch_size=3, flush_interval=0.05)
+    writes = []
+    append = sink._append
+    sink._append = lambda lines: (writes.append(lines.count("\n")), append(lines))
+
+    async def run():
+        for i in range(7):
+            sink.emit({"i": i})
+        await asyncio.sleep(0.2)
+        await sink.close()
+
+    asyncio.run(run())
+    assert writes == [3, 3, 1]
+    assert [record["i"] for record in _read_records(path)] == list(range(7))
+    assert sink.stats() == {"queued": 0, "written": 7, "dropped": 0}
+
+
+def test_full_queue_drops_records(tmp_path):
+    sink = ToolLogSink(path=str(tmp_path / "tool_output.jsonl"), max_queue=2)
+
+    async def run():
+        for i in range(5):
+            sink.emit({"i": i})  # 中间不让出事件循环，后台任务来不及消费
+        dropped = sink.dropped
+        await sink.close()
+        return dropped
+
+    assert asyncio.run(run()) == 3
+    assert sink.written == 2
+
+
+def test_rotates_when_file_is_too_large(tmp_path):
+    path = str(tmp_path / "tool_output.jsonl")
+    sink = ToolLogSink(path=path, max_file_bytes=10)
+    sink._append('{"i": 0, "padding": "xxxx"}\n')
+    sink._append('{"i": 1}\n')
+    rotated = [name for name in os.listdir(tmp_path) if name != "tool_output.jsonl"]
+    assert len(rotated) == 1
+    assert _read_records(path) == [{"i": 1}]
+
+
+def test_file_left_from_previous_day_is_rotated(tmp_path):
+    path = tmp_path / "tool_output.jsonl"
+    path.write_text('{"i": "yesterday"}\n', encoding="utf-8")
+    yesterday = time.time() - 86400
+    os.utime(path, (yesterday, yesterday))
+
+    sink = ToolLogSink(path=str(path))
+    sink._append('{"i": "today"}\n')
+    assert _read_records(path) == [{"i": "today"}]
+    assert len(os.listdir(tmp_path)) == 2
+
+    sink._append('{"i": "later"}\n')  # 同一天不再轮转
+    assert len(os.listdir(tmp_path)) == 2
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import os
+import time
+
+from utils.toolOutputStore import ToolOutputStore, build_preview
+
+
+def test_short_output_is_kept_verbatim():
+    store = ToolOutputStore(preview_threshold=100)
+    assert asyncio.run(store.to_context("短输出")) == "短输出"
+    assert store.total_bytes == 0
+
+
+def test_json_preview_describes_structure():
+    content = json.dumps({"items": [{"id": i, "name": f"n{i}", "ok": True} for i in range(200)], "total": 200})
+    preview = build_preview(content, "0123456789abcdef")
+    assert "ref=0123456789abcdef" in preview
+    assert 'JSON 结构: {"items": [{"id": "number", "name": "string", "ok": "boolean"}, "... 共 200 项"], "total": "number"}' in preview
+
+
+def test_table_preview_counts_rows():
+    content = "\n".join(["name,score"] + [f"row{i},{i}" for i in range(300)])
+    preview = build_preview(content, "0123456789abcdef", head_chars=50, tail_chars=20)
+    assert "CSV 表格，共 301 行" in preview
+    assert preview.count("row") < 20  # 只保留开头和结尾
+    assert preview.rstrip().splitlines()[-2] == "row299,299"
+
+
+def test_read_by_offset_and_keyword():
+    store = ToolOutputStore(preview_threshold=10)
+    content = "abcdefghij" * 100 + "关键词在这里" + "z" * 100
+
+    async def run():
+        preview = await store.to_context(content)
+        ref = preview.split("ref=")[1].split("，")[0]
+        by_offset = await store.read({"ref": ref, "offset": 5, "length": 10})
+        by_keyword = await store.read({"ref": ref, "keyword": "关键词"})
+        missing = await store.read({"ref": ref, "keyword": "不存在"})
+        return ref, by_offset, by_keyword, missing
+
+    ref, by_offset, by_keyword, missing = asyncio.run(run())
+    assert by_offset == f"[ref={ref}，字符 5-15 / 共 {len(content)}]\nfghijabcde"
+    assert by_keyword.startswith("[offset 1000]") and "关键词在这里" in by_keyword
+    assert missing == "未找到关键词 不存在。"
+
+
+def test_lru_eviction_within_memory_budget():
+    store = ToolOutputStore(max_bytes=25, preview_threshold=0)
+
+    async def run():
+        first = await store.put("a" * 10)
+        await store.put("b" * 10)
+        await store.get(first)  # 最近使用过，不会被淘汰
+        await store.put("c" * 10)
+        return first
+
+    first = asyncio.run(run())
+    assert asyncio.run(store.get(first)) == "a" * 10
+    assert store.total_bytes == 20
+
+
+def test_archive_survives_restart(tmp_path):
+    directory = str(tmp_path / "tool_outputs")
+    content = "x" * 5000
+
+    ref = asyncio.run(ToolOutputStore(preview_threshold=100, directory=directory).put(content))
+    restarted = ToolOutputStore(preview_threshold=100, directory=directory)
+    assert asyncio.run(restarted.get(ref)) == content
+    assert asyncio.run(ToolOutputStore().get(ref)) is None  # 不持久化时重启后引用失效
+
+
+def test_invalid_ref_never_touches_disk(tmp_path):
+    (tmp_path / "secret.txt").write_text("secret", encoding="utf-8")
+    store = ToolOutputStore(directory=str(tmp_path / "tool_outputs"))
+    assert asyncio.run(store.get("../secret")) is None
+
+
+def test_purge_expired_archive_files(tmp_path):
+    directory = tmp_path / "tool_outputs"
+    store = ToolOutputStore(directory=str(directory), retention=60)
+    old_ref = asyncio.run(store.put("old"))
+    new_ref = asyncio.run(store.put("new"))
+    old_path = directory / f"{old_ref}.txt"
+    os.utime(old_path, (time.time() - 120, time.time() - 120))
+
+    assert store.purge_expired() == 1
+    assert not old_path.exists() and (directory / f"{new_ref}.txt").exists()
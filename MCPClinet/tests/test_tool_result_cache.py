@@ -0,0 +1,74 @@
+import time
+
+from mcp import types
+
+from utils.toolResultCache import ToolResultCache, canonical_args
+
+
+def _result(text="ok", is_error=False):
+    return types.CallToolResult(content=[types.TextContent(type="text", text=text)], isError=is_error)
+
+
+def _cache(**kwargs):
+    cache = ToolResultCache(**kwargs)
+    cache.configure_server("file-system", {
+        "tools": {"read_file": {"ttl": 60}, "list_files": 60},
+        "invalidated_by": ["write_file", "execute-command.execute_command_tool", "excel-stdio.*"],
+    })
+    return cache
+
+
+def test_canonical_args_ignores_key_order():
+    assert canonical_args({"b": 1, "a": "文件"}) == canonical_args({"a": "文件", "b": 1})
+
+
+def test_put_and_get_cacheable_tools_only():
+    cache = _cache()
+    cache.put("file-system", "read_file", {"path": "a"}, _result())
+    cache.put("file-system", "write_file", {"path": "a"}, _result())
+    cache.put("file-system", "list_files", {"path": "."}, _result(is_error=True))
+    assert cache.get("file-system", "read_file", {"path": "a"}) is not None
+    assert cache.get("file-system", "write_file", {"path": "a"}) is None
+    assert cache.get("file-system", "list_files", {"path": "."}) is None
+
+
+def test_expired_entries_are_dropped():
+    cache = _cache()
+    cache.put("file-system", "read_file", {"path": "a"}, _result())
+    key = next(iter(cache._entries))
+    _, size, result = cache._entries[key]
+    cache._entries[key] = (time.monotonic() - 1, size, result)
+    assert cache.get("file-system", "read_file", {"path": "a"}) is None
+    assert cache.total_bytes == 0
+
+
+def test_lru_eviction_respects_byte_budget():
+    cache = _cache(max_bytes=200)
+    cache.put("file-system", "read_file", {"path": "a"}, _result("x" * 100))
+    cache.put("file-system", "read_file", {"path": "b"}, _result("y" * 100))
+    assert cache.get("file-system", "read_file", {"path": "a"}) is None
+    assert cache.get("file-system", "read_file", {"path": "b"}) is not None
+    assert cache.total_bytes <= 200
+
+
+def test_same_server_write_invalidates():
+    cache = _cache()
+    cache.put("file-system", "read_file", {"path": "a"}, _result())
+    cache.on_tool_called("file-system", "write_file")
+    assert cache.get("file-system", "read_file", {"path": "a"}) is None
+
+
+def test_other_server_tools_invalidate():
+    cache = _cache()
+    for server_name, tool_name in [("execute-command", "execute_command_tool"), ("excel-stdio", "write_data_to_excel")]:
+        cache.put("file-system", "read_file", {"path": "a"}, _result())
+        cache.on_tool_called(server_name, tool_name)
+        assert cache.get("file-system", "read_file", {"path": "a"}) is None
+
+
+def test_unrelated_calls_keep_entries():
+    cache = _cache()
+    cache.put("file-system", "read_file", {"path": "a"}, _result())
+    cache.on_tool_called("weather", "write_file")
+    cache.on_tool_called("file-system", "read_file")
+    assert cache.get("file-system", "read_file", {"path": "a"}) is not None
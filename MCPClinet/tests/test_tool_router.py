@@ -0,0 +1,66 @@
+import json
+
+from utils.toolRouter import ToolRouter
+
+BUILTIN = "client.read_tool_output"
+
+
+def _tool(name, description):
+    return {"type": "function", "function": {
+        "name": name, "description": description,
+        "parameters": {"type": "object", "properties": {"path": {"type": "string", "description": "Path to the file"}}}}}
+
+
+def _catalog():
+    tools = [_tool(f"misc{i}.helper_{i}", f"Generic helper number {i}") for i in range(30)]
+    tools += [
+        _tool("filesystem.read_file", "Read the complete contents of a file from the file system"),
+        _tool("filesystem.write_file", "Create a new file or overwrite an existing file"),
+        _tool("weather.get_forecast", "Get weather forecast for a city"),
+        _tool(BUILTIN, "读取已存档的完整工具输出的指定片段"),
+    ]
+    return tools, json.dumps(tools, ensure_ascii=False)
+
+
+def _route(query, router=None, **kwargs):
+    tools, serialized = _catalog()
+    router = router or ToolRouter(top_k=3, min_tools=10)
+    return router.route(query, tools, 1, serialized, always_include=[BUILTIN], **kwargs)
+
+
+def test_route_ranks_relevant_tools_first():
+    selected = _route("read the file config.json")
+    assert selected[0] == BUILTIN
+    assert selected[1] == "filesystem.read_file"
+    assert len(selected) <= 1 + 3
+
+
+def test_route_keeps_recent_tools():
+    selected = _route("weather in Beijing", recent_tools=["filesystem.write_file"])
+    assert {"weather.get_forecast", "filesystem.write_file", BUILTIN} <= set(selected)
+
+
+def test_route_sends_all_tools_when_nothing_matches():
+    assert _route("hello there") is None
+
+
+def test_route_sends_all_tools_for_cross_language_query():
+    # 中文问题与英文工具描述没有共同的词，只和内置工具的中文描述偶然共享 "的"，不能只发送内置工具
+    assert _route("帮我查一下北京明天的天气") is None
+
+
+def test_route_sends_all_tools_below_min_score():
+    assert _route("read the file", router=ToolRouter(top_k=3, min_tools=10, min_score=100.0)) is None
+
+
+def test_route_skips_small_catalogs():
+    assert _route("read the file", router=ToolRouter(top_k=3, min_tools=100)) is None
+
+
+def test_subset_reports_saved_tokens():
+    tools, serialized = _catalog()
+    router = ToolRouter(top_k=3, min_tools=10)
+    subset, subset_json, saved = router.subset(["filesystem.read_file"], tools, 1, serialized)
+    assert [tool["function"]["name"] for tool in subset] == ["filesystem.read_file"]
+    assert json.loads(subset_json) == subset
+    assert saved > 0
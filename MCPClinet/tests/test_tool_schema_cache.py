@@ -0,0 +1,38 @@
+import asyncio
+import os
+
+from utils.toolSchemaCache import ToolSchemaCache, server_fingerprint
+
+TOOLS = [{"type": "function", "function": {"name": "fs.read_file", "description": "读取文件", "parameters": {}}}]
+
+
+def test_fingerprint_follows_launch_config():
+    config = {"command": "python", "args": ["server.py"], "env": None}
+    assert server_fingerprint(config) == server_fingerprint({**config, "lifecycle": "on_demand"})
+    assert server_fingerprint(config) != server_fingerprint({**config, "args": ["other.py"]})
+
+
+def test_put_persists_and_reloads(tmp_path):
+    path = str(tmp_path / "cache" / "tool_schemas.json")
+    cache = ToolSchemaCache(path)
+    asyncio.run(cache.put("fs", "abc", TOOLS))
+    assert cache.get("fs", "abc") == TOOLS
+    reloaded = ToolSchemaCache(path)
+    assert reloaded.get("fs", "abc") == TOOLS
+    assert reloaded.get("fs", "changed") is None  # 配置改变后缓存失效
+    assert reloaded.get("other", "abc") is None
+
+
+def test_unchanged_put_does_not_rewrite(tmp_path):
+    path = str(tmp_path / "tool_schemas.json")
+    cache = ToolSchemaCache(path)
+    asyncio.run(cache.put("fs", "abc", TOOLS))
+    os.remove(path)
+    asyncio.run(cache.put("fs", "abc", list(TOOLS)))
+    assert not os.path.exists(path)
+
+
+def test_corrupt_file_is_ignored(tmp_path):
+    path = tmp_path / "tool_schemas.json"
+    path.write_text("{not json", encoding="utf-8")
+    assert ToolSchemaCache(str(path)).get("fs", "abc") is None
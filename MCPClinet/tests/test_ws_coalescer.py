@@ -0,0 +1,116 @@
+import asyncio
+import json
+
+from utils.wsCoalescer import WebSocketCoalescer
+
+
+class _WebSocket:
+    """记录发送的帧；gate 未打开时 send 一直等待，模拟跟不上的客户端"""
+    def __init__(self):
+        self.frames = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def send(self, data):
+        await self.gate.wait()
+        self.frames.append(json.loads(data))
+
+
+def test_adjacent_deltas_are_merged_until_close():
+    async def run():
+        ws = _WebSocket()
+        coalescer = WebSocketCoalescer(ws, flush_interval=10, flush_bytes=1024)
+        for part in ("你", "好", "!"):
+            await coalescer.push("content", part)
+        assert ws.frames == []
+        await coalescer.close()
+        return ws.frames, coalescer
+
+    frames, coalescer = asyncio.run(run())
+    assert frames == [{"type": "content", "content": "你好!"}]
+    assert (coalescer.deltas, coalescer.frames_sent) == (3, 1)
+
+
+def test_type_switch_and_new_step_start_new_frames_in_order():
+    async def run():
+        ws = _WebSocket()
+        coalescer = WebSocketCoalescer(ws, flush_interval=10, flush_bytes=1024)
+        await coalescer.push("reasoning", "r1", newStep=True)
+        await coalescer.push("reasoning", "r2")
+        await coalescer.push("content", "c1")
+        await coalescer.push("reasoning", "r3")
+        await coalescer.push("reasoning", "r4", newStep=True)
+        await coalescer.close()
+        return ws.frames
+
+    assert asyncio.run(run()) == [
+        {"type": "reasoning", "newStep": True, "content": "r1r2"},
+        {"type": "content", "content": "c1"},
+        {"type": "reasoning", "content": "r3"},
+        {"type": "reasoning", "newStep": True, "content": "r4"},
+    ]
+
+
+def test_flush_when_buffer_reaches_flush_bytes():
+    async def run():
+        ws = _WebSocket()
+        coalescer = WebSocketCoalescer(ws, flush_interval=10, flush_bytes=4)
+        await coalescer.push("content", "ab")
+        sent_early = list(ws.frames)
+        await coalescer.push("content", "cd")
+        sent = list(ws.frames)
+        await coalescer.close()
+        return sent_early, sent
+
+    sent_early, sent = asyncio.run(run())
+    assert sent_early == []
+    assert sent == [{"type": "content", "content": "abcd"}]
+
+
+def test_timer_flushes_after_flush_interval():
+    async def run():
+        ws = _WebSocket()
+        coalescer = WebSocketCoalescer(ws, flush_interval=0.01, flush_bytes=1024)
+        await coalescer.push("content", "a")
+        await asyncio.sleep(0.05)
+        sent = list(ws.frames)
+        await coalescer.close()
+        return sent
+
+    assert asyncio.run(run()) == [{"type": "content", "content": "a"}]
+
+
+def test_push_waits_when_pending_bytes_exceed_limit():
+    async def run():
+        ws = _WebSocket()
+        coalescer = WebSocketCoalescer(ws, flush_interval=0.01, flush_bytes=1024, max_pending_bytes=8)
+        ws.gate.clear()
+        await coalescer.push("content", "ab")
+        await asyncio.sleep(0.03)  # 定时器开始发送 "ab"，客户端没有读取
+        await coalescer.push("content", "cd")  # 上一帧仍在发送，继续合并
+        await coalescer.push("content", "efgh")
+        blocked = asyncio.create_task(coalescer.push("content", "ijk"))
+        await asyncio.sleep(0.03)
+        was_blocked = not blocked.done()
+        ws.gate.set()
+        await blocked
+        await coalescer.close()
+        return was_blocked, ws.frames
+
+    was_blocked, frames = asyncio.run(run())
+    assert was_blocked
+    assert frames == [{"type": "content", "content": "ab"}, {"type": "content", "content": "cdefghijk"}]
+
+
+def test_close_cancels_timer_and_flushes_remainder():
+    async def run():
+        ws = _WebSocket()
+        coalescer = WebSocketCoalescer(ws, flush_interval=10, flush_bytes=1024)
+        await coalescer.push("reasoning", "思考")
+        timer = coalescer._timer
+        await coalescer.close()
+        return ws.frames, timer
+
+    frames, timer = asyncio.run(run())
+    assert frames == [{"type": "reasoning", "content": "思考"}]
+    assert timer.cancelled()
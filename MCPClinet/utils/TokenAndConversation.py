@@ -1,10 +1,17 @@
-import json
-from typing import List, Dict, Any, Optional
+import asyncio
+from typing import List, Dict, Any, Iterable, Optional
 from dotenv import load_dotenv
-import requests
+import httpx
 from datetime import datetime
-from transformers import AutoTokenizer
 import os
+import threading
+import time
+from collections import Counter
+from utils.metrics import TOKEN_COUNT_SECONDS
+from utils.messageStore import MessageStore
+from utils.budgetPacker import group_tool_exchanges, pack_to_budget
+from utils.extractiveCompressor import find_redundant, compress_content, message_text
+from utils.textUtils import estimate_tokens, tokenize
 
 
 
@@ -17,28 +24,107 @@ print("当前LLM窗口大小设置为:",model_contextWindow)
 """
 
 
-# 设置令牌限制
+# 设置令牌限制 (MAX_TOKENS 为调用方未提供预算时使用的默认上下文上限)
 MAX_TOKENS = 128000
-MIN_TOKENS_RESERVE = 500
+MIN_TOKENS_RESERVE = 500  # 预算之外再留出的余量，抵消 token 估算误差
+RECENT_MESSAGES_KEPT = 4  # 压缩时总是保留的最近消息数
+EXTRACTIVE_MIN_CHARS = 1500  # 超过该字符数的较早消息才做抽取式压缩
+EXTRACTIVE_RATIO = 0.3  # 抽取式压缩保留的字符比例
+# 上下文超过限制的该比例时，在后台提前生成摘要
+SUMMARY_SOFT_RATIO = 0.75
+SUMMARY_TIMEOUT = 120  # 摘要请求超时 (秒)
+
+# 分词器后端: auto (依次尝试 tokenizers 本地文件 -> transformers -> 估算) / tokenizers / transformers / estimate
+TOKENIZER_BACKEND = os.getenv("TOKENIZER_BACKEND", "auto")
+# tokenizers 后端使用的本地 tokenizer.json 文件 (不随仓库提供，需从所用模型的 Hugging Face 仓库下载，见 README)
+TOKENIZER_FILE = os.getenv("TOKENIZER_FILE", "../tokenizer/tokenizer.json")
+
+# 消息上的内部元数据字段，发送给 LLM 前需要移除
+META_FIELDS = ("timestamp", "is_key", "importance_score", "token_count", "token_key", "msg_id")
 
 class TokenCounter:
-    """适用于 Qwen 模型的令牌计数器"""
-    def __init__(self, model_name="Qwen/Qwen-7B-Chat"):
-        try:
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-        except Exception as e:
-            print(f"初始化 Qwen tokenizer 失败: {e}")
-            self.tokenizer = None
+    """适用于 Qwen 模型的令牌计数器
+
+    分词器在后台线程中加载 (启动时通过 warm_up_in_background 预热，未预热时在第一次计数时开始)，
+    加载完成前使用估算值，加载完成后 generation 递增，已缓存的估算值会被重新计算。
+    """
+    def __init__(self, model_name="Qwen/Qwen-7B-Chat", backend: str = TOKENIZER_BACKEND, tokenizer_file: str = TOKENIZER_FILE):
+        self.model_name = model_name
+        self.backend = backend
+        self.tokenizer_file = tokenizer_file
+        self.tokenizer = None
+        self.backend_name = "estimate"  # 实际使用的后端
+        self.generation = 0  # 分词器加载完成后递增，用于使缓存的估算值失效
+        self.load_seconds: Optional[float] = None
+        self._encode = None
+        self._loaded = False
+        self._warming = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> None:
+        """按配置的后端顺序加载分词器"""
+        with self._lock:
+            if self._loaded:
+                return
+            start = time.perf_counter()
+            backends = ["tokenizers", "transformers"] if self.backend == "auto" else [self.backend]
+            for backend in backends:
+                try:
+                    if backend == "tokenizers":
+                        if not os.path.exists(self.tokenizer_file):
+                            raise FileNotFoundError(self.tokenizer_file)
+                        from tokenizers import Tokenizer
+                        self.tokenizer = Tokenizer.from_file(self.tokenizer_file)
+                        self._encode = lambda text: len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+                    elif backend == "transformers":
+                        from transformers import AutoTokenizer
+                        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, trust_remote_code=True)
+                        self._encode = lambda text: len(self.tokenizer.encode(text))
+                    else:
+                        continue
+                    self.backend_name = backend
+                    break
+                except Exception as e:
+                    print(f"初始化 {backend} 分词器失败: {e}")
+                    self.tokenizer = None
+            self.load_seconds = time.perf_counter() - start
+            self._loaded = True
+            self.generation += 1
+            print(f"分词器后端: {self.backend_name}，加载耗时 {self.load_seconds:.2f}s")
+
+    def warm_up_in_background(self) -> threading.Thread:
+        """在后台线程中加载分词器，避免阻塞服务启动"""
+        self._warming = True
+        thread = threading.Thread(target=self._load, name="tokenizer-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def _ensure_loaded(self) -> bool:
+        """分词器是否已加载；尚未开始预热时在后台开始加载，加载完成前返回 False (此时使用估算值)"""
+        if self._loaded:
+            return True
+        if not self._warming:
+            self.warm_up_in_background()  # 不在事件循环中同步加载分词器
+        return False
 
     def count_message_tokens(self, message: Dict[str, Any]) -> int:
         """计算单条消息的 token 数"""
-        if not self.tokenizer:
-            return len(str(message)) // 4  # 退化为估算
+        if not self._ensure_loaded() or self._encode is None:
+            # 退化为估算 (不计入内部元数据字段，中文按字计数)
+            return estimate_tokens(str({k: v for k, v in message.items() if k not in META_FIELDS}))
 
         role = message.get("role", "")
-        content = message.get("content", "")
-        text = f"<|im_start|>{role}\n{content}<|im_end|>\n"
-        return len(self.tokenizer.encode(text))
+        text = f"<|im_start|>{role}\n{message_text(message)}<|im_end|>\n"  # 内容 + 工具调用参数
+        return self._encode(text)
+
+    def count_message_tokens_cached(self, message: Dict[str, Any]) -> int:
+        """计算单条消息的 token 数并缓存在消息上，role、content 和 tool_calls 未变化时直接复用"""
+        key = hash((message.get("role", ""), message_text(message), self.generation))
+        if message.get("token_key") != key:
+            with TOKEN_COUNT_SECONDS.time():
+                message["token_count"] = self.count_message_tokens(message)
+            message["token_key"] = key
+        return message["token_count"]
 
     def count_total_tokens(self, messages: List[Dict[str, Any]]) -> int:
         """计算整个上下文的 token 总数"""
@@ -46,19 +132,26 @@ class TokenCounter:
 
 class ConversationManager:
     """对话管理器，负责维护消息历史"""
-    def __init__(self, model_api_url: str, model_name: str, token_counter: TokenCounter):
-        self.messages: List[Dict[str, Any]] = []
+    def __init__(self, model_api_url: str, model_name: str, token_counter: TokenCounter,
+                 http_client: Optional[httpx.AsyncClient] = None, model_api_key: Optional[str] = None,
+                 session_id: Optional[str] = None, store=None):
+        self.session_id = session_id
+        self.store = store  # 会话持久化存储 (ConversationStore)，为 None 时只保存在内存中
+        self.history = MessageStore()  # 带索引的消息历史 (稳定 msg_id、角色索引、关键消息集合)
+        self.system_prompts: List[Dict[str, Any]] = []  # 固定的系统提示前缀，不参与压缩，保持不变以命中前缀缓存
+        self.prompt_cache_stats = {"prompt_tokens": 0, "cached_tokens": 0}  # 会话累计的前缀缓存统计
         self.token_counter = token_counter
+        self._history_tokens = 0  # 历史消息的 token 总数，增量维护
+        self._counted_generation = token_counter.generation  # _history_tokens 对应的分词器版本
         self.model_api_url = model_api_url
         self.model_name = model_name
+        self.model_api_key = model_api_key
+        self.http_client = http_client  # 共享的 httpx 客户端，用于生成摘要
+        self._summary_task: Optional[asyncio.Task] = None  # 后台摘要任务
         self.system_summary = None
         self.tool_context = None  # 存储工具上下文摘要
-        self.key_messages = []  # 存储被标记为重要的消息
-        self.compression_stages = {
-            "stage1": 0.8,  # 第一阶段，保留80%的令牌
-            "stage2": 0.6,  # 第二阶段，保留60%的令牌
-            "stage3": 0.4   # 第三阶段，保留40%的令牌
-        }
+        self.routed_tools: Optional[List[str]] = None  # 本轮工具路由选中的工具名，None 表示发送全部工具
+        self.token_budget = MAX_TOKENS - MIN_TOKENS_RESERVE  # 消息 (含固定前缀和摘要) 可用的 token 数，由 optimize_history 更新
     
     def add_message(self, message: Dict[str, Any], is_key_message: bool = False) -> None:
         """
@@ -71,46 +164,166 @@ class ConversationManager:
         # 添加时间戳和重要性标记
         message["timestamp"] = datetime.now().isoformat()
         message["is_key"] = is_key_message
-        
-        if is_key_message:
-            self.key_messages.append(len(self.messages))  # 记录关键消息的索引
-            
-        self.messages.append(message)
+        message["msg_id"] = self.history.next_id
+        self.history.append(message)
+        self._history_tokens += self.token_counter.count_message_tokens_cached(message)
+        self._journal("append", {"message": message})
+
+    def _journal(self, kind: str, payload: Dict[str, Any]) -> None:
+        """把一次历史变更作为事件追加到持久化存储"""
+        if self.store is not None and self.session_id:
+            self.store.append(self.session_id, kind, payload)
+
+    @property
+    def messages(self) -> List[Dict[str, Any]]:
+        """按顺序的历史消息列表 (只读视图，修改请使用 add_message / remove_message 等方法)"""
+        return self.history.as_list()
+
+    def _remove_ids(self, msg_ids: Iterable[int]) -> int:
+        """按 msg_id 移除消息 (每条 O(1))，同步 token 总数并只记录被移除的 id，返回移除的条数"""
+        removed = []
+        for msg_id in msg_ids:
+            message = self.history.remove(msg_id)
+            if message is not None:
+                removed.append(msg_id)
+                self._history_tokens -= message.get("token_count", 0)
+        if removed:
+            self._journal("remove", {"msg_ids": removed})
+        return len(removed)
+
+    def _replace_content(self, msg_id: int, content: str) -> None:
+        """替换消息内容 (压缩)，同步 token 总数并记录持久化事件"""
+        message = self.history.get(msg_id)
+        if message is None:
+            return
+        self._history_tokens -= message.get("token_count", 0)
+        self.history.update_content(msg_id, content)
+        self._history_tokens += self.token_counter.count_message_tokens_cached(message)
+        self._journal("replace", {"msg_id": msg_id, "content": content})
+
+    def _set_system_summary(self, summary: Optional[Dict[str, Any]]) -> None:
+        self.system_summary = summary
+        self._journal("summary", {"summary": summary})
+
+    async def rehydrate(self) -> bool:
+        """从持久化存储恢复会话历史 (会话重连且不在内存中时调用)，返回是否找到历史
+
+        读取和回放事件在线程中执行，不阻塞事件循环。
+        """
+        if self.store is None or not self.session_id:
+            return False
+        state = await asyncio.to_thread(self.store.load, self.session_id)
+        if state is None:
+            return False
+        self.history.clear()
+        for message in state["messages"]:
+            self.history.append(message)
+        self.system_summary = state["system_summary"]
+        self.tool_context = state["tool_context"]
+        self._refresh_token_total()
+        return True
+
+    def remove_message(self, message: Dict[str, Any]) -> None:
+        """移除指定的消息对象 (不存在时忽略)"""
+        msg_id = message.get("msg_id")
+        if msg_id is not None and self.history.get(msg_id) is message:
+            self._remove_ids([msg_id])
+
+    def checkpoint(self) -> int:
+        """记录轮次开始时的位置 (下一条消息的 id)，轮次被中断时用于 rollback_turn"""
+        return self.history.next_id
+
+    def rollback_turn(self, checkpoint: int, note: Optional[str] = None) -> int:
+        """撤销轮次中新增的消息 (保留本轮用户问题)，避免留下没有工具结果的 tool_calls 等不完整的消息
+
+        note 不为空时在用户问题后追加一条说明中断的助手消息；返回移除的消息数
+        """
+        self.cancel_background_summary()  # 摘要可能基于被撤销的消息生成
+        added = self.history.ids_since(checkpoint)
+        user_query = next((msg_id for msg_id in added if self.history.get(msg_id).get("role") == "user"), None)
+        removed = self._remove_ids([msg_id for msg_id in added if msg_id != user_query])
+        if user_query is not None and note:
+            self.add_message({"role": "assistant", "content": note})
+        return removed
+
+    def _refresh_token_total(self) -> None:
+        """消息列表被重建后重新汇总 token 总数 (只有内容变化的消息会重新分词)"""
+        self._counted_generation = self.token_counter.generation
+        self._history_tokens = sum(self.token_counter.count_message_tokens_cached(msg) for msg in self.history)
+
+    def count_context_tokens(self) -> int:
+        """当前上下文 (固定前缀 + 摘要 + 工具上下文 + 历史) 的 token 总数，使用缓存的逐条计数"""
+        if self._counted_generation != self.token_counter.generation:
+            self._refresh_token_total() # 分词器已加载完成，用真实计数替换估算值
+        extra = list(self.system_prompts)
+        if self.system_summary:
+            extra.append(self.system_summary)
+        if self.tool_context:
+            extra.append(self.tool_context)
+        return self._history_tokens + sum(self.token_counter.count_message_tokens_cached(msg) for msg in extra)
     
+    def add_system_prompt(self, message: Dict[str, Any]) -> None:
+        """添加固定的系统提示到前缀 (已存在相同内容时忽略)"""
+        if message not in self.system_prompts:
+            self.system_prompts.append(message)
+
+    def record_prompt_usage(self, usage: Dict[str, Any]) -> float:
+        """累计一次 LLM 调用的 prompt/cached token 数，返回会话累计缓存命中率"""
+        self.prompt_cache_stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        self.prompt_cache_stats["cached_tokens"] += (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        prompt_tokens = self.prompt_cache_stats["prompt_tokens"]
+        return self.prompt_cache_stats["cached_tokens"] / prompt_tokens if prompt_tokens else 0.0
+
     def mark_as_key_message(self, message_index: int) -> None:
         """将指定索引的消息标记为关键消息"""
         if 0 <= message_index < len(self.messages):
-            self.messages[message_index]["is_key"] = True
-            if message_index not in self.key_messages:
-                self.key_messages.append(message_index)
+            self._mark_key(self.messages[message_index]["msg_id"])
+
+    def _mark_key(self, msg_id: int) -> None:
+        if self.history.mark_key(msg_id):
+            self._journal("mark_key", {"msg_id": msg_id})
     
     def get_current_messages(self) -> List[Dict[str, Any]]:
-        """获取当前的消息历史，包括摘要和工具上下文"""
-        result = []
+        """获取当前的消息历史，包括固定系统提示、摘要和工具上下文
+
+        顺序为: 固定系统提示 -> 摘要 -> 工具上下文 -> 历史消息，前面的部分越稳定，前缀缓存命中越多
+        """
+        sources = list(self.system_prompts)
         
         # 添加对话摘要（如果有）
         if self.system_summary:
-            result.append(self.system_summary)
+            sources.append(self.system_summary)
             
         # 添加工具上下文（如果有）
         if self.tool_context:
-            result.append(self.tool_context)
+            sources.append(self.tool_context)
             
-        # 添加常规消息，但移除内部用的元数据字段
-        for msg in self.messages:
-            clean_msg = {k: v for k, v in msg.items() 
-                        if k not in ["timestamp", "is_key", "importance_score"]}
+        # 添加常规消息，并移除内部用的元数据字段
+        sources.extend(self.messages)
+        result = []
+        for msg in sources:
+            clean_msg = {k: v for k, v in msg.items() if k not in META_FIELDS}
             result.append(clean_msg)
         
         return result
     
     def get_last_user_question(self) -> Optional[str]:
         """获取最后一个用户问题，用于生成针对性摘要"""
-        for msg in reversed(self.messages):
-            if msg.get("role") == "user":
-                return msg.get("content", "")
-        return None
-        
+        last_user = self.history.last("user")
+        return last_user.get("content", "") if last_user else None
+        
+    def get_recent_tool_names(self, limit: int = 8) -> List[str]:
+        """获取最近调用过的工具名 (按时间倒序去重)，工具路由时总是发送这些工具"""
+        names: List[str] = []
+        for msg in self.history.reversed_by_role("assistant"):
+            for call in msg.get("tool_calls") or []:
+                name = (call.get("function") or {}).get("name")
+                if name and name not in names:
+                    names.append(name)
+                    if len(names) >= limit:
+                        return names
+        return names
+
     def update_tool_context(self, tools_info: str) -> None:
         """更新工具上下文信息"""
         self.tool_context = {
@@ -121,78 +334,93 @@ class ConversationManager:
 
 请根据用户需求选择合适的工具。"""
         }
+        self._journal("tool_context", {"tool_context": self.tool_context})
     
-    async def optimize_history(self) -> None:
-        """智能优化历史记录以保持在令牌限制内"""
-        # 获取当前令牌数
-        current_messages = self.get_current_messages()
-        total_tokens = self.token_counter.count_total_tokens(current_messages)
-        
-        # 如果令牌数低于限制，不需要优化
-        if total_tokens <= MAX_TOKENS - MIN_TOKENS_RESERVE:
+    async def optimize_history(self, token_budget: Optional[int] = None) -> None:
+        """把上下文压缩到 token 预算内
+
+        token_budget 为模型上下文窗口减去工具定义和为回答预留的 token 数 (未提供时沿用上一次的预算)。
+        先做不调用 LLM 的本地压缩，再按预算一次性挑选保留的消息；
+        必须保留的消息仍超出预算时才调用 LLM 摘要较早的部分，最后只保留最关键的上下文。
+        """
+        if token_budget is not None:
+            self.token_budget = max(0, token_budget - MIN_TOKENS_RESERVE)
+
+        # 获取当前令牌数 (使用逐条缓存的计数，不重新分词整个历史)
+        # 如果令牌数低于限制，不需要优化 (超过软阈值的后台摘要在轮次结束时由 maybe_schedule_summary 安排)
+        if self.count_context_tokens() <= self.token_budget:
             return
-            
-        # 多阶段压缩策略
-        compression_needed = total_tokens - (MAX_TOKENS - MIN_TOKENS_RESERVE)
-        
-        # 1. 尝试智能过滤非关键消息
-        if compression_needed > 0:
-            self._filter_non_essential_messages()
-            # 重新计算令牌数
-            current_messages = self.get_current_messages()
-            total_tokens = self.token_counter.count_total_tokens(current_messages)
-            compression_needed = total_tokens - (MAX_TOKENS - MIN_TOKENS_RESERVE)
-        
-        # 2. 如果仍然需要压缩，对对话分块并摘要化较早的部分
-        if compression_needed > 0:
+
+        # 1. 不调用 LLM 的本地压缩: 去重、去除重复的系统提示、裁剪 JSON、抽取关键句
+        self._compress_extractive()
+
+        # 2. 按重要性/token 在预算内挑选消息 (工具调用与结果成组保留)
+        if self.count_context_tokens() > self.token_budget:
+            self._pack_to_budget()
+
+        # 3. 如果仍然需要压缩，对对话分块并摘要化较早的部分
+        if self.count_context_tokens() > self.token_budget:
             await self._summarize_conversation_segments()
-            # 重新计算令牌数
-            current_messages = self.get_current_messages()
-            total_tokens = self.token_counter.count_total_tokens(current_messages)
-            compression_needed = total_tokens - (MAX_TOKENS - MIN_TOKENS_RESERVE)
-            
-        # 3. 如果仍然超过限制，保留最近的重要消息和用户问题
-        if compression_needed > 0:
+
+        # 4. 如果仍然超过限制，保留最近的重要消息和用户问题
+        if self.count_context_tokens() > self.token_budget:
             self._preserve_critical_context()
-    
-    def _filter_non_essential_messages(self) -> None:
-        """过滤掉非必要的中间消息，保留关键节点"""
-        if len(self.messages) <= 4:  # 如果消息太少，不进行过滤
+
+    def _pinned_indices(self) -> set:
+        """压缩时必须保留的消息下标: 最近几条消息和当前轮次 (最后一个用户问题及之后) 的全部消息"""
+        messages = self.messages
+        pinned = set(range(max(0, len(messages) - RECENT_MESSAGES_KEPT), len(messages)))
+        last_user = self.history.last("user")
+        if last_user is not None:
+            current_turn = len(self.history.ids_since(last_user["msg_id"]))
+            pinned.update(range(len(messages) - current_turn, len(messages)))
+        return pinned
+
+    def _compress_extractive(self) -> None:
+        """本地抽取式压缩，不调用 LLM；当前轮次和最近的消息不压缩
+
+        先移除冗余 (重复的系统提示、重复的工具结果)，再从最早的消息开始逐条压缩，满足预算即停止:
+        JSON 工具结果只保留后续对话引用过的字段，长文本用 TextRank 保留关键句。
+        """
+        messages = self.messages
+        pinned = self._pinned_indices()
+        removable, replacements = find_redundant(messages, pinned, (msg["content"] for msg in self.system_prompts))
+        for i, content in replacements.items():
+            self._replace_content(messages[i]["msg_id"], content)
+        removed = self._remove_ids([messages[i]["msg_id"] for i in removable])
+        removable = set(removable)
+        compressed = 0
+
+        # later_terms 为当前消息之后所有消息中的词，用于判断 JSON 字段是否被引用
+        later_terms = Counter(term for i, msg in enumerate(messages) if i not in removable
+                              for term in tokenize(message_text(msg)))
+        for i, msg in enumerate(messages):
+            if self.count_context_tokens() <= self.token_budget:
+                break
+            if i in removable:
+                continue
+            later_terms.subtract(tokenize(message_text(msg)))
+            if i in pinned:
+                continue
+            content = compress_content(msg, later_terms, EXTRACTIVE_MIN_CHARS, EXTRACTIVE_RATIO)
+            if content is not None:
+                self._replace_content(msg["msg_id"], content)
+                compressed += 1
+        if removed or replacements or compressed:
+            print(f"本地压缩: 移除 {removed} 条重复系统提示，省略 {len(replacements)} 个重复工具结果，"
+                  f"抽取式压缩 {compressed} 条消息，当前 {self.count_context_tokens()} tokens")
+
+    def _pack_to_budget(self) -> None:
+        """一次性选出预算内价值最高的消息组合，移除其余消息"""
+        messages = self.messages
+        if len(messages) <= RECENT_MESSAGES_KEPT:  # 如果消息太少，不进行过滤
             return
-            
-        # 计算每条消息的重要性分数
-        scored_messages = []
-        for i, msg in enumerate(self.messages):
-            score = self._calculate_message_importance(msg, i)
-            scored_messages.append((i, score))
-            
-        # 按重要性排序
-        scored_messages.sort(key=lambda x: x[1], reverse=True)
-        
-        # 确定要保留的消息数量（基于当前阶段）
-        stage = "stage1"  # 默认第一阶段
-        keep_ratio = self.compression_stages[stage]
-        keep_count = max(4, int(len(self.messages) * keep_ratio))
-        
-        # 获取要保留的消息索引（按原始顺序）
-        indices_to_keep = [idx for idx, _ in sorted(scored_messages[:keep_count])]
-        
-        # 保留选定的消息和最新的几条消息
-        recent_count = min(4, len(self.messages))
-        recent_indices = list(range(len(self.messages) - recent_count, len(self.messages)))
-        
-        # 合并保留索引（确保包含最近消息）
-        all_indices = sorted(set(indices_to_keep + recent_indices))
-        
-        # 重建消息列表
-        self.messages = [self.messages[i] for i in all_indices]
-        
-        # 更新key_messages索引
-        new_key_messages = []
-        for i, idx in enumerate(all_indices):
-            if idx in self.key_messages:
-                new_key_messages.append(i)
-        self.key_messages = new_key_messages
+        history_budget = self.token_budget - (self.count_context_tokens() - self._history_tokens)  # 减去固定前缀和摘要
+        kept = pack_to_budget(messages, history_budget, self.token_counter.count_message_tokens_cached,
+                              self._calculate_message_importance, self._pinned_indices())
+        removed = self._remove_ids([msg["msg_id"] for i, msg in enumerate(messages) if i not in kept])
+        if removed:
+            print(f"按 token 预算 {self.token_budget} 移除 {removed} 条低价值消息，当前 {self.count_context_tokens()} tokens")
     
     def _calculate_message_importance(self, message: Dict[str, Any], index: int) -> float:
         """计算消息的重要性分数"""
@@ -232,49 +460,79 @@ class ConversationManager:
                 
         return score
             
-    async def _summarize_conversation_segments(self) -> None:
-        """将对话分段并对较早的部分进行摘要"""
-        if len(self.messages) <= 6:  # 至少需要足够多的消息才值得摘要
+    def _select_summary_segment(self) -> List[Dict[str, Any]]:
+        """选出需要摘要的较早消息，保留最新的4-6条消息和必须保留的消息 (当前轮次等)；
+        分界点落在工具调用单元的边界上，不拆开工具调用与其结果
+        """
+        messages = self.messages
+        if len(messages) <= 6:  # 至少需要足够多的消息才值得摘要
+            return []
+        recent_turns = min(6, max(len(messages) // 3, 4))
+        cut = min([len(messages) - recent_turns, *self._pinned_indices()])
+        for unit in group_tool_exchanges(messages):
+            if unit[0] < cut <= unit[-1]:
+                cut = unit[0]  # 分界点落在单元内部时整个单元留在最近的消息中
+                break
+        return messages[:cut]
+
+    def maybe_schedule_summary(self) -> None:
+        """上下文超过软阈值时，在后台为较早的消息生成摘要
+
+        只在轮次结束后调用 (用户空闲时生成)，摘要的消息不包含任何轮次中的消息；轮次被撤销时摘要任务随之取消。
+        """
+        if self._summary_task and not self._summary_task.done():
             return
-            
-        # 确定分割点，保留最新的4-6轮对话
-        recent_turns = min(6, max(len(self.messages) // 3, 4))
-        split_index = len(self.messages) - recent_turns
-        
-        # 分离较早和最近的消息
-        earlier_messages = self.messages[:split_index]
-        recent_messages = self.messages[split_index:]
-        
-        if not earlier_messages:
+        if self.count_context_tokens() <= self.token_budget * SUMMARY_SOFT_RATIO:
             return
-            
-        # 获取最新的用户问题，用于上下文相关摘要
-        last_question = self.get_last_user_question()
-        
-        # 生成包含了关键信息的摘要
-        summary = await self._generate_focused_summary(earlier_messages, last_question)
-        
-        # 更新系统摘要
-        self.system_summary = {
+        segment = self._select_summary_segment()
+        if not segment:
+            return
+        print(f"上下文超过软阈值，后台摘要 {len(segment)} 条较早消息")
+        self._summary_task = asyncio.create_task(self._summarize_segment(segment))
+
+    async def _summarize_segment(self, segment: List[Dict[str, Any]]) -> None:
+        """生成摘要并替换对应的消息；摘要失败时保留原消息和之前的摘要"""
+        summary = await self._generate_focused_summary(segment, self.get_last_user_question())
+        if summary is None:
+            print(f"摘要未生成，保留 {len(segment)} 条原消息")
+            return
+        self._apply_summary(segment, summary)
+
+    def _apply_summary(self, segment: List[Dict[str, Any]], summary: str) -> None:
+        """用摘要替换已被摘要的消息；在事件循环中一次性完成，不会与其他协程交错"""
+        self._set_system_summary({
             "role": "system",
             "content": f"""以下是之前对话的详细摘要：
 
             {summary}
 
             请基于此摘要继续对话，保持连贯性。如有必要，可以参考摘要中的关键信息。"""
-                    }
-        
-        # 更新消息列表
-        self.messages = recent_messages
-        
-        # 更新key_messages索引
-        self.key_messages = [i for i in self.key_messages if i >= split_index]
-        self.key_messages = [i - split_index for i in self.key_messages]
-    
+                    })
+        # 摘要生成期间新增或被过滤的消息不受影响，只移除已被摘要的消息
+        self._remove_ids([msg["msg_id"] for msg in segment])
+
+    async def _summarize_conversation_segments(self) -> None:
+        """将对话分段并对较早的部分进行摘要 (超过硬限制时调用，会等待摘要完成)"""
+        if self._summary_task and not self._summary_task.done():
+            # 后台摘要已在进行，等待其完成即可
+            await asyncio.shield(self._summary_task)
+            return
+
+        earlier_messages = self._select_summary_segment()
+        if not earlier_messages:
+            return
+        await self._summarize_segment(earlier_messages)
+
+    def cancel_background_summary(self) -> None:
+        """取消尚未完成的后台摘要任务"""
+        if self._summary_task and not self._summary_task.done():
+            self._summary_task.cancel()
+        self._summary_task = None
+
     async def _generate_focused_summary(self, 
                                      messages: List[Dict[str, Any]], 
-                                     last_question: Optional[str] = None) -> str:
-        """生成针对当前上下文的详细摘要"""
+                                     last_question: Optional[str] = None) -> Optional[str]:
+        """生成针对当前上下文的详细摘要，请求失败或摘要为空时返回 None"""
         try:
             # 提取关键信息，如工具调用、代码片段和重要结果
             key_info = self._extract_key_information(messages)
@@ -296,10 +554,11 @@ class ConversationManager:
             if last_question:
                 guidance += f"\n\n最新用户问题是：\"{last_question}\"\n请确保摘要保留与这个问题相关的所有背景信息。"
             
-            # 准备摘要请求
-            summary_request = [
-                {"role": "system", "content": guidance}
-            ] + messages
+            # 准备摘要请求 (包含之前的摘要，避免再次摘要时丢失更早的信息)
+            summary_request = [{"role": "system", "content": guidance}]
+            if self.system_summary:
+                summary_request.append({"role": "system", "content": self.system_summary["content"]})
+            summary_request += [{k: v for k, v in msg.items() if k not in META_FIELDS} for msg in messages]
             
             # 调用模型生成摘要
             data = {
@@ -309,20 +568,27 @@ class ConversationManager:
             }
             
             headers = {'Content-type': 'application/json'}
-            response = requests.post(
-                self.model_api_url,
-                data=json.dumps(data),
-                headers=headers
-            )
-            
-            if response.status_code == 200:
-                summary = response.json().get("message", {}).get("content", "")
-                return summary
+            if self.model_api_key:
+                headers['Authorization'] = f"Bearer {self.model_api_key}"
+            if self.http_client is not None:
+                response = await self.http_client.post(self.model_api_url, json=data, headers=headers, timeout=SUMMARY_TIMEOUT)
+            else:
+                async with httpx.AsyncClient(timeout=SUMMARY_TIMEOUT) as client:
+                    response = await client.post(self.model_api_url, json=data, headers=headers)
             
-            return "无法生成有效摘要，但对话包含工具调用和重要信息。" 
+            if response.status_code != 200:
+                print(f"生成摘要失败: 状态码 {response.status_code}")
+                return None
+            response_json = response.json()
+            # 兼容 OpenAI 格式 (choices) 和 Ollama 格式 (message)
+            if response_json.get("choices"):
+                summary = response_json["choices"][0].get("message", {}).get("content")
+            else:
+                summary = response_json.get("message", {}).get("content")
+            return summary or None
         except Exception as e:
             print(f"生成摘要失败: {str(e)}")
-            return "生成摘要过程中出错，但请记住对话中包含了工具调用和重要结果。"
+            return None
     
     def _extract_key_information(self, messages: List[Dict[str, Any]]) -> str:
         """从消息中提取关键信息片段"""
@@ -377,89 +643,84 @@ class ConversationManager:
             
     def _preserve_critical_context(self) -> None:
         """在令牌严重超限的情况下，只保留最关键的上下文"""
-        # 保留系统消息、最新的用户问题和答复，以及标记为关键的消息
+        # 保留系统消息、最新的用户问题和答复，以及标记为关键的消息 (均按 msg_id 计算)
         
         # 1. 找出所有系统消息
-        system_indices = [i for i, msg in enumerate(self.messages) 
-                          if msg.get("role") == "system"]
+        system_ids = [msg["msg_id"] for msg in self.history.by_role("system")]
                           
         # 2. 找出最新的2轮对话
-        recent_indices = list(range(max(0, len(self.messages) - 4), len(self.messages)))
+        recent_ids = [msg["msg_id"] for msg in self.messages[-4:]]
         
-        # 3. 合并所有需要保留的索引
-        keep_indices = sorted(set(system_indices + recent_indices + self.key_messages))
+        # 3. 合并所有需要保留的消息
+        keep_ids = set(system_ids + recent_ids) | self.history.key_ids
         
         # 如果需要保留的消息仍然太多，只保留绝对必要的部分
-        if len(keep_indices) > 6:
+        if len(keep_ids) > 6:
             # 确保保留最新的用户问题和回答
-            last_user_idx = None
-            for i in reversed(range(len(self.messages))):
-                if self.messages[i].get("role") == "user":
-                    last_user_idx = i
-                    break
+            last_user = self.history.last("user")
                     
-            # 如果找到了最新用户问题，确保保留它和它之后的回答
-            if last_user_idx is not None:
-                must_keep = [last_user_idx]
-                if last_user_idx < len(self.messages) - 1:
-                    must_keep.append(last_user_idx + 1)
+            # 如果找到了最新用户问题，确保保留它和它之后的回答，以及当前轮次最新的消息 (例如刚返回的工具结果)
+            if last_user is not None:
+                current_turn = self.history.ids_since(last_user["msg_id"])
+                must_keep = current_turn[:2] + current_turn[-1:]
                     
-                # 合并必须保留的关键消息
-                must_keep_key = [i for i in self.key_messages if i in keep_indices][:2]
+                # 合并必须保留的关键消息 (最早的两条)
+                must_keep_key = sorted(self.history.key_ids)[:2]
                 
-                # 最终保留的消息索引
-                keep_indices = sorted(set(must_keep + must_keep_key + system_indices))
-        
-        # 更新消息列表
-        self.messages = [self.messages[i] for i in keep_indices]
+                # 最终保留的消息
+                keep_ids = set(must_keep + must_keep_key + system_ids)
         
-        # 更新key_messages索引
-        new_key_messages = []
-        for i, old_idx in enumerate(keep_indices):
-            if old_idx in self.key_messages:
-                new_key_messages.append(i)
-        self.key_messages = new_key_messages
+        # 工具调用与其结果成组保留，避免留下没有结果的工具调用或没有调用的工具结果
+        keep_ids = self._expand_to_exchanges(keep_ids)
+
+        # 按 id 移除其余消息
+        self._remove_ids([msg["msg_id"] for msg in self.messages if msg["msg_id"] not in keep_ids])
         
         # 添加一个警告消息，告知用户上下文已大幅压缩
-        self.system_summary = {
+        self._set_system_summary({
             "role": "system",
             "content": "注意：由于对话长度超过限制，系统已保留最关键的上下文信息。如果需要参考之前的内容，请明确提醒助手。"
-        }
+        })
     
+    def _expand_to_exchanges(self, msg_ids: set) -> set:
+        """把消息 id 集合扩展为完整的工具调用单元 (带 tool_calls 的助手消息及其全部工具结果)"""
+        messages = self.messages
+        expanded = set()
+        for unit in group_tool_exchanges(messages):
+            unit_ids = [messages[i]["msg_id"] for i in unit]
+            if any(msg_id in msg_ids for msg_id in unit_ids):
+                expanded.update(unit_ids)
+        return expanded
+
     def diminishMessages(self):
         """清空历史消息"""
-        self.messages = []
-        self.key_messages = []
+        self.history.clear()
         self.system_summary = None
+        self._history_tokens = 0
+        self.cancel_background_summary()
+        self._journal("clear", {})
         print(f"已清空历史消息")
         
     def diminishRoleMessages(self,role:str):
         
-       self.messages = [msg for msg in self.messages if msg["role"] != role]
+       self._remove_ids([msg["msg_id"] for msg in self.history.by_role(role)])
             
     def removeMessageByContent(self, target_content: str):
-        self.messages = [
-            msg for msg in self.messages
-            if msg["content"].strip() != target_content.strip()
-        ]      
+        self._remove_ids(self.history.find_by_content(target_content))
         
     def mark_current_exchange_as_key(self):
         """将当前最新的问答交互标记为关键信息"""
-        if len(self.messages) >= 2:
+        last_user = self.history.last("user")
+        if len(self.history) >= 2 and last_user is not None:
             # 标记最后一个用户问题
-            for i in range(len(self.messages)-1, -1, -1):
-                if self.messages[i].get("role") == "user":
-                    self.mark_as_key_message(i)
-                    # 同时标记对应的回答（如果存在）
-                    if i+1 < len(self.messages) and self.messages[i+1].get("role") == "assistant":
-                        self.mark_as_key_message(i+1)
-                    break
+            exchange = self.history.ids_since(last_user["msg_id"])
+            self._mark_key(exchange[0])
+            # 同时标记对应的回答（如果存在）
+            if len(exchange) > 1 and self.history.get(exchange[1]).get("role") == "assistant":
+                self._mark_key(exchange[1])
                 
                     
     def diminishByRoleAndKey(self,  role: str = "system", keyword: str = "推荐的工作流程"):
-        # 删除已有提示消息（避免重复）
-        self.messages = [
-            msg for msg in self.messages
-            if not (msg["role"] == role and keyword in msg["content"])
-        ]
+        # 删除已有提示消息（避免重复），只查找该角色的消息
+        self._remove_ids([msg["msg_id"] for msg in self.history.by_role(role) if keyword in msg["content"]])
 
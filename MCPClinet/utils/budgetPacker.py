@@ -0,0 +1,61 @@
+from typing import Any, Callable, Dict, List, Set
+
+
+def group_tool_exchanges(messages: List[Dict[str, Any]]) -> List[List[int]]:
+    """把消息分组为不可拆分的单元 (消息下标列表)
+
+    带 tool_calls 的助手消息与其后对应 tool_call_id 的工具结果为一组，
+    只保留其中一部分会产生没有结果的工具调用或没有调用的工具结果，LLM 接口会拒绝这样的请求。
+    """
+    units: List[List[int]] = []
+    open_calls: Dict[str, List[int]] = {}  # tool_call_id -> 所属单元
+    for i, msg in enumerate(messages):
+        if msg.get("role") == "tool" and msg.get("tool_call_id") in open_calls:
+            open_calls[msg["tool_call_id"]].append(i)
+            continue
+        unit = [i]
+        units.append(unit)
+        for call in msg.get("tool_calls") or []:
+            if call.get("id"):
+                open_calls[call["id"]] = unit
+    return units
+
+
+def pack_to_budget(messages: List[Dict[str, Any]], budget: int, count_tokens: Callable[[Dict[str, Any]], int],
+                   score: Callable[[Dict[str, Any], int], float], pinned: Set[int]) -> Set[int]:
+    """在 token 预算内选出保留的消息下标
+
+    pinned 中的消息 (及其所在单元) 必须保留；其余单元按 "重要性 / token 数" 从高到低贪心装入剩余预算
+    (分数背包的贪心解)，装不下的跳过继续尝试更小的单元。结果与单个最有价值且能装下的单元比较取优。
+    """
+    units = group_tool_exchanges(messages)
+    kept: Set[int] = set()
+    candidates = []
+    remaining = budget
+    for unit in units:
+        tokens = sum(count_tokens(messages[i]) for i in unit)
+        if any(i in pinned for i in unit):
+            kept.update(unit)
+            remaining -= tokens
+        else:
+            value = sum(score(messages[i], i) for i in unit)
+            candidates.append((value / max(tokens, 1), value, tokens, unit))
+    if remaining <= 0 or not candidates:
+        return kept
+
+    candidates.sort(key=lambda c: c[0], reverse=True)
+    greedy: List[List[int]] = []
+    greedy_value = 0.0
+    left = remaining
+    for _, value, tokens, unit in candidates:
+        if tokens <= left:
+            greedy.append(unit)
+            greedy_value += value
+            left -= tokens
+
+    best_single = max((c for c in candidates if c[2] <= remaining), key=lambda c: c[1], default=None)
+    if best_single is not None and best_single[1] > greedy_value:
+        greedy = [best_single[3]]
+    for unit in greedy:
+        kept.update(unit)
+    return kept
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+# 持久化时不保存的消息字段 (token 计数随分词器变化，重新加载时重算)
+TRANSIENT_FIELDS = ("token_count", "token_key")
+
+
+def replay_events(events: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, Any]:
+    """按顺序回放会话事件，得到会话状态: messages / system_summary / tool_context"""
+    state: Dict[str, Any] = {"messages": [], "system_summary": None, "tool_context": None}
+    by_id: Dict[int, Dict[str, Any]] = {}
+    for kind, payload in events:
+        if kind == "append":
+            message = payload["message"]
+            by_id[message["msg_id"]] = message
+        elif kind == "remove":
+            for msg_id in payload["msg_ids"]:
+                by_id.pop(msg_id, None)
+        elif kind == "replace":
+            if payload["msg_id"] in by_id:
+                by_id[payload["msg_id"]]["content"] = payload["content"]
+        elif kind == "mark_key":
+            if payload["msg_id"] in by_id:
+                by_id[payload["msg_id"]]["is_key"] = True
+        elif kind == "summary":
+            state["system_summary"] = payload.get("summary")
+        elif kind == "tool_context":
+            state["tool_context"] = payload.get("tool_context")
+        elif kind == "clear":
+            by_id.clear()
+            state["system_summary"] = None
+        elif kind == "snapshot":
+            by_id = {message["msg_id"]: message for message in payload["messages"]}
+            state["system_summary"] = payload.get("system_summary")
+            state["tool_context"] = payload.get("tool_context")
+    state["messages"] = list(by_id.values())  # dict 保持插入顺序，即消息的追加顺序
+    return state
+
+
+class ConversationStore:
+    """基于 SQLite (WAL 模式) 的只追加会话存储
+
+    每条新消息、每次压缩的结果 (移除的消息 id、压缩后的内容、新的摘要等) 都作为事件追加，不重写整段历史。
+    事件先进入内存队列，由后台任务组提交写盘；会话重连时才读取并回放其事件 (load)。
+    回放的事件数远多于存活消息时写入一个快照并删除旧事件，限制日志长度。
+    会话被清空 (clear) 时删除其之前的全部事件；超过 retention 秒没有新事件的会话被定期删除。
+    """
+    def __init__(self, path: str = "./cache/conversations.db", flush_interval: float = 0.2,
+                 snapshot_min_events: int = 200, retention: Optional[float] = None,
+                 sweep_interval: float = 3600):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.snapshot_min_events = snapshot_min_events
+        self.retention = retention
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._pending: deque = deque()  # 尚未写盘的 (session_id, kind, payload, created_at)
+        self._lock = threading.Lock()  # 串行化写盘与读取，保证 load 能看到所有已提交的事件
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.failed = 0
+        self.purged_sessions = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS events (
+                                  id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                  session_id TEXT NOT NULL,
+                                  kind TEXT NOT NULL,
+                                  payload TEXT NOT NULL,
+                                  created_at REAL NOT NULL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS events_session ON events (session_id, id)")
+        self._conn.commit()
+
+    def start(self) -> None:
+        """在当前事件循环中启动后台写盘任务"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def append(self, session_id: str, kind: str, payload: Dict[str, Any]) -> None:
+        """追加一个会话事件 (非阻塞，O(1))"""
+        if kind == "append":
+            message = {k: v for k, v in payload["message"].items() if k not in TRANSIENT_FIELDS}
+            payload = {**payload, "message": message}
+        self._pending.append((session_id, kind, json.dumps(payload, ensure_ascii=False, default=str), time.time()))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.flush_interval)  # 组提交: 合并刷新窗口内的事件
+            self._wakeup.clear()
+            await asyncio.to_thread(self._flush)
+            if self.retention is not None and time.monotonic() - self._last_sweep >= self.sweep_interval:
+                self._last_sweep = time.monotonic()
+                await asyncio.to_thread(self.purge_expired)
+
+    def _flush(self) -> None:
+        """把队列中的事件在一个事务中写入数据库"""
+        with self._lock:
+            if not self._pending:
+                return
+            batch = [self._pending.popleft() for _ in range(len(self._pending))]
+            # 被清空的会话: 删除其已写入的事件，并丢弃本批中 clear 及之前的事件
+            last_clear = {event[0]: i for i, event in enumerate(batch) if event[1] == "clear"}
+            rows = [event for i, event in enumerate(batch) if i > last_clear.get(event[0], -1)]
+            try:
+                with self._conn:
+                    self._conn.executemany("DELETE FROM events WHERE session_id = ?",
+                                           [(session_id,) for session_id in last_clear])
+                    self._conn.executemany(
+                        "INSERT INTO events (session_id, kind, payload, created_at) VALUES (?, ?, ?, ?)", rows)
+                self.written += len(batch)
+            except sqlite3.Error as e:
+                self.failed += len(batch)
+                print(f"写入会话存储失败 ({len(batch)} 个事件): {e}")
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """读取并回放会话的事件；会话不存在时返回 None"""
+        self._flush()  # 先写入尚在队列中的事件 (例如会话被淘汰后很快重连)
+        with self._lock:
+            rows = self._conn.execute("SELECT id, kind, payload FROM events WHERE session_id = ? ORDER BY id",
+                                      (session_id,)).fetchall()
+            if not rows:
+                return None
+            state = replay_events([(kind, json.loads(payload)) for _, kind, payload in rows])
+            if len(rows) >= self.snapshot_min_events and len(rows) > 2 * len(state["messages"]):
+                self._write_snapshot(session_id, rows[-1][0], state)
+        return state
+
+    def purge_expired(self) -> int:
+        """删除超过 retention 秒没有新事件的会话，返回删除的会话数"""
+        if self.retention is None:
+            return 0
+        cutoff = time.time() - self.retention
+        with self._lock:
+            try:
+                with self._conn:
+                    expired = [row[0] for row in self._conn.execute(
+                        "SELECT session_id FROM events GROUP BY session_id HAVING MAX(created_at) < ?", (cutoff,))]
+                    self._conn.executemany("DELETE FROM events WHERE session_id = ?",
+                                           [(session_id,) for session_id in expired])
+            except sqlite3.Error as e:
+                print(f"清理过期会话失败: {e}")
+                return 0
+        if expired:
+            self.purged_sessions += len(expired)
+            print(f"从会话存储中删除 {len(expired)} 个超过保留时间的会话")
+        return len(expired)
+
+    def _write_snapshot(self, session_id: str, last_id: int, state: Dict[str, Any]) -> None:
+        """用当前状态的快照替换 last_id 及之前的事件 (调用方持有锁)"""
+        payload = json.dumps({"messages": state["messages"], "system_summary": state["system_summary"],
+                              "tool_context": state["tool_context"]}, ensure_ascii=False, default=str)
+        try:
+            with self._conn:
+                self._conn.execute("DELETE FROM events WHERE session_id = ? AND id <= ?", (session_id, last_id))
+                self._conn.execute("INSERT INTO events (id, session_id, kind, payload, created_at) VALUES (?, ?, 'snapshot', ?, ?)",
+                                   (last_id, session_id, payload, time.time()))
+        except sqlite3.Error as e:
+            print(f"写入会话 {session_id} 的快照失败: {e}")
+
+    async def close(self) -> None:
+        """写完队列中剩余的事件并关闭数据库"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self._flush)
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"queued": len(self._pending), "written": self.written, "failed": self.failed,
+                "purged_sessions": self.purged_sessions}
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from utils.textUtils import tokenize
+
+# 句子切分: 中文句末标点、英文句末标点 (句点需后接空白，避免切开小数和 URL)、换行；句末换行保留在句子中
+_SENTENCE_RE = re.compile(r"(?:[^。！？；!?;.\n]|\.(?!\s))+(?:[。！？；!?;]|\.(?=\s))?\s*")
+_MAX_SENTENCES = 300  # TextRank 相似度矩阵为 O(n²)，更长的文本只对前面的句子排序
+
+
+def _terms(text: str) -> List[str]:
+    """用于判断 "是否被引用" 的词: 有多字词时只用多字词 (中文单字太容易偶然出现)"""
+    tokens = tokenize(text)
+    multi = [token for token in tokens if len(token) > 1]
+    return multi or tokens
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    """消息中可被后续引用的文本 (内容 + 工具调用参数)"""
+    text = str(message.get("content") or "")
+    if message.get("tool_calls"):
+        text += " " + json.dumps(message["tool_calls"], ensure_ascii=False)
+    return text
+
+
+def content_hash(content: Any) -> str:
+    return hashlib.sha256(str(content).strip().encode("utf-8")).hexdigest()[:16]
+
+
+def find_redundant(messages: List[Dict[str, Any]], pinned: Set[int],
+                   prefix_contents: Iterable[str]) -> Tuple[List[int], Dict[int, str]]:
+    """找出冗余消息，返回 (可移除的下标, 下标 -> 替换内容)
+
+    - 与固定前缀重复、或在历史中重复出现的系统提示: 只保留最后一次
+    - 内容相同的工具结果: 保留最后一次，之前的替换为引用 (工具结果需与工具调用成对，不能移除)
+    """
+    removable: List[int] = []
+    replacements: Dict[int, str] = {}
+    prefix = {content_hash(content) for content in prefix_contents}
+    last_system: Dict[str, int] = {}
+    last_tool: Dict[str, int] = {}
+    for i, msg in enumerate(messages):
+        if msg.get("role") == "system":
+            last_system[content_hash(msg.get("content"))] = i
+        elif msg.get("role") == "tool" and len(str(msg.get("content") or "")) > 200:
+            last_tool[content_hash(msg.get("content"))] = i
+    for i, msg in enumerate(messages):
+        if i in pinned:
+            continue
+        digest = content_hash(msg.get("content"))
+        if msg.get("role") == "system" and (digest in prefix or last_system.get(digest) != i):
+            removable.append(i)
+        elif msg.get("role") == "tool" and digest in last_tool and last_tool[digest] != i:
+            later = messages[last_tool[digest]]
+            replacements[i] = f"（与后面 tool_call_id={later.get('tool_call_id')} 的工具结果相同，已省略）"
+    return removable, replacements
+
+
+def _is_referenced(value: str, later_terms: Counter) -> bool:
+    terms = _terms(value)
+    return bool(terms) and all(later_terms[term] > 0 for term in terms)
+
+
+def trim_json(value: Any, later_terms: Counter, depth: int = 0) -> Any:
+    """只保留后续对话中引用过的字段 (字段名或短的字段值出现在后续消息中)，未引用的子树返回 None"""
+    if isinstance(value, dict):
+        kept = {}
+        for key, item in value.items():
+            if _is_referenced(str(key), later_terms) and depth < 8:
+                kept[key] = item if not isinstance(item, (dict, list)) else (trim_json(item, later_terms, depth + 1) or item)
+                continue
+            trimmed = trim_json(item, later_terms, depth + 1)
+            if trimmed is not None:
+                kept[key] = trimmed
+        return kept or None
+    if isinstance(value, list):
+        kept_items = [trimmed for trimmed in (trim_json(item, later_terms, depth + 1) for item in value)
+                      if trimmed is not None]
+        return kept_items or None
+    if isinstance(value, str) and len(value) > 80:
+        return None  # 长文本值只在字段名被引用时保留
+    return value if _is_referenced(str(value), later_terms) else None
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in _SENTENCE_RE.findall(text) if sentence.strip()]
+
+
+def textrank(sentences: List[str], iterations: int = 30, damping: float = 0.85) -> List[Tuple[float, float]]:
+    """TextRank 句子打分: 句子为节点，按词重叠 (中文单字 + 双字、英文单词) 归一化的相似度为边权
+
+    返回每个句子的 (TextRank 分数, 加权度数)；对称的句子团内分数相同，用加权度数区分与更多内容相关的句子。
+    """
+    term_sets = [set(tokenize(sentence)) for sentence in sentences]
+    n = len(sentences)
+    neighbors: List[List[Tuple[int, float]]] = [[] for _ in range(n)]
+    for i in range(n):
+        if len(term_sets[i]) < 2:
+            continue
+        for j in range(i + 1, n):
+            if len(term_sets[j]) < 2:
+                continue
+            overlap = len(term_sets[i] & term_sets[j])
+            if overlap:
+                weight = overlap / (len(term_sets[i]) + len(term_sets[j]))
+                neighbors[i].append((j, weight))
+                neighbors[j].append((i, weight))
+    degree = [sum(weight for _, weight in edges) for edges in neighbors]
+    out_weight = [d or 1.0 for d in degree]
+    scores = [1.0] * n
+    for _ in range(iterations):
+        scores = [(1 - damping) + damping * sum(scores[j] * weight / out_weight[j] for j, weight in neighbors[i])
+                  for i in range(n)]
+    return [(round(score, 6), d) for score, d in zip(scores, degree)]
+
+
+def extract_key_sentences(text: str, ratio: float = 0.3, keep_marker: str = "ref=") -> Optional[str]:
+    """按 TextRank 选出约 ratio 比例 (按字符) 的关键句，保持原文顺序；包含 keep_marker 的句子总是保留"""
+    sentences = split_sentences(text)
+    if len(sentences) < 4:
+        return None
+    ranked_part = sentences[:_MAX_SENTENCES]
+    scores = textrank(ranked_part)
+    target = int(len(text) * ratio)
+    chosen = {i for i, sentence in enumerate(ranked_part) if keep_marker and keep_marker in sentence}
+    used = sum(len(ranked_part[i]) for i in chosen)
+    for i in sorted(range(len(ranked_part)), key=lambda i: scores[i], reverse=True):
+        if used >= target:
+            break
+        if i not in chosen:
+            chosen.add(i)
+            used += len(ranked_part[i])
+    return "".join(ranked_part[i] for i in sorted(chosen)).strip()
+
+
+def compress_content(message: Dict[str, Any], later_terms: Counter, min_chars: int = 1500,
+                     ratio: float = 0.3) -> Optional[str]:
+    """对单条消息做抽取式压缩，返回新内容；无法明显缩短时返回 None"""
+    content = message.get("content")
+    if not isinstance(content, str) or len(content) < min_chars or message.get("role") == "system":
+        return None
+    compressed = None
+    if message.get("role") == "tool":
+        try:
+            data = json.loads(content)
+        except ValueError:
+            data = None
+        if isinstance(data, (dict, list)):
+            trimmed = trim_json(data, later_terms)
+            compressed = json.dumps(trimmed, ensure_ascii=False) + "\n（已省略后续对话未引用的字段）" if trimmed is not None \
+                else "（JSON 工具结果中的字段均未在后续对话中引用，已省略）"
+    if compressed is None:
+        extracted = extract_key_sentences(content, ratio)
+        if extracted:
+            compressed = f"{extracted}\n（抽取式摘要，原文 {len(content)} 字）"
+    if compressed is None or len(compressed) > len(content) * 0.8:
+        return None
+    return compressed
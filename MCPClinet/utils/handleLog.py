@@ -1,6 +1,11 @@
 from tabulate import tabulate
+import asyncio
 import datetime
+import hashlib
 import json
+import os
+import time
+from utils.metrics import WS_SEND_SECONDS
 def log_llm_summary(response: dict):
     def ns_to_ms(ns):
         return round(ns / 1_000_000, 2)
@@ -30,24 +35,127 @@ def log_tool_info(tool_name,tool_args,tool_content):
     
     
     
-async def log_tool_info_websocket(tool_name, tool_args, tool_content, websocket):
-    # 1. 写入日志文件
-    with open("log/tool_output.log", "a", encoding="utf-8") as f:
-        f.write(
-            f"[{datetime.datetime.now()}],工具名:{tool_name},工具参数:{tool_args},执行结果: {tool_content}\n\n"
-        )
+class ToolLogSink:
+    """后台 JSONL 日志写入器：记录先进入有界队列，由后台任务批量写盘，并按大小或日期轮转文件
+
+    队列满时丢弃记录并计入 dropped，不阻塞调用方。
+    """
+    def __init__(self, path="log/tool_output.jsonl", max_queue=10000, batch_size=200,
+                 flush_interval=0.5, max_file_bytes=50 * 1024 * 1024, rotate_daily=True):
+        self.path = path
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_file_bytes = max_file_bytes
+        self.rotate_daily = rotate_daily
+        self.dropped = 0  # 队列满时被丢弃的记录数
+        self.written = 0
+        self._queue = None
+        self._task = None
+        self._file_date = None
+
+    def start(self):
+        """在当前事件循环中启动后台写入任务"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+
+    def emit(self, record):
+        """提交一条记录 (非阻塞)"""
+        if self._task is None or self._task.done():
+            self.start()
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # 组提交: 在一个刷新窗口内尽量凑满一批再写盘
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._write(batch)
+
+    async def _write(self, batch):
+        lines = "".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in batch)
+        try:
+            await asyncio.to_thread(self._append, lines)
+            self.written += len(batch)
+        except Exception as e:
+            print(f"写入工具日志失败: {e}")
+
+    def _append(self, lines):
+        """在线程中执行: 必要时轮转文件，然后追加写入"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        today = datetime.date.today()
+        if os.path.exists(self.path):
+            if self._file_date is None:
+                # 之前运行留下的文件按其最后写入日期判断是否需要轮转
+                self._file_date = datetime.date.fromtimestamp(os.path.getmtime(self.path))
+            too_large = os.path.getsize(self.path) >= self.max_file_bytes
+            new_day = self.rotate_daily and self._file_date != today
+            if too_large or new_day:
+                os.replace(self.path, f"{self.path}.{datetime.datetime.now():%Y%m%d-%H%M%S}")
+        self._file_date = today
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    async def close(self):
+        """写完队列中剩余的记录并停止后台任务"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        remaining = []
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+        if remaining:
+            await self._write(remaining)
+        self._task = None
+
+    def stats(self):
+        return {"queued": self._queue.qsize() if self._queue else 0, "written": self.written, "dropped": self.dropped}
+
+
+tool_log_sink = ToolLogSink()  # 全局工具日志写入器
+
+
+async def log_tool_info_websocket(tool_name, tool_args, tool_content, websocket, session_id=None, latency=None):
+    # 1. 提交结构化日志记录 (只记录结果大小和哈希，不记录完整内容)
+    content_bytes = str(tool_content).encode("utf-8")
+    tool_log_sink.emit({
+        "ts": datetime.datetime.now().isoformat(),
+        "session": session_id,
+        "tool": tool_name,
+        "args": tool_args,
+        "latency_ms": round(latency * 1000, 1) if latency is not None else None,
+        "result_size": len(content_bytes),
+        "result_sha256": hashlib.sha256(content_bytes).hexdigest(),
+    })
 
     # 2. 简要信息（用于控制台和 WebSocket）
     summary = (tool_content[:50] + '...') if len(tool_content) > 50 else tool_content
-    print(f"工具执行结果为: {summary}（完整结果已记录到日志）\n")
+    print(f"工具执行结果为: {summary}（结果摘要已记录到日志）\n")
 
     # 3. WebSocket 推送
-    await websocket.send(json.dumps({
-        "type": "tool_result",
-        "tool_name": tool_name,
-        "tool_args": tool_args,
-        "tool_result": summary
-    }))
+    with WS_SEND_SECONDS.time():
+        await websocket.send(json.dumps({
+            "type": "tool_result",
+            "tool_name": tool_name,
+            "tool_args": tool_args,
+            "tool_result": summary
+        }))
     
 def outputTokenInfo(response):
     response_json = response.json()  # 使用json()方法直接获取JSON数据
@@ -58,4 +166,38 @@ def outputTokenInfo(response):
     ct = usage.get('completion_tokens')
     tt = usage.get('total_tokens')
     cache = usage.get('prompt_tokens_details', {}).get('cached_tokens')
-    print(f"[Token]  total: {tt}, prompt: {pt}, completion: {ct}, cached: {cache}")
\ No newline at end of file
+    print(f"[Token]  total: {tt}, prompt: {pt}, completion: {ct}, cached: {cache}")
+
+
+def log_prompt_cache_usage(usage, session_ratio=None):
+    """输出单次 LLM 调用的 token 用量与前缀缓存命中率"""
+    pt = usage.get('prompt_tokens') or 0
+    ct = usage.get('completion_tokens')
+    cache = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+    ratio = cache / pt if pt else 0.0
+    line = f"[Token]  prompt: {pt}, completion: {ct}, cached: {cache}, 缓存命中率: {ratio:.1%}"
+    if session_ratio is not None:
+        line += f", 会话累计命中率: {session_ratio:.1%}"
+    print(line)
+
+
+def current_rss_mb():
+    """返回当前进程的内存占用 (MB)，无法获取时返回 None"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:  # 第二列为常驻内存页数
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def log_startup_resources(label, start_time):
+    """输出启动耗时和内存占用"""
+    rss = current_rss_mb()
+    rss_text = f"{rss:.1f} MB" if rss is not None else "未知"
+    print(f"[启动] {label}: 耗时 {time.perf_counter() - start_time:.2f}s, 内存占用 {rss_text}")
@@ -2,6 +2,8 @@ import json
 from collections import defaultdict
 from typing import List, Dict, Tuple, Union
 import requests
+from utils.wsCoalescer import WebSocketCoalescer
+from utils.sseDecoder import SSEDecoder, loads as fast_loads
 def parse_stream_response(
     stream_data: List[Dict]
 ) -> Tuple[str, List[Dict[str, Union[str, Dict]]]]:
@@ -119,7 +121,44 @@ from collections import defaultdict
 from typing import List, Dict, Tuple, Union
 import json
 
-async def parse_stream_response_websocket(websocket, stream_iterator, is_new_reasoning_phase: bool = True):
+
+class JsonObjectTracker:
+    """增量跟踪参数 JSON 的括号深度 (跳过字符串内的括号和转义)，每个片段只扫描一次
+
+    顶层括号闭合后 closed 为 True，此时再拼接并解析参数，不必在每个片段到达时重复解析整个缓冲区。
+    """
+    __slots__ = ("depth", "in_string", "escaped", "closed")
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.closed = False
+
+    def feed(self, fragment: str) -> bool:
+        """读入一个参数片段，返回顶层 JSON 是否已经闭合"""
+        for ch in fragment:
+            if self.closed:
+                break
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]" and self.depth > 0:
+                self.depth -= 1
+                self.closed = self.depth == 0
+        return self.closed
+
+
+async def parse_stream_response_websocket(websocket, stream_iterator, is_new_reasoning_phase: bool = True, on_tool_call_ready=None,
+                                          usage: dict = None, coalescer: WebSocketCoalescer = None, can_dispatch_early=None):
     """
     解析 OpenAI 流式响应，提取自然语言回复与工具调用信息，同时实时推送内容到前端。
     
@@ -129,6 +168,11 @@ async def parse_stream_response_websocket(websocket, stream_iterator, is_new_rea
         is_new_reasoning_phase (bool): 指示当前处理的流是否为一个新的主要思考阶段的开始。
                                      例如，对用户新查询的初步思考，或在工具调用返回结果后的再次思考。
                                      默认为 True。
+        on_tool_call_ready: 可选回调，某个工具调用的参数 JSON 生成完毕（可完整解析，或下一个 index 已开始）时立即调用，
+                            参数为 {"tool_call_id", "tool_name", "tool_args"}，用于在流结束前提前派发工具调用。
+        can_dispatch_early: 可选，参数为工具名，返回该工具是否允许提前派发；不允许的工具不会为提前派发拼接和解析参数。
+        usage (dict): 可选，流中出现 usage 数据块时写入其内容 (需请求 stream_options.include_usage)。
+        coalescer (WebSocketCoalescer): 可选，推送内容用的合并器，未提供时按默认参数创建；函数返回前会发送完缓冲的内容。
                                      
     返回：
         Tuple[str, List[Dict], List[Dict]]: 
@@ -149,79 +193,112 @@ async def parse_stream_response_websocket(websocket, stream_iterator, is_new_rea
     # `sent_first_reasoning_chunk_in_this_phase` 用于确保只在该阶段的第一个推理信息块上标记 newStep=true
     sent_first_reasoning_chunk_in_this_phase = False
 
-    async for chunk in stream_iterator:
+    argument_parts = defaultdict(list) # 工具调用参数片段，按 index 收集，需要时再拼接
+    argument_trackers = defaultdict(JsonObjectTracker) # 每个工具调用参数的括号深度，闭合时参数已生成完毕
+    attempted_indices = set() # 已尝试过提前派发的工具调用 index (参数只拼接、解析一次)
+
+    def join_arguments(index):
+        arguments = "".join(argument_parts[index])
+        tool_calls_data[index]["function"]["arguments"] = arguments
+        argument_parts[index] = [arguments] if arguments else []
+        return arguments
+
+    def try_dispatch(index):
+        """参数 JSON 完整时提前派发该工具调用；每个工具调用最多尝试一次"""
+        if index in attempted_indices:
+            return
+        tool_info = tool_calls_data[index]
+        func_info = tool_info["function"]
+        if not tool_info.get("id") or not func_info.get("name"):
+            return
+        attempted_indices.add(index)
+        if can_dispatch_early is not None and not can_dispatch_early(func_info["name"]):
+            return
+        arguments = join_arguments(index)
         try:
-            text = chunk.decode('utf-8')
-            # print(f"Raw chunk text: {text}") # 用于调试
-            for line in text.split('\n'):
-                if line.startswith('data: ') and not line.startswith('data: [DONE]'):
-                    json_str = line[6:]
-                    try:
-                        part = json.loads(json_str)
-                        # print(f"Parsed part: {part}") # 用于调试
-                        
-                        delta = part['choices'][0].get("delta", {})
-                        
-                        # --- 处理 reasoning_content ---
-                        if "reasoning_content" in delta and isinstance(delta["reasoning_content"], str) and delta["reasoning_content"].strip():
-                            send_as_new_step = False
-                            if is_new_reasoning_phase and not sent_first_reasoning_chunk_in_this_phase:
-                                send_as_new_step = True
-                                sent_first_reasoning_chunk_in_this_phase = True # 标记已发送此阶段的第一个块
-                            
-                            await websocket.send(json.dumps({
-                                "type": "reasoning",
-                                "content": delta["reasoning_content"],
-                                "newStep": send_as_new_step # 向前端传递 newStep 标记
-                            }))
-                        
-                        # --- 处理自然语言内容 ---
-                        if "content" in delta and isinstance(delta["content"], str) and delta["content"].strip():
-                            content_parts.append(delta["content"])
-                            await websocket.send(json.dumps({
-                                "type": "content",
-                                "content": delta["content"]
-                                # "newStep" 通常不用于最终内容块，主要用于 reasoning
-                            }))
-                        
-                        # --- 收集工具调用内容 ---
-                        if "tool_calls" in delta:
-                            # 如果在工具调用信息出现之前已经有思考内容，那么这个思考内容属于上一个步骤。
-                            # 工具调用本身，以及之后的思考，将构成新的步骤（由调用者通过新的 is_new_reasoning_phase=True 来发起）
-                            for tool_call_delta in delta["tool_calls"]:
-                                index = tool_call_delta.get("index")
-                                if index is None: # 对于OpenAI的格式，index 应该是存在的
-                                    # logger.warning("Tool call delta missing index.")
-                                    print("Tool call delta missing index.")
-                                    continue
-                                
-                                # 确保 tool_calls_data[index] 被正确初始化 (defaultdict 会处理)
-                                # 更新 ID (通常只在第一个 delta 中出现)
-                                if "id" in tool_call_delta and tool_call_delta["id"]:
-                                    tool_calls_data[index]["id"] = tool_call_delta["id"]
-                                
-                                # 更新类型 (通常也只在第一个 delta 中出现)
-                                if "type" in tool_call_delta and tool_call_delta["type"]:
-                                     tool_calls_data[index]["type"] = tool_call_delta["type"]
-
-                                func_delta = tool_call_delta.get("function", {})
-                                if "name" in func_delta and isinstance(func_delta["name"], str):
-                                    tool_calls_data[index]["function"]["name"] += func_delta["name"]
-                                if "arguments" in func_delta and isinstance(func_delta["arguments"], str):
-                                    tool_calls_data[index]["function"]["arguments"] += func_delta["arguments"]
-                                    
-                    except json.JSONDecodeError:
-                        # logger.warning(f"Invalid JSON in stream line: {json_str}")
-                        print(f"Invalid JSON in stream line: {json_str}")
-                        pass # 忽略无效的 JSON 数据
-        except Exception as e:
-            # logger.error(f"Error processing stream chunk: {e}", exc_info=True)
-            print(f"解析流数据时出错: {e}")
-    
+            args = fast_loads(arguments) if arguments.strip() else {}
+        except ValueError:
+            return
+        if not isinstance(args, dict):
+            return
+        on_tool_call_ready({
+            "tool_call_id": tool_info["id"],
+            "tool_name": func_info["name"],
+            "tool_args": args
+        })
+
+    if coalescer is None:
+        coalescer = WebSocketCoalescer(websocket)
+
+    decoder = SSEDecoder() # 按字节缓冲分帧，数据块边界截断的行不会丢失
+    try:
+        async for part in decoder.aiter_events(stream_iterator):
+            try:
+                if usage is not None and part.get("usage"):
+                    usage.update(part["usage"])
+                if not part.get("choices"):
+                    continue # usage 数据块的 choices 为空
+
+                delta = part['choices'][0].get("delta") or {}
+
+                # --- 处理 reasoning_content ---
+                if "reasoning_content" in delta and isinstance(delta["reasoning_content"], str) and delta["reasoning_content"].strip():
+                    send_as_new_step = False
+                    if is_new_reasoning_phase and not sent_first_reasoning_chunk_in_this_phase:
+                        send_as_new_step = True
+                        sent_first_reasoning_chunk_in_this_phase = True # 标记已发送此阶段的第一个块
+
+                    await coalescer.push("reasoning", delta["reasoning_content"],
+                                         newStep=send_as_new_step) # 向前端传递 newStep 标记
+
+                # --- 处理自然语言内容 ---
+                if "content" in delta and isinstance(delta["content"], str) and delta["content"].strip():
+                    content_parts.append(delta["content"])
+                    await coalescer.push("content", delta["content"])
+
+                # --- 收集工具调用内容 ---
+                if delta.get("tool_calls"):
+                    # 如果在工具调用信息出现之前已经有思考内容，那么这个思考内容属于上一个步骤。
+                    # 工具调用本身，以及之后的思考，将构成新的步骤（由调用者通过新的 is_new_reasoning_phase=True 来发起）
+                    for tool_call_delta in delta["tool_calls"]:
+                        index = tool_call_delta.get("index")
+                        if index is None: # 对于OpenAI的格式，index 应该是存在的
+                            print("Tool call delta missing index.")
+                            continue
+
+                        # 更新 ID 和类型 (通常只在第一个 delta 中出现)
+                        if tool_call_delta.get("id"):
+                            tool_calls_data[index]["id"] = tool_call_delta["id"]
+                        if tool_call_delta.get("type"):
+                            tool_calls_data[index]["type"] = tool_call_delta["type"]
+
+                        func_delta = tool_call_delta.get("function") or {}
+                        if isinstance(func_delta.get("name"), str):
+                            tool_calls_data[index]["function"]["name"] += func_delta["name"]
+                        fragment = func_delta.get("arguments")
+                        if isinstance(fragment, str):
+                            argument_parts[index].append(fragment)
+
+                        if on_tool_call_ready is not None:
+                            # 新的 index 开始，说明之前的工具调用参数已生成完毕
+                            for prev_index in list(tool_calls_data.keys()):
+                                if prev_index < index:
+                                    try_dispatch(prev_index)
+                            # 参数的顶层括号闭合时说明参数已完整，只在此时解析一次
+                            if isinstance(fragment, str) and index not in attempted_indices \
+                                    and argument_trackers[index].feed(fragment):
+                                try_dispatch(index)
+            except Exception as e:
+                print(f"解析流数据时出错: {e}")
+
+    finally:
+        await coalescer.close() # 发送缓冲中剩余的内容
+
     response_text = ''.join(content_parts)
     
     tool_calls_info_list = []
     for index in sorted(tool_calls_data.keys()):
+        join_arguments(index)
         # 确保在流结束后，数据是完整的
         tool_info = tool_calls_data[index]
         func_info = tool_info["function"]
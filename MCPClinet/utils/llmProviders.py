@@ -0,0 +1,118 @@
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from dotenv import dotenv_values
+
+ALIYUN_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
+
+
+def is_retryable_status(status_code: int) -> bool:
+    """408 (超时)、429 (限流) 和 5xx 可以换接口重试；其余 4xx 是请求本身的问题，换接口也会失败"""
+    return status_code in (408, 429) or status_code >= 500
+
+
+def is_content_event(event: Any) -> bool:
+    """流式响应事件是否包含模型生成的内容 (正文、推理内容或工具调用)，用于测量首 token 延迟"""
+    try:
+        delta = event["choices"][0].get("delta") or {}
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return False
+    return bool(delta.get("content") or delta.get("reasoning_content") or delta.get("tool_calls"))
+
+
+class LLMProvider:
+    """一个 OpenAI 兼容的 LLM 接口，以及它的首 token 延迟 (TTFT) 和错误率统计"""
+    def __init__(self, name: str, model: str, base_url: str, api_key: str, context_window: int = 16000):
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.api_key = api_key
+        self.context_window = context_window
+        self.is_aliyun = base_url == ALIYUN_BASE_URL
+
+        self.ttft_ewma: Optional[float] = None  # 首 token 延迟的指数滑动平均 (秒)
+        self.error_ewma = 0.0  # 错误率的指数滑动平均
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.hedge_wins = 0
+
+    def record_success(self, ttft: float, alpha: float = 0.3) -> None:
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.ttft_ewma = ttft if self.ttft_ewma is None else alpha * ttft + (1 - alpha) * self.ttft_ewma
+        self.error_ewma = (1 - alpha) * self.error_ewma
+
+    def record_failure(self, alpha: float = 0.3, max_failures: int = 3, cooldown: float = 30) -> None:
+        self.requests += 1
+        self.errors += 1
+        self.consecutive_failures += 1
+        self.error_ewma = alpha + (1 - alpha) * self.error_ewma
+        if self.consecutive_failures >= max_failures:
+            self.cooldown_until = time.monotonic() + cooldown
+            print(f"LLM 接口 {self.name} 连续失败 {self.consecutive_failures} 次，冷却 {cooldown}s")
+
+    @property
+    def in_cooldown(self) -> bool:
+        return time.monotonic() < self.cooldown_until
+
+    def score(self, default_ttft: float = 1.0) -> float:
+        """分数越低越健康：TTFT 按错误率加权，冷却中的接口排到最后"""
+        ttft = self.ttft_ewma if self.ttft_ewma is not None else default_ttft
+        penalty = 1000.0 if self.in_cooldown else 0.0
+        return ttft * (1 + 4 * self.error_ewma) + penalty
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "model": self.model,
+            "ttft_ewma": round(self.ttft_ewma, 3) if self.ttft_ewma is not None else None,
+            "error_rate": round(self.error_ewma, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "hedge_wins": self.hedge_wins,
+            "cooldown": self.in_cooldown,
+        }
+
+
+def load_providers(env_files: List[str], primary: Optional[LLMProvider] = None) -> List[LLMProvider]:
+    """从多个 .env 文件加载 LLM 接口 (不修改进程环境变量)，按 model + base_url 去重"""
+    providers = [primary] if primary else []
+    seen = {(primary.model, primary.base_url)} if primary else set()
+    for env_file in env_files:
+        if not os.path.exists(env_file):
+            print(f"LLM 接口配置文件 {env_file} 不存在，已跳过")
+            continue
+        values = dotenv_values(env_file)
+        model, base_url = values.get("MODEL"), values.get("MODEL_BASE_URL")
+        if not model or not base_url or (model, base_url) in seen:
+            continue
+        seen.add((model, base_url))
+        providers.append(LLMProvider(
+            name=os.path.splitext(os.path.basename(env_file))[0],
+            model=model,
+            base_url=base_url,
+            api_key=values.get("MODEL_API_KEY", ""),
+            context_window=int(values.get("MODEL_API_OPTION_CONTEXTWINDOWS") or 16000),
+        ))
+    return providers
+
+
+class ProviderPool:
+    """LLM 接口池：按健康度排序选择接口"""
+    def __init__(self, providers: List[LLMProvider]):
+        self.providers = providers
+
+    def ranked(self) -> List[LLMProvider]:
+        """按分数从优到劣排序 (分数相同时保持配置顺序)"""
+        return sorted(self.providers, key=lambda provider: provider.score())
+
+    @property
+    def context_window(self) -> int:
+        """可安全使用的上下文窗口：请求可能因对冲或故障转移落到任一接口，取各接口窗口的最小值"""
+        return min(provider.context_window for provider in self.providers)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [provider.stats() for provider in self.providers]
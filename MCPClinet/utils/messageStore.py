@@ -0,0 +1,151 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+from utils.extractiveCompressor import message_text
+
+
+def _content_key(message: Dict[str, Any]) -> int:
+    return hash(str(message.get("content") or "").strip())
+
+
+def _message_bytes(message: Dict[str, Any]) -> int:
+    """消息内容和工具调用参数的 UTF-8 字节数"""
+    return len(message_text(message).encode("utf-8"))
+
+
+class MessageStore:
+    """带索引的消息历史：消息按稳定的 msg_id 保存，追加、按 id 移除、按角色查找均为 O(1)
+
+    - 消息按追加顺序保存在 dict 中 (msg_id -> 消息)，移除消息不需要移动其他消息或重算下标
+    - 角色索引: role -> {msg_id: 消息}，同样保持追加顺序
+    - 内容索引: 去除首尾空白后的内容哈希 -> msg_id 集合，用于按内容删除
+    - 关键消息集合: 被标记为关键的 msg_id
+    需要按位置访问时使用 as_list()，结果缓存到下一次修改为止。
+    """
+    def __init__(self):
+        self._messages: Dict[int, Dict[str, Any]] = {}
+        self._by_role: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        self._by_content: Dict[int, Set[int]] = {}
+        self.key_ids: Set[int] = set()
+        self.next_id = 0
+        self.content_bytes = 0  # 所有消息内容和工具调用参数的 UTF-8 字节数，用于估算会话占用的内存
+        self._list: Optional[List[Dict[str, Any]]] = None
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self._messages.values())
+
+    def __reversed__(self) -> Iterator[Dict[str, Any]]:
+        return reversed(self._messages.values())
+
+    def __contains__(self, msg_id: int) -> bool:
+        return msg_id in self._messages
+
+    def get(self, msg_id: int) -> Optional[Dict[str, Any]]:
+        return self._messages.get(msg_id)
+
+    def as_list(self) -> List[Dict[str, Any]]:
+        """按顺序返回消息列表 (只读，缓存到下一次修改)"""
+        if self._list is None:
+            self._list = list(self._messages.values())
+        return self._list
+
+    def append(self, message: Dict[str, Any]) -> int:
+        """追加消息并分配 msg_id (已带 msg_id 的消息沿用原 id，例如从持久化存储恢复)"""
+        msg_id = message.get("msg_id")
+        if msg_id is None:
+            msg_id = message["msg_id"] = self.next_id
+        self.next_id = max(self.next_id, msg_id + 1)
+        self._messages[msg_id] = message
+        self._by_role.setdefault(message.get("role", ""), {})[msg_id] = message
+        self._by_content.setdefault(_content_key(message), set()).add(msg_id)
+        if message.get("is_key"):
+            self.key_ids.add(msg_id)
+        self.content_bytes += _message_bytes(message)
+        self._list = None
+        return msg_id
+
+    def remove(self, msg_id: int) -> Optional[Dict[str, Any]]:
+        """按 id 移除消息，返回被移除的消息 (不存在时返回 None)"""
+        message = self._messages.pop(msg_id, None)
+        if message is None:
+            return None
+        role_index = self._by_role.get(message.get("role", ""))
+        if role_index is not None:
+            role_index.pop(msg_id, None)
+        content_key = _content_key(message)
+        same_content = self._by_content.get(content_key)
+        if same_content is not None:
+            same_content.discard(msg_id)
+            if not same_content:
+                del self._by_content[content_key]
+        self.key_ids.discard(msg_id)
+        self.content_bytes -= _message_bytes(message)
+        self._list = None
+        return message
+
+    def clear(self) -> None:
+        self._messages.clear()
+        self._by_role.clear()
+        self._by_content.clear()
+        self.key_ids.clear()
+        self.content_bytes = 0
+        self._list = None
+
+    def update_content(self, msg_id: int, content: str) -> Optional[Dict[str, Any]]:
+        """替换消息内容 (例如压缩后)，同步内容索引；返回被修改的消息"""
+        message = self._messages.get(msg_id)
+        if message is None:
+            return None
+        old_key = _content_key(message)
+        same_content = self._by_content.get(old_key)
+        if same_content is not None:
+            same_content.discard(msg_id)
+            if not same_content:
+                del self._by_content[old_key]
+        self.content_bytes -= _message_bytes(message)
+        message["content"] = content
+        self.content_bytes += _message_bytes(message)
+        self._by_content.setdefault(_content_key(message), set()).add(msg_id)
+        return message
+
+    def mark_key(self, msg_id: int) -> bool:
+        """标记关键消息，返回是否为新标记"""
+        message = self._messages.get(msg_id)
+        if message is None or msg_id in self.key_ids:
+            return False
+        message["is_key"] = True
+        self.key_ids.add(msg_id)
+        return True
+
+    def by_role(self, role: str) -> List[Dict[str, Any]]:
+        """某角色的全部消息 (按顺序)"""
+        return list(self._by_role.get(role, {}).values())
+
+    def last(self, role: str) -> Optional[Dict[str, Any]]:
+        """某角色最新的一条消息"""
+        role_index = self._by_role.get(role)
+        if not role_index:
+            return None
+        return role_index[next(reversed(role_index))]
+
+    def reversed_by_role(self, role: str) -> Iterable[Dict[str, Any]]:
+        """从新到旧遍历某角色的消息"""
+        return reversed(self._by_role.get(role, {}).values())
+
+    def find_by_content(self, content: str) -> List[int]:
+        """内容 (去除首尾空白后) 与 content 相同的消息 id"""
+        target = content.strip()
+        return [msg_id for msg_id in self._by_content.get(hash(target), ())
+                if str(self._messages[msg_id].get("content") or "").strip() == target]
+
+    def ids_since(self, msg_id: int) -> List[int]:
+        """id 不小于 msg_id 的消息 (即某个时间点之后追加的消息)，从最新的开始向前查找"""
+        result = []
+        for message in reversed(self._messages.values()):
+            if message["msg_id"] < msg_id:
+                break
+            result.append(message["msg_id"])
+        result.reverse()
+        return result
@@ -0,0 +1,124 @@
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Tuple
+
+# 默认的延迟分桶 (秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape_label_value(value: str) -> str:
+    """按 Prometheus 文本格式转义标签值：先转义反斜杠，再转义双引号和换行"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label_value(str(value))}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Prometheus 直方图 (按标签分组的累计分桶计数、总和与次数)"""
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {}  # 标签值 -> [各分桶计数..., sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """计时上下文：退出时记录耗时 (包括异常退出)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in self._series.items():
+            for i, bound in enumerate(self.buckets):
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {series[i]}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Prometheus 仪表：采集时调用回调函数取值
+
+    有标签时回调返回 {标签值 (单个或元组): 数值}
+    """
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Any], metric_type: str = "gauge",
+                 labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.metric_type = metric_type
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        try:
+            if self.labelnames:
+                samples = [((key if isinstance(key, tuple) else (key,)), float(value))
+                           for key, value in self.callback().items()]
+            else:
+                samples = [((), float(self.callback()))]
+        except Exception:
+            return []
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for key, value in samples:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，输出 Prometheus 文本格式"""
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        if name not in self._metrics:
+            self._metrics[name] = Histogram(name, documentation, labelnames, buckets)
+        return self._metrics[name]
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], Any], metric_type: str = "gauge",
+              labelnames: Tuple[str, ...] = ()) -> Gauge:
+        self._metrics[name] = Gauge(name, documentation, callback, metric_type, labelnames)
+        return self._metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()  # 全局指标注册表
+
+# --- 各环节的耗时直方图 ---
+LLM_CONNECT_SECONDS = registry.histogram("mcp_llm_connect_seconds", "LLM 请求发出到收到响应头的耗时", ("provider",))
+LLM_TTFT_SECONDS = registry.histogram("mcp_llm_ttft_seconds", "LLM 请求发出到收到第一个内容事件 (正文、推理内容或工具调用) 的耗时", ("provider",))
+LLM_STREAM_SECONDS = registry.histogram("mcp_llm_stream_seconds", "LLM 第一个内容事件到流结束的耗时", ("provider",))
+TOOL_CALL_SECONDS = registry.histogram("mcp_tool_call_seconds", "MCP 工具调用耗时", ("server", "tool"))
+OPTIMIZE_HISTORY_SECONDS = registry.histogram("mcp_optimize_history_seconds", "optimize_history 耗时")
+TOKEN_COUNT_SECONDS = registry.histogram("mcp_token_count_seconds", "单条消息分词计数耗时",
+                                         buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5))
+WS_SEND_SECONDS = registry.histogram("mcp_ws_send_seconds", "WebSocket 单次发送耗时",
+                                     buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
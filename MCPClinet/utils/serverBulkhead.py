@@ -0,0 +1,120 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+
+class BulkheadRejected(Exception):
+    """调用被舱壁拒绝 (熔断中或等待队列已满)，不会发送到服务器"""
+
+
+class ServerBulkhead:
+    """单个 MCP 服务器的舱壁：并发上限 + 有界等待队列 + 熔断器
+
+    - 同时最多 max_concurrency 个调用发往服务器，其余排队；排队数超过 max_queue 时立即拒绝
+    - 连续 failure_threshold 次超时或传输层错误后熔断 (open)，cooldown 秒内直接拒绝
+    - 冷却结束后进入半开 (half_open)，只放行一个探测调用：成功则恢复，失败则重新熔断
+    工具自身返回的错误 (isError) 说明服务器仍在正常响应，不计入失败。
+    """
+    def __init__(self, server_name: str, max_concurrency: int = 4, max_queue: int = 32, timeout: float = 120,
+                 failure_threshold: int = 3, cooldown: float = 30):
+        self.server_name = server_name
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.timeout = timeout
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown = cooldown
+
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.waiting = 0  # 排队等待的调用数
+        self.in_flight = 0  # 正在执行的调用数
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self._probe_in_flight = False
+        self.rejected = 0
+        self.failures = 0
+
+    @classmethod
+    def from_config(cls, server_name: str, config: Optional[Dict[str, Any]], **defaults) -> "ServerBulkhead":
+        """按服务器配置中的 "bulkhead" 字段创建，未配置的参数使用 defaults"""
+        options = {**defaults, **(config or {})}
+        return cls(server_name, **{key: options[key] for key in
+                                   ("max_concurrency", "max_queue", "timeout", "failure_threshold", "cooldown")
+                                   if key in options})
+
+    def _check_breaker(self) -> bool:
+        """返回本次调用是否为半开状态下的探测调用；熔断中则抛出 BulkheadRejected"""
+        if self.state == "open":
+            remaining = self.opened_until - time.monotonic()
+            if remaining > 0:
+                raise BulkheadRejected(f"服务器 {self.server_name} 连续失败已熔断，约 {max(1, round(remaining))}s 后重试")
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                raise BulkheadRejected(f"服务器 {self.server_name} 正在恢复中，请稍后重试")
+            self._probe_in_flight = True
+            return True
+        return False
+
+    @asynccontextmanager
+    async def slot(self, timeout: Optional[float] = None):
+        """占用一个并发名额 (必要时排队，最多等待 timeout 秒)；被拒绝或排队超时时抛出 BulkheadRejected
+
+        排队超时只说明服务器繁忙，不计入熔断器的失败次数
+        """
+        try:
+            probe = self._check_breaker()
+            if self._semaphore.locked() and self.waiting >= self.max_queue:
+                if probe:
+                    self._probe_in_flight = False
+                raise BulkheadRejected(f"服务器 {self.server_name} 繁忙 (排队 {self.waiting} 个调用)，请稍后重试")
+        except BulkheadRejected:
+            self.rejected += 1
+            raise
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        except BaseException as e:
+            if probe:
+                self._probe_in_flight = False
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise BulkheadRejected(f"服务器 {self.server_name} 繁忙 (排队超过 {timeout}s)，请稍后重试") from None
+            raise
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+            if probe:
+                self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            print(f"服务器 {self.server_name} 已恢复，关闭熔断")
+        self.state = "closed"
+        self.consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_until = time.monotonic() + self.cooldown
+            print(f"服务器 {self.server_name} 连续失败 {self.consecutive_failures} 次，熔断 {self.cooldown}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "failures": self.failures,
+        }
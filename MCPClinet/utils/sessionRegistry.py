@@ -0,0 +1,121 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from utils.TokenAndConversation import ConversationManager
+
+
+class ConversationSession:
+    """单个会话：拥有独立的对话管理器和轮次锁"""
+    def __init__(self, session_id: str, conversation_manager: ConversationManager):
+        self.session_id = session_id
+        self.conversation_manager = conversation_manager
+        self.turn_lock = asyncio.Lock()  # 同一会话内的轮次串行执行
+        self.connections = 0  # 当前绑定到此会话的 WebSocket 连接数
+        self.restored = False  # 是否已尝试从持久化存储恢复历史
+        self.last_active = time.monotonic()
+
+    def touch(self) -> None:
+        self.last_active = time.monotonic()
+
+    @property
+    def is_idle(self) -> bool:
+        return self.connections == 0 and not self.turn_lock.locked()
+
+    def estimate_size(self) -> int:
+        """粗略估算会话历史占用的字节数
+
+        消息内容和工具调用参数的 UTF-8 字节数由消息存储增量维护，另加摘要和工具上下文
+        """
+        conversation = self.conversation_manager
+        size = conversation.history.content_bytes
+        for extra in (conversation.system_summary, conversation.tool_context):
+            if extra:
+                size += len(json.dumps(extra, ensure_ascii=False, default=str).encode("utf-8"))
+        return size
+
+
+class SessionRegistry:
+    """会话注册表：按 session_id 管理对话，空闲会话在超出内存预算或超时后被淘汰"""
+    def __init__(self,
+                 conversation_factory: Callable[[str], ConversationManager],
+                 max_sessions: int = 200,
+                 max_total_bytes: int = 256 * 1024 * 1024,
+                 idle_ttl: float = 3600,
+                 sweep_interval: float = 60):
+        self._factory = conversation_factory
+        self._sessions: "OrderedDict[str, ConversationSession]" = OrderedDict()  # 按最近使用排序
+        self.max_sessions = max_sessions
+        self.max_total_bytes = max_total_bytes
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """在当前事件循环中启动定期淘汰任务，没有连接进出时空闲会话也会按时过期"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.evict_idle()
+
+    async def close(self) -> None:
+        """停止定期淘汰任务"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> Optional[ConversationSession]:
+        return self._sessions.get(session_id)
+
+    def acquire(self, session_id: Optional[str] = None) -> ConversationSession:
+        """获取（或创建）会话并登记一个连接；未提供 session_id 时生成新的"""
+        session_id = session_id or uuid.uuid4().hex
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = ConversationSession(session_id, self._factory(session_id))
+            self._sessions[session_id] = session
+            print(f"创建新会话 {session_id} (当前会话数: {len(self._sessions)})")
+        self._sessions.move_to_end(session_id)
+        session.connections += 1
+        session.touch()
+        self.evict_idle()
+        return session
+
+    def release(self, session: ConversationSession) -> None:
+        """连接断开时调用，会话保留以便重连，之后由淘汰策略回收"""
+        session.connections = max(0, session.connections - 1)
+        session.touch()
+        self.evict_idle()
+
+    def evict_idle(self) -> None:
+        """淘汰超时的空闲会话，并在超出会话数或内存预算时按 LRU 淘汰空闲会话"""
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if session.is_idle and now - session.last_active > self.idle_ttl:
+                self._evict(session_id, "空闲超时")
+
+        total_bytes = sum(session.estimate_size() for session in self._sessions.values())
+        for session_id, session in list(self._sessions.items()):  # 从最久未使用的开始
+            if len(self._sessions) <= self.max_sessions and total_bytes <= self.max_total_bytes:
+                break
+            if session.is_idle:
+                total_bytes -= session.estimate_size()
+                self._evict(session_id, "超出内存预算")
+
+    def _evict(self, session_id: str, reason: str) -> None:
+        session = self._sessions.pop(session_id)
+        session.conversation_manager.cancel_background_summary()
+        print(f"淘汰会话 {session_id} ({reason})")
@@ -0,0 +1,65 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from utils.toolResultCache import canonical_args
+
+
+class ToolSingleFlight:
+    """进行中工具调用的合并：(服务器, 工具, 规范化参数) 相同的并发调用共享同一次执行和结果
+
+    所有等待者都被取消时才取消底层调用；某个等待者被取消 (例如轮次中断) 不影响其他等待者。
+    只合并幂等的工具 (按需启用)：is_idempotent 判定为幂等的工具 (例如配置了缓存 TTL 的只读工具)，
+    以及服务器配置 "single_flight" 中列出的工具；"single_flight_exclude" 和缓存规则 invalidated_by 中的工具总是不合并。
+    其余工具 (执行命令、写入记忆等) 每次调用都单独执行。
+    """
+    def __init__(self, is_idempotent: Optional[Callable[[str, str], bool]] = None):
+        self._is_idempotent = is_idempotent or (lambda server_name, tool_name: False)
+        self._inflight: Dict[Tuple[str, str, str], asyncio.Task] = {}
+        self._waiters: Dict[Tuple[str, str, str], int] = {}
+        self._included: Dict[str, set] = {}
+        self._excluded: Dict[str, set] = {}
+        self.executions = 0
+        self.shared = 0
+
+    def configure_server(self, server_name: str, server_config: Optional[Dict[str, Any]]) -> None:
+        """登记某服务器额外参与合并和不参与合并的工具"""
+        server_config = server_config or {}
+        self._included[server_name] = set(server_config.get("single_flight", []))
+        excluded = set(server_config.get("single_flight_exclude", []))
+        excluded.update((server_config.get("cache") or {}).get("invalidated_by", []))
+        self._excluded[server_name] = excluded
+
+    def should_merge(self, server_name: str, tool_name: str) -> bool:
+        if tool_name in self._excluded.get(server_name, ()):
+            return False
+        return tool_name in self._included.get(server_name, ()) or self._is_idempotent(server_name, tool_name)
+
+    async def call(self, server_name: str, tool_name: str, args: Dict[str, Any],
+                   execute: Callable[[], Awaitable[Any]]) -> Any:
+        """执行 execute()，相同的调用正在进行时直接等待其结果"""
+        if not self.should_merge(server_name, tool_name):
+            return await execute()
+
+        key = (server_name, tool_name, canonical_args(args))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(execute())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._inflight.pop(k, None) if self._inflight.get(k) is t else None)
+            self.executions += 1
+        else:
+            self.shared += 1
+            print(f"合并进行中的相同工具调用: {server_name}.{tool_name}")
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                if not task.done():
+                    task.cancel()  # 最后一个等待者也离开了 (被取消)，不再需要结果
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._inflight), "executions": self.executions, "shared": self.shared}
@@ -0,0 +1,113 @@
+import json
+from typing import Any, AsyncIterator, List, Optional
+
+try:
+    import orjson  # 可选：更快的 JSON 解析
+    _loads = orjson.loads
+    _JSON_ERRORS = (orjson.JSONDecodeError, ValueError)
+except ImportError:
+    orjson = None
+    _loads = json.loads
+    _JSON_ERRORS = (json.JSONDecodeError, ValueError)
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data) -> Any:
+    """解析 JSON (bytes 或 str)，安装了 orjson 时使用 orjson"""
+    return _loads(data)
+
+
+class SSEDecoder:
+    """增量 SSE 解码器：按字节缓冲分帧，数据块在任意位置 (包括多字节字符中间) 被截断都能正确拼接
+
+    - 按行分帧 (兼容 \\r\\n)，空行结束一个事件，同一事件的多行 data 以 \\n 连接
+    - 忽略注释行 (以 ':' 开头) 以及 event / id / retry 字段
+    - 遇到 data: [DONE] 后停止输出事件
+    - 个别接口事件之间不输出空行：已缓冲的 data 行是完整 JSON 对象时，遇到下一个 data 行即输出
+    """
+    def __init__(self, json_loads=None):
+        self._loads = json_loads or _loads  # 默认优先使用 orjson
+        self._buffer = bytearray()
+        self._data_lines: List[bytes] = []
+        self.done = False
+        self.events = 0
+        self.invalid = 0
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        """送入一个原始数据块，返回其中已完整的事件 (解析后的 JSON 对象)"""
+        if self.done or not chunk:
+            return []
+        self._buffer += chunk
+        end = self._buffer.rfind(b"\n")
+        if end == -1:
+            return []
+        lines = bytes(self._buffer[:end]).split(b"\n")
+        del self._buffer[:end + 1]
+
+        events = []
+        for line in lines:
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if not line:
+                self._dispatch(events)
+                if self.done:
+                    break
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                if self._data_lines and self._pending_is_complete():
+                    self._dispatch(events)  # 事件之间缺少空行：上一个 data 已是完整 JSON，先输出
+                    if self.done:
+                        break
+                self._data_lines.append(value[1:] if value.startswith(b" ") else value)
+            # 注释行和其它字段忽略
+        return events
+
+    def flush(self) -> List[Any]:
+        """流结束时调用：处理缓冲中最后一个未以换行结尾的行和未结束的事件"""
+        if not self.done and self._buffer:
+            tail = bytes(self._buffer)
+            self._buffer.clear()
+            events = self.feed(tail + b"\n\n")
+        else:
+            events = []
+            self._dispatch(events)
+        return events
+
+    def _dispatch(self, events: List[Any]) -> None:
+        if not self._data_lines:
+            return
+        lines, self._data_lines = self._data_lines, []
+        data = lines[0] if len(lines) == 1 else b"\n".join(lines)
+        if data.strip() == b"[DONE]":
+            self.done = True
+            return
+        try:
+            events.append(self._loads(data))
+            self.events += 1
+        except _JSON_ERRORS:
+            self.invalid += 1
+            print(f"Invalid JSON in stream line: {data[:200].decode('utf-8', errors='replace')}")
+
+    def _pending_is_complete(self) -> bool:
+        """已缓冲的单行 data 看起来是完整的 JSON 对象或 [DONE]"""
+        if len(self._data_lines) != 1:
+            return False
+        data = self._data_lines[0].strip()
+        return data == b"[DONE]" or (data.startswith(b"{") and data.endswith(b"}"))
+
+    async def aiter_events(self, byte_iterator: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+        """包装原始字节流的异步迭代器，逐个产出解析后的事件"""
+        async for chunk in byte_iterator:
+            for event in self.feed(chunk):
+                yield event
+            if self.done:
+                return
+        for event in self.flush():
+            yield event
+
+
+def decode_sse_bytes(data: bytes, decoder: Optional[SSEDecoder] = None) -> List[Any]:
+    """一次性解码完整的 SSE 字节串 (用于非增量场景和基准测试)"""
+    decoder = decoder or SSEDecoder()
+    return decoder.feed(data) + decoder.flush()
@@ -0,0 +1,31 @@
+import re
+from typing import List
+
+_WORD_RE = re.compile(r"[a-z0-9]+|[一-鿿]+")
+_CAMEL_RE = re.compile(r"([a-z0-9])([A-Z])")
+
+
+def tokenize(text: str) -> List[str]:
+    """中英文混合分词：英文按单词 (工具名按 . _ - 和驼峰拆分)，中文取单字和相邻双字
+
+    供工具路由 (BM25) 和抽取式压缩 (TextRank、引用判断) 共用。
+    """
+    text = _CAMEL_RE.sub(r"\1 \2", text or "").lower()
+    tokens = []
+    for word in _WORD_RE.findall(text):
+        if "一" <= word[0] <= "鿿":
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+# 中日韩文字及全角标点: 主流分词器 (Qwen 等) 中大多一字一个 token
+_CJK_RE = re.compile(r"[　-〿一-鿿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """没有分词器时估算 token 数: 中文每字计 1 个 token，其余字符约 4 个字符 1 个 token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
@@ -0,0 +1,55 @@
+import json
+from typing import Dict, List, Any, Optional
+
+
+class ToolCatalog:
+    """工具目录缓存：按服务器保存已转换为 LLM 格式的工具列表，并维护版本号"""
+    def __init__(self):
+        self._server_tools: Dict[str, List[Dict[str, Any]]] = {}  # server_name -> 已转换的工具列表
+        self._stale: set[str] = set()  # 需要重新拉取工具列表的服务器
+        self.version = 0  # 任意服务器的工具列表发生变化时递增
+        self._merged: Optional[List[Dict[str, Any]]] = None
+        self._serialized: Optional[str] = None
+        self._cached_version = -1
+
+    def needs_refresh(self, server_name: str) -> bool:
+        """判断某服务器的工具列表是否需要重新获取"""
+        return server_name not in self._server_tools or server_name in self._stale
+
+    def invalidate(self, server_name: str) -> None:
+        """标记某服务器的工具列表已失效（收到 tools/list_changed 或重连时调用）"""
+        self._stale.add(server_name)
+        print(f"工具目录: 服务器 `{server_name}` 的工具列表已失效")
+
+    def remove_server(self, server_name: str) -> None:
+        """移除某服务器的全部工具（服务器断开时调用）"""
+        self._stale.discard(server_name)
+        if self._server_tools.pop(server_name, None) is not None:
+            self.version += 1
+
+    def update(self, server_name: str, tools: List[Dict[str, Any]]) -> None:
+        """写入某服务器最新的已转换工具列表"""
+        self._stale.discard(server_name)
+        if self._server_tools.get(server_name) != tools:
+            self._server_tools[server_name] = tools
+            self.version += 1
+
+    def get_tools(self, server_names: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """返回合并后的工具列表；同一版本内返回同一个列表对象"""
+        if self._merged is None or self._cached_version != self.version:
+            self._rebuild()
+        if server_names is None:
+            return self._merged
+        return [tool for name in server_names for tool in self._server_tools.get(name, [])]
+
+    def get_serialized(self) -> str:
+        """返回合并后工具列表的 JSON 序列化结果，版本不变时直接复用"""
+        if self._serialized is None or self._cached_version != self.version:
+            self._rebuild()
+        return self._serialized
+
+    def _rebuild(self) -> None:
+        self._merged = [tool for tools in self._server_tools.values() for tool in tools]
+        self._serialized = json.dumps(self._merged, ensure_ascii=False)
+        self._cached_version = self.version
+        print(f"工具目录已重建: 版本 {self.version}, 共 {len(self._merged)} 个工具")
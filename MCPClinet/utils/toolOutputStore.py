@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# 客户端内置工具：按引用读取已存档的工具输出
+READ_TOOL_OUTPUT_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "client.read_tool_output",
+        "description": "读取已存档的完整工具输出。较长的工具结果在对话中只保留预览和引用 ref，需要更多内容时用此工具按偏移量分段读取，或按关键词查找相关片段。",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "ref": {"type": "string", "description": "工具输出预览中给出的引用 ref"},
+                "offset": {"type": "integer", "description": "起始字符位置，默认 0"},
+                "length": {"type": "integer", "description": "读取的字符数，默认 4000，最大 16000"},
+                "keyword": {"type": "string", "description": "可选，返回包含该关键词的片段 (忽略 offset/length)"}
+            },
+            "required": ["ref"]
+        }
+    }
+}
+
+_REF_PATTERN = re.compile(r"[0-9a-f]{16}")  # 引用是内容 sha256 的前 16 位，也是存档文件名
+
+
+def _describe_json(value: Any, depth: int = 0, max_depth: int = 3, max_keys: int = 30) -> Any:
+    """生成 JSON 值的结构描述 (键与类型，数组只展示第一项的结构和长度)"""
+    if isinstance(value, dict):
+        if depth >= max_depth:
+            return f"object({len(value)} keys)"
+        described = {k: _describe_json(v, depth + 1, max_depth, max_keys) for k, v in list(value.items())[:max_keys]}
+        if len(value) > max_keys:
+            described["..."] = f"共 {len(value)} 个键"
+        return described
+    if isinstance(value, list):
+        if not value:
+            return []
+        if depth >= max_depth:
+            return f"array({len(value)})"
+        return [_describe_json(value[0], depth + 1, max_depth, max_keys), f"... 共 {len(value)} 项"]
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    return "null"
+
+
+def _table_info(lines) -> Optional[str]:
+    """判断文本是否为表格 (markdown / CSV / TSV)，返回表格描述"""
+    sample = [line for line in lines[:50] if line.strip()]
+    if len(sample) < 3:
+        return None
+    for sep, name in (("|", "markdown 表格"), ("\t", "TSV 表格"), (",", "CSV 表格")):
+        counts = {line.count(sep) for line in sample}
+        if len(counts) == 1 and counts.pop() > 0:
+            rows = sum(1 for line in lines if line.strip())
+            return f"{name}，共 {rows} 行"
+    return None
+
+
+def build_preview(content: str, ref: str, head_chars: int = 1500, tail_chars: int = 500) -> str:
+    """为较长的工具输出生成有界预览：JSON 给出结构，表格给出行数，文本保留开头和结尾"""
+    lines = content.splitlines()
+    parts = [f"[工具输出已存档: ref={ref}，共 {len(content)} 字符 / {len(lines)} 行]"]
+    try:
+        parsed = json.loads(content)
+        schema = json.dumps(_describe_json(parsed), ensure_ascii=False)
+        parts.append(f"JSON 结构: {schema[:head_chars]}")
+    except (json.JSONDecodeError, ValueError):
+        table = _table_info(lines)
+        if table:
+            parts.append(table)
+    parts.append(f"开头:\n{content[:head_chars]}")
+    if len(content) > head_chars + tail_chars:
+        parts.append(f"...\n结尾:\n{content[-tail_chars:]}")
+    parts.append(f"如需更多内容，请调用 client.read_tool_output (ref=\"{ref}\")，按 offset/length 分段读取或按 keyword 查找。")
+    return "\n".join(parts)
+
+
+class ToolOutputStore:
+    """内容寻址的工具输出存储：对话历史只保留预览和引用，完整输出按引用读取
+
+    内存中按 LRU 保留最近的输出 (max_bytes 字节预算)；提供 directory 时每个输出另存为 <ref>.txt，
+    重启或会话从持久化存储恢复后，历史中的引用仍然可以读取。超过 retention 秒未被读写的存档文件被定期删除。
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, preview_threshold: int = 4000,
+                 directory: Optional[str] = None, retention: Optional[float] = None, sweep_interval: float = 3600):
+        self.max_bytes = max_bytes
+        self.preview_threshold = preview_threshold  # 超过该字符数的输出才存档
+        self.directory = directory
+        self.retention = retention
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._outputs: "OrderedDict[str, str]" = OrderedDict()
+        self.total_bytes = 0
+        self.purged_files = 0
+
+    def _path(self, ref: str) -> str:
+        return os.path.join(self.directory, f"{ref}.txt")
+
+    def _remember(self, ref: str, content: str) -> None:
+        """放入内存缓存，超出预算时淘汰最久未使用的输出 (存档文件不受影响)"""
+        self._outputs[ref] = content
+        self.total_bytes += len(content.encode("utf-8"))
+        while self.total_bytes > self.max_bytes and len(self._outputs) > 1:
+            _, evicted = self._outputs.popitem(last=False)
+            self.total_bytes -= len(evicted.encode("utf-8"))
+
+    def _write_file(self, ref: str, content: str) -> None:
+        path = self._path(ref)
+        try:
+            if os.path.exists(path):
+                os.utime(path)  # 相同内容已存档，只刷新保留时间
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"写入工具输出存档 {path} 失败: {e}")
+
+    def _read_file(self, ref: str) -> Optional[str]:
+        path = self._path(ref)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+            os.utime(path)
+            return content
+        except OSError:
+            return None
+
+    async def put(self, content: str) -> str:
+        """保存输出并返回引用 (内容的 sha256 前缀)，相同内容只保存一份"""
+        ref = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+        if ref in self._outputs:
+            self._outputs.move_to_end(ref)
+        else:
+            self._remember(ref, content)
+        if self.directory:
+            await asyncio.to_thread(self._write_file, ref, content)
+            if self.retention is not None and time.monotonic() - self._last_sweep >= self.sweep_interval:
+                self._last_sweep = time.monotonic()
+                await asyncio.to_thread(self.purge_expired)
+        return ref
+
+    async def get(self, ref: str) -> Optional[str]:
+        content = self._outputs.get(ref)
+        if content is not None:
+            self._outputs.move_to_end(ref)
+            return content
+        if not self.directory or not _REF_PATTERN.fullmatch(ref):
+            return None
+        content = await asyncio.to_thread(self._read_file, ref)
+        if content is not None:
+            self._remember(ref, content)
+        return content
+
+    def purge_expired(self) -> int:
+        """删除超过 retention 秒未被读写的存档文件，返回删除的文件数"""
+        if self.retention is None or not self.directory or not os.path.isdir(self.directory):
+            return 0
+        cutoff = time.time() - self.retention
+        purged = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".txt") and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    purged += 1
+            except OSError as e:
+                print(f"清理工具输出存档 {path} 失败: {e}")
+        if purged:
+            self.purged_files += purged
+            print(f"删除 {purged} 个超过保留时间的工具输出存档")
+        return purged
+
+    async def to_context(self, content: str) -> str:
+        """返回放入对话历史的内容：短输出原样返回，长输出存档后返回预览"""
+        if len(content) <= self.preview_threshold:
+            return content
+        return build_preview(content, await self.put(content))
+
+    async def read(self, args: Dict[str, Any]) -> str:
+        """client.read_tool_output 的实现"""
+        ref = str(args.get("ref", ""))
+        content = await self.get(ref)
+        if content is None:
+            return f"错误: 未找到引用 {ref} 对应的工具输出 (可能已被淘汰)，请重新调用原工具。"
+
+        keyword = args.get("keyword")
+        if keyword:
+            snippets = []
+            start = content.find(keyword)
+            while start != -1 and len(snippets) < 10:
+                snippets.append(f"[offset {start}] ...{content[max(0, start - 200):start + len(keyword) + 200]}...")
+                start = content.find(keyword, start + len(keyword))
+            return "\n\n".join(snippets) if snippets else f"未找到关键词 {keyword}。"
+
+        offset = max(0, int(args.get("offset") or 0))
+        length = min(16000, max(1, int(args.get("length") or 4000)))
+        chunk = content[offset:offset + length]
+        end = offset + len(chunk)
+        return f"[ref={ref}，字符 {offset}-{end} / 共 {len(content)}]\n{chunk}"
@@ -0,0 +1,117 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def canonical_args(args: Dict[str, Any]) -> str:
+    """将工具参数规范化为稳定的字符串 (键排序、紧凑格式)"""
+    return json.dumps(args or {}, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def estimate_result_size(result: Any) -> int:
+    """估算工具结果占用的字节数"""
+    size = 0
+    for item in getattr(result, "content", None) or []:
+        text = getattr(item, "text", None)
+        size += len(text.encode("utf-8")) if isinstance(text, str) else len(str(item))
+    return size + 64
+
+
+class ToolResultCache:
+    """幂等工具调用的结果缓存：按 (服务器, 工具, 规范化参数) 缓存，支持按工具配置 TTL 与按字节预算的 LRU 淘汰
+
+    每个服务器的缓存规则来自 MCP 配置中的 "cache" 字段，例如:
+        "cache": {
+            "default_ttl": 0,
+            "tools": {"get_weather_tool": {"ttl": 600}},
+            "invalidated_by": ["write_file"]
+        }
+    ttl 为 0 或未配置的工具不缓存；调用 invalidated_by 中的工具会清空该服务器的缓存。
+    invalidated_by 也可以列出其他服务器的工具 ("服务器.工具"，或 "服务器.*" 表示该服务器的任意工具)，
+    例如执行命令、编辑文档的服务器同样会修改文件系统。
+    """
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[float, int, Any]]" = OrderedDict()  # key -> (过期时间, 大小, 结果)
+        self._rules: Dict[str, Dict[str, Any]] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def configure_server(self, server_name: str, cache_config: Optional[Dict[str, Any]]) -> None:
+        """登记某服务器的缓存规则"""
+        if cache_config:
+            self._rules[server_name] = cache_config
+        else:
+            self._rules.pop(server_name, None)
+
+    def get_ttl(self, server_name: str, tool_name: str) -> float:
+        """返回工具的缓存时间 (秒)，0 表示不缓存"""
+        rules = self._rules.get(server_name)
+        if not rules:
+            return 0
+        tool_rule = rules.get("tools", {}).get(tool_name)
+        if tool_rule is None:
+            return rules.get("default_ttl", 0)
+        if isinstance(tool_rule, (int, float)):
+            return tool_rule
+        return tool_rule.get("ttl", 0)
+
+    def get(self, server_name: str, tool_name: str, args: Dict[str, Any]) -> Optional[Any]:
+        """查询缓存，命中返回结果，否则返回 None"""
+        if self.get_ttl(server_name, tool_name) <= 0:
+            return None
+        key = (server_name, tool_name, canonical_args(args))
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, server_name: str, tool_name: str, args: Dict[str, Any], result: Any) -> None:
+        """写入缓存；出错的结果和不可缓存的工具不会写入"""
+        ttl = self.get_ttl(server_name, tool_name)
+        if ttl <= 0 or getattr(result, "isError", None) or getattr(result, "is_error", None):  # 新版 mcp 字段名为 is_error
+            return
+        size = estimate_result_size(result)
+        if size > self.max_bytes:
+            return
+        key = (server_name, tool_name, canonical_args(args))
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, size, result)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def on_tool_called(self, server_name: str, tool_name: str) -> None:
+        """工具调用后检查哪些服务器的缓存需要失效 (例如写文件、执行命令后)"""
+        qualified = (f"{server_name}.{tool_name}", f"{server_name}.*")
+        for target, rules in self._rules.items():
+            invalidated_by = rules.get("invalidated_by", [])
+            if any(entry in qualified for entry in invalidated_by) or \
+                    (target == server_name and tool_name in invalidated_by):
+                self.invalidate_server(target)
+
+    def invalidate_server(self, server_name: str) -> None:
+        for key in [key for key in self._entries if key[0] == server_name]:
+            self._remove(key)
+
+    def _remove(self, key: Tuple[str, str, str]) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+        }
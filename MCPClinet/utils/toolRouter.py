@@ -0,0 +1,116 @@
+import json
+import math
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from utils.textUtils import estimate_tokens, tokenize
+
+
+def tool_name(tool: Dict[str, Any]) -> str:
+    return tool.get("function", {}).get("name", "")
+
+
+class ToolRouter:
+    """本地工具路由：对工具名、描述和参数说明建立 BM25 索引，每次调用 LLM 只发送与当前问题最相关的 top-k 个工具
+
+    - 工具目录版本变化时重建索引
+    - always_include 中的工具 (例如客户端内置工具) 和最近用过的工具总是发送
+    - 工具总数不超过 min_tools 时不路由，直接发送全部工具
+    - 最相关工具的分数低于 min_score (例如中文问题对英文工具描述，几乎没有共同的词) 时
+      检索结果不可信，同样发送全部工具，避免模型只看到内置工具
+    """
+    def __init__(self, top_k: int = 12, min_tools: int = 24, count_tokens: Optional[Callable[[str], int]] = None,
+                 k1: float = 1.5, b: float = 0.75, min_score: float = 1.0):
+        self.top_k = top_k
+        self.min_tools = min_tools
+        self.min_score = min_score
+        self.count_tokens = count_tokens or estimate_tokens
+        self.k1 = k1
+        self.b = b
+
+        self._version = -1
+        self._tools: List[Dict[str, Any]] = []
+        self._doc_terms: List[Counter] = []
+        self._doc_lengths: List[int] = []
+        self._avg_length = 0.0
+        self._idf: Dict[str, float] = {}
+        self._full_tokens = 0
+        self._subset_cache: Dict[Tuple[str, ...], Tuple[List[Dict[str, Any]], str, int]] = {}
+        self.tokens_saved_total = 0
+
+    def _sync(self, tools: List[Dict[str, Any]], version: int, serialized: str) -> None:
+        """工具目录版本变化时重建索引"""
+        if version == self._version:
+            return
+        self._tools = tools
+        self._doc_terms = []
+        for tool in tools:
+            function = tool.get("function", {})
+            params = function.get("parameters", {}).get("properties", {})
+            text = " ".join([function.get("name", "").split(".", 1)[-1]] * 2  # 工具名加权
+                            + [function.get("name", ""), function.get("description") or ""]
+                            + [f"{name} {prop.get('description', '')}" for name, prop in params.items()])
+            self._doc_terms.append(Counter(tokenize(text)))
+        self._doc_lengths = [sum(terms.values()) for terms in self._doc_terms]
+        self._avg_length = sum(self._doc_lengths) / len(self._doc_lengths) if self._doc_lengths else 0.0
+        document_frequency = Counter(term for terms in self._doc_terms for term in terms)
+        total = len(tools)
+        self._idf = {term: math.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+        self._full_tokens = self.count_tokens(serialized)
+        self._subset_cache.clear()
+        self._version = version
+
+    def _score(self, query_terms: Iterable[str]) -> List[float]:
+        scores = [0.0] * len(self._tools)
+        for term in set(query_terms):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for i, terms in enumerate(self._doc_terms):
+                tf = terms.get(term)
+                if tf:
+                    norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[i] / (self._avg_length or 1))
+                    scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def route(self, query: str, tools: List[Dict[str, Any]], version: int, serialized: str,
+              recent_tools: Iterable[str] = (), always_include: Iterable[str] = ()) -> Optional[List[str]]:
+        """选出本轮发送的工具名列表；不需要路由 (工具较少或没有可信的匹配) 时返回 None 表示发送全部工具"""
+        self._sync(tools, version, serialized)
+        if len(self._tools) <= self.min_tools:
+            return None
+
+        pinned = set(recent_tools) | set(always_include)
+        scores = self._score(tokenize(query))
+        best = max((score for tool, score in zip(self._tools, scores) if tool_name(tool) not in pinned), default=0.0)
+        if best < self.min_score:
+            return None  # 除总是发送的工具外没有可信的匹配
+
+        selected = [tool_name(tool) for tool in self._tools if tool_name(tool) in pinned]
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+        for i in ranked:
+            if len(selected) >= self.top_k + len(pinned):
+                break
+            name = tool_name(self._tools[i])
+            if name not in pinned:
+                selected.append(name)
+        return selected
+
+    def subset(self, names: List[str], tools: List[Dict[str, Any]], version: int,
+               serialized: str) -> Tuple[List[Dict[str, Any]], str, int]:
+        """返回工具名列表对应的 (工具定义列表, JSON 序列化结果, 相比发送全部工具节省的 token 数)，按工具名组合缓存"""
+        self._sync(tools, version, serialized)
+        key = tuple(names)
+        cached = self._subset_cache.get(key)
+        if cached is None:
+            wanted = set(names)
+            tools = [tool for tool in self._tools if tool_name(tool) in wanted]
+            serialized = json.dumps(tools, ensure_ascii=False)
+            cached = (tools, serialized, max(0, self._full_tokens - self.count_tokens(serialized)))
+            if len(self._subset_cache) > 256:
+                self._subset_cache.clear()
+            self._subset_cache[key] = cached
+        return cached
+
+    def record_saved(self, tokens: int) -> None:
+        self.tokens_saved_total += tokens
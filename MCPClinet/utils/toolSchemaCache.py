@@ -0,0 +1,61 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+
+def server_fingerprint(server_config: Dict[str, Any]) -> str:
+    """服务器启动方式 (命令、参数、环境变量或 URL) 的指纹，配置改变后缓存的工具定义随之失效"""
+    identity = {key: server_config.get(key) for key in ("command", "args", "env", "url")}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+
+class ToolSchemaCache:
+    """持久化的工具定义缓存：保存各服务器上次运行时的工具列表 (已转换为 LLM 格式)
+
+    按需启动的服务器在进程未运行时也能用缓存的工具定义出现在工具目录中。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._write_lock = asyncio.Lock()  # 串行写文件，后写入的总是较新的内容
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"读取工具定义缓存 {self.path} 失败: {e}")
+            self._entries = {}
+
+    def get(self, server_name: str, fingerprint: str) -> Optional[List[Dict[str, Any]]]:
+        """返回缓存的工具列表；服务器配置已改变或没有缓存时返回 None"""
+        entry = self._entries.get(server_name)
+        if not entry or entry.get("fingerprint") != fingerprint:
+            return None
+        return entry.get("tools")
+
+    async def put(self, server_name: str, fingerprint: str, tools: List[Dict[str, Any]]) -> None:
+        """更新缓存，内容有变化时在线程中写回文件，不阻塞事件循环"""
+        entry = {"fingerprint": fingerprint, "tools": tools}
+        if self._entries.get(server_name) == entry:
+            return
+        self._entries[server_name] = entry
+        snapshot = dict(self._entries)  # 条目只会被整体替换，浅拷贝即可在线程中安全序列化
+        async with self._write_lock:
+            await asyncio.to_thread(self._write, snapshot)
+
+    def _write(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        """写回文件 (先写临时文件再替换)"""
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"写入工具定义缓存 {self.path} 失败: {e}")
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+from utils.metrics import WS_SEND_SECONDS
+
+
+class WebSocketCoalescer:
+    """流式输出合并器：把逐 token 的增量合并成较大的 WebSocket 帧
+
+    - 相邻的同类型增量 (content / reasoning) 合并到同一帧，类型切换或 newStep 时另起一帧，保证顺序不变
+    - 缓冲内容超过 flush_interval 秒或 flush_bytes 字节时发送
+    - 客户端跟不上时 (上一帧仍在发送) 增量继续合并；待发送字节超过 max_pending_bytes 时 push 等待发送完成，形成背压
+    """
+    def __init__(self, websocket, flush_interval: float = 0.04, flush_bytes: int = 4096,
+                 max_pending_bytes: int = 256 * 1024):
+        self.websocket = websocket
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.max_pending_bytes = max_pending_bytes
+
+        self._frames: List[Dict[str, Any]] = []  # 待发送的帧，每帧 {"type", "parts", 其它字段}
+        self._pending_bytes = 0
+        self._first_pending_at = 0.0
+        self._send_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self.frames_sent = 0
+        self.deltas = 0
+
+    async def push(self, msg_type: str, content: str, **fields) -> None:
+        """缓冲一个增量；fields 中的 newStep=True 会开始新的一帧"""
+        self.deltas += 1
+        last = self._frames[-1] if self._frames else None
+        if last is None or last["type"] != msg_type or fields.get("newStep"):
+            last = {"type": msg_type, "parts": [], **fields}
+            self._frames.append(last)
+        last["parts"].append(content)
+        if not self._pending_bytes:
+            self._first_pending_at = time.monotonic()
+        self._pending_bytes += len(content.encode("utf-8"))
+
+        due = self._pending_bytes >= self.flush_bytes or time.monotonic() - self._first_pending_at >= self.flush_interval
+        if self._pending_bytes >= self.max_pending_bytes:
+            await self.flush()  # 背压：等待之前的帧发送完成
+        elif due and not self._send_lock.locked():
+            await self.flush()
+        elif self._timer is None or self._timer.done():
+            # 未到发送时机，或上一帧仍在发送 (增量继续合并)，由定时器稍后发送
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await asyncio.shield(self.flush())  # 取消定时器时不打断正在发送的帧
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"WebSocket 合并发送失败: {e}")
+
+    async def flush(self) -> None:
+        """发送所有缓冲的帧"""
+        async with self._send_lock:
+            frames, self._frames = self._frames, []
+            self._pending_bytes = 0
+            for frame in frames:
+                payload = {key: value for key, value in frame.items() if key != "parts"}
+                payload["content"] = "".join(frame["parts"])
+                with WS_SEND_SECONDS.time():
+                    await self.websocket.send(json.dumps(payload))
+                self.frames_sent += 1
+
+    async def close(self) -> None:
+        """流结束时调用：取消定时器并发送剩余内容"""
+        if self._timer is not None and not self._timer.done() and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            try:
+                await self._timer
+            except asyncio.CancelledError:
+                pass
+        self._timer = None
+        await self.flush()
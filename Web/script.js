@@ -13,6 +13,7 @@ let currentReasoningMessageDiv = null
 // 添加一个计数器或会话ID来区分不同的用户消息
 let conversationCounter = 0;
 let currentSessionId = null;
+let serverSessionId = sessionStorage.getItem('mcpSessionId'); // 服务端会话 ID，重连后恢复同一对话 (按标签页保存，多个标签页各自独立)
 
 // 页面加载时执行
 document.addEventListener('DOMContentLoaded', () => {
@@ -177,8 +178,9 @@ function clearMessages() {
 // 连接WebSocket
 function connectWebSocket() {
     try {
-        // 直接使用硬编码的WebSocket地址
-        socket = new WebSocket(`ws://127.0.0.1:5000/ws`);
+        // 直接使用硬编码的WebSocket地址，携带会话 ID 以恢复对话
+        const sessionQuery = serverSessionId ? `?session_id=${encodeURIComponent(serverSessionId)}` : '';
+        socket = new WebSocket(`ws://127.0.0.1:5000/ws${sessionQuery}`);
         
         socket.onopen = function(e) {
             console.log("WebSocket 连接已建立");
@@ -254,6 +256,10 @@ function handleMessage(data) {
             case "system":
                 addSystemMessage(message.content);
                 break;
+            case "session":
+                serverSessionId = message.session_id;
+                sessionStorage.setItem('mcpSessionId', serverSessionId);
+                break;
             default:
                 // 作为普通文本消息处理
                 addSystemMessage(typeof message === 'string' ? message : JSON.stringify(message));